@@ -0,0 +1,254 @@
+"""
+本地日 K 快取（SQLite），推播與補齊歷史兩支程式共用。
+
+- 以 (stock_id, date) 為主鍵，已完成的交易日永久保留
+- coverage 表記錄每支股票已向 FinMind 確認過的日期區間，
+  之後只補抓區間外（通常是最後快取日之後）的日期
+- 資料有誤時可用指令清除，下次執行會自動重新抓取：
+
+    python bar_store.py invalidate 2330 --from 2024-05-01 --to 2024-05-31
+    python bar_store.py invalidate --all
+    python bar_store.py stats
+"""
+import argparse
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+BAR_STORE_PATH = os.getenv("BAR_STORE_PATH", "market_data.db")
+TW_TZ = timezone(timedelta(hours=8))
+MARKET_CLOSE_HOUR = 14  # 14:00 後 FinMind 才會有當天日 K
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_bars (
+    stock_id TEXT NOT NULL,
+    date     TEXT NOT NULL,
+    open     REAL,
+    high     REAL,
+    low      REAL,
+    close    REAL,
+    volume   REAL,
+    PRIMARY KEY (stock_id, date)
+);
+CREATE TABLE IF NOT EXISTS coverage (
+    stock_id      TEXT PRIMARY KEY,
+    covered_from  TEXT NOT NULL,
+    covered_until TEXT NOT NULL
+);
+"""
+
+
+def _shift(date_str: str, days: int) -> str:
+    return (datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def last_completed_date(now: Optional[datetime] = None) -> str:
+    """回傳目前可視為「已收盤定案」的最後日期：14:00 後為今天，否則為昨天。"""
+    now = now or datetime.now(TW_TZ)
+    if now.hour >= MARKET_CLOSE_HOUR:
+        return now.strftime("%Y-%m-%d")
+    return (now - timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+class BarStore:
+    """SQLite 日 K 快取；同一連線以鎖保護，可在抓取執行緒池中共用。"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or BAR_STORE_PATH
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # ---------- 讀取 ----------
+    def get_bars(self, stock_id: str, start_date: str, end_date: str) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT date, open, high, low, close, volume FROM daily_bars "
+                "WHERE stock_id = ? AND date BETWEEN ? AND ? ORDER BY date",
+                (stock_id, start_date, end_date),
+            ).fetchall()
+        return [
+            {"date": r[0], "open": r[1], "high": r[2], "low": r[3], "close": r[4], "volume": r[5]}
+            for r in rows
+        ]
+
+    def coverage(self, stock_id: str) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT covered_from, covered_until FROM coverage WHERE stock_id = ?",
+                (stock_id,),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    # ---------- 寫入 ----------
+    def upsert_bars(self, stock_id: str, bars: List[Dict]):
+        if not bars:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO daily_bars (stock_id, date, open, high, low, close, volume) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (stock_id, b["date"], b.get("open"), b.get("high"), b.get("low"), b["close"], b.get("volume"))
+                    for b in bars
+                ],
+            )
+            self._conn.commit()
+
+    def bar_dates(self, start_date: str, end_date: str) -> List[str]:
+        """區間內任何股票有日 K 的日期（供交易日曆推導）。"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT date FROM daily_bars WHERE date BETWEEN ? AND ? ORDER BY date",
+                (start_date, end_date),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def set_coverage(self, stock_id: str, covered_from: str, covered_until: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO coverage (stock_id, covered_from, covered_until) VALUES (?, ?, ?)",
+                (stock_id, covered_from, covered_until),
+            )
+            self._conn.commit()
+
+    def invalidate(self, stock_id: Optional[str] = None,
+                   start_date: Optional[str] = None, end_date: Optional[str] = None) -> int:
+        """刪除指定範圍的快取並縮小 coverage，回傳刪除筆數。未指定 stock_id 時作用於全部股票。"""
+        start_date = start_date or "0000-01-01"
+        end_date = end_date or "9999-12-31"
+        with self._lock:
+            where, params = "date BETWEEN ? AND ?", [start_date, end_date]
+            if stock_id:
+                where += " AND stock_id = ?"
+                params.append(stock_id)
+            deleted = self._conn.execute(f"DELETE FROM daily_bars WHERE {where}", params).rowcount
+
+            cov_sql = "SELECT stock_id, covered_from, covered_until FROM coverage"
+            cov_params = []
+            if stock_id:
+                cov_sql += " WHERE stock_id = ?"
+                cov_params.append(stock_id)
+            for sid, cov_from, cov_until in self._conn.execute(cov_sql, cov_params).fetchall():
+                if end_date < cov_from or start_date > cov_until:
+                    continue
+                if start_date <= cov_from:
+                    # 刪到區間開頭：整段重新確認
+                    self._conn.execute("DELETE FROM coverage WHERE stock_id = ?", (sid,))
+                else:
+                    self._conn.execute(
+                        "UPDATE coverage SET covered_until = ? WHERE stock_id = ?",
+                        (_shift(start_date, -1), sid),
+                    )
+            self._conn.commit()
+        return deleted
+
+    def stats(self) -> List[Tuple]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT b.stock_id, COUNT(*), MIN(b.date), MAX(b.date), c.covered_until "
+                "FROM daily_bars b LEFT JOIN coverage c ON c.stock_id = b.stock_id "
+                "GROUP BY b.stock_id ORDER BY b.stock_id"
+            ).fetchall()
+
+
+def _df_to_bars(df) -> List[Dict]:
+    """FinMind taiwan_stock_daily DataFrame → 快取用的 bar dict。"""
+    if df is None or df.empty:
+        return []
+    bars = []
+    for rec in df.to_dict("records"):
+        bars.append({
+            "date": str(rec["date"])[:10],
+            "open": rec.get("open"),
+            "high": rec.get("max"),
+            "low": rec.get("min"),
+            "close": float(rec["close"]),
+            "volume": rec.get("Trading_Volume"),
+        })
+    return bars
+
+
+def missing_segments(store: BarStore, stock_id: str, start_date: str, end_date: str,
+                     now: Optional[datetime] = None) -> List[Tuple[str, str]]:
+    """回傳 start_date～end_date 中快取尚未涵蓋、且已可向資料來源查詢的日期區段。"""
+    fetch_end = min(end_date, last_completed_date(now))
+    cov = store.coverage(stock_id)
+    segments = []
+    if cov is None:
+        segments.append((start_date, fetch_end))
+    else:
+        cov_from, cov_until = cov
+        if start_date < cov_from:
+            segments.append((start_date, min(_shift(cov_from, -1), fetch_end)))
+        if fetch_end > cov_until:
+            segments.append((max(_shift(cov_until, 1), start_date), fetch_end))
+    return [(s, e) for s, e in segments if s <= e]
+
+
+def sync_daily_bars(store: BarStore, stock_id: str, start_date: str, end_date: str,
+                    fetch_daily: Callable, now: Optional[datetime] = None) -> List[Dict]:
+    """
+    回傳 start_date～end_date 的日 K，只向資料來源補抓快取未涵蓋的日期。
+    fetch_daily(stock_id, start_date, end_date) 需回傳 FinMind 格式 DataFrame；
+    回傳 None 表示該區段這次不補（例如只寫入已預先抓到的資料），coverage 不延伸到該區段。
+    當天日 K 只有在實際抓到資料時才納入 coverage，避免盤後資料延遲時被永久略過。
+    """
+    today = (now or datetime.now(TW_TZ)).strftime("%Y-%m-%d")
+    cov = store.coverage(stock_id)
+    new_from, new_until = (cov if cov else (start_date, _shift(start_date, -1)))
+    for seg_start, seg_end in missing_segments(store, stock_id, start_date, end_date, now):
+        df = fetch_daily(stock_id, seg_start, seg_end)
+        if df is None:
+            continue
+        bars = _df_to_bars(df)
+        store.upsert_bars(stock_id, bars)
+        confirmed_until = seg_end
+        if seg_end >= today and not any(b["date"] == seg_end for b in bars):
+            confirmed_until = _shift(today, -1)
+        new_from = min(new_from, seg_start)
+        new_until = max(new_until, confirmed_until)
+
+    if new_until >= new_from:
+        store.set_coverage(stock_id, new_from, new_until)
+    return store.get_bars(stock_id, start_date, end_date)
+
+
+# ======================== 指令列 ========================
+def main():
+    parser = argparse.ArgumentParser(description="本地日 K 快取管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    inv = sub.add_parser("invalidate", help="清除錯誤資料，下次執行自動重抓")
+    inv.add_argument("stock_id", nargs="?", help="股票代號（搭配 --all 可省略）")
+    inv.add_argument("--from", dest="start_date", help="起始日期 YYYY-MM-DD（含）")
+    inv.add_argument("--to", dest="end_date", help="結束日期 YYYY-MM-DD（含）")
+    inv.add_argument("--all", action="store_true", help="清除所有股票")
+
+    sub.add_parser("stats", help="顯示各股票快取筆數與範圍")
+
+    args = parser.parse_args()
+    store = BarStore()
+    try:
+        if args.command == "invalidate":
+            if not args.stock_id and not args.all:
+                parser.error("請指定股票代號，或使用 --all 清除全部")
+            stock_id = None if args.all else args.stock_id.strip().upper()
+            deleted = store.invalidate(stock_id, args.start_date, args.end_date)
+            print(f"已清除 {deleted} 筆快取（{stock_id or '全部股票'}）")
+        elif args.command == "stats":
+            for stock_id, count, first, last, covered in store.stats():
+                print(f"{stock_id}\t{count} 筆\t{first} ~ {last}\t已確認至 {covered}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
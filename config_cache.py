@@ -0,0 +1,187 @@
+"""
+Config 分頁（股票清單）與 Rules 分頁（建議規則）本地快取（SQLite，與日 K 快取共用同一個檔案）。
+
+- 解析後的結果連同內容指紋（sha256）存在本地；CONFIG_CACHE_TTL_MINUTES 內直接沿用，不讀 Sheets
+- 過期後重新讀取：指紋相同只更新讀取時間，不重新解析與驗證；不同才重新解析
+- 格式錯誤等警告以指紋記錄是否已送出，同一份內容只警告一次（cron 每次重新啟動也一樣）
+- 讀取 Sheets 失敗時沿用已過期的快取
+- 版本以內容指紋判斷：Drive 的 modifiedTime 需要額外的 Drive 權限，服務帳號只有 spreadsheets 權限
+
+    python config_cache.py invalidate      # 改了 Config 想立即生效時，清除快取
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from bar_store import BAR_STORE_PATH
+
+CONFIG_CACHE_TTL_MINUTES = float(os.getenv("CONFIG_CACHE_TTL_MINUTES", "30"))  # 0：每次都讀取（仍只在變更時解析）
+STOCK_ID_PATTERN = re.compile(r'^[0-9]{4,6}[A-Z]?$')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS config_cache (
+    range_name  TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    parsed      TEXT NOT NULL,
+    fetched_at  REAL NOT NULL,
+    warned      TEXT
+);
+"""
+
+
+class Watchlist(NamedTuple):
+    stock_ids: List[str]
+    names: Dict[str, str]
+    rows: int                         # 有代號的列數
+    disabled: List[Tuple[str, str]]   # (代號, 啟用欄的值)
+    invalid: List[str]
+    duplicates: List[str]
+
+
+class ConfigLoad(NamedTuple):
+    value: Optional[Any]              # 解析結果（預設為 Watchlist）；None：讀取失敗且沒有快取
+    fingerprint: Optional[str]
+    status: str                       # fresh／unchanged／changed／stale／failed
+    error: Optional[str] = None
+
+
+def fingerprint(rows: List[List]) -> str:
+    return hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def parse_watchlist(rows: List[List]) -> Watchlist:
+    """Config 列（A 代號、B 名稱、C 啟用）→ 清單；C 欄空白視為 Y，只驗證不輸出。"""
+    stock_ids: List[str] = []
+    names: Dict[str, str] = {}
+    count = 0
+    disabled, invalid, duplicates = [], [], []
+    for row in rows or []:
+        if not row or not str(row[0]).strip():
+            continue
+        count += 1
+        stock_id = str(row[0]).strip().upper()
+        stock_name = str(row[1]).strip() if len(row) > 1 and row[1] else stock_id
+        enabled = str(row[2]).strip().upper() if len(row) > 2 and row[2] else "Y"
+        if enabled != "Y":
+            disabled.append((stock_id, enabled))
+        elif not STOCK_ID_PATTERN.match(stock_id):
+            invalid.append(stock_id)
+        elif stock_id in names:
+            duplicates.append(stock_id)
+        else:
+            stock_ids.append(stock_id)
+            names[stock_id] = stock_name
+    return Watchlist(stock_ids, names, count, disabled, invalid, duplicates)
+
+
+def restore_watchlist(value) -> Watchlist:
+    return Watchlist(*value)
+
+
+class ConfigCache:
+    def __init__(self, path: Optional[str] = None, ttl_minutes: float = CONFIG_CACHE_TTL_MINUTES,
+                 clock: Callable[[], float] = time.time):
+        self.path = path or BAR_STORE_PATH
+        self.ttl = ttl_minutes * 60
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _row(self, range_name: str):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT fingerprint, parsed, fetched_at, warned FROM config_cache WHERE range_name = ?",
+                (range_name,),
+            ).fetchone()
+
+    def expired(self, range_name: str) -> bool:
+        """快取不存在或超過 TTL，需要重新讀取 Sheets。"""
+        row = self._row(range_name)
+        return row is None or self.clock() - row[2] >= self.ttl
+
+    def load(self, sheets, range_name: str, parse: Callable[[List[List]], Any] = parse_watchlist,
+             restore: Callable[[Any], Any] = restore_watchlist, missing_ok: bool = False) -> ConfigLoad:
+        """
+        TTL 內回傳快取；否則讀取 range_name（sheets 為 SheetsGateway，可先 prefetch），內容變更才以 parse 重新解析。
+        parse 的結果須可轉成 JSON，restore 把 JSON 轉回原本的型別。
+        missing_ok 時分頁不存在視為空白（選用的分頁不必每次重試）。
+        """
+        row = self._row(range_name)
+        now = self.clock()
+        if row is not None and now - row[2] < self.ttl:
+            return ConfigLoad(restore(json.loads(row[1])), row[0], "fresh")
+        try:
+            rows = sheets.get(range_name)
+        except Exception as e:
+            if missing_ok and "Unable to parse range" in str(e):
+                rows = []
+            elif row is not None:
+                return ConfigLoad(restore(json.loads(row[1])), row[0], "stale", str(e))
+            else:
+                return ConfigLoad(None, None, "failed", str(e))
+
+        digest = fingerprint(rows)
+        with self._lock:
+            if row is not None and row[0] == digest:
+                self._conn.execute("UPDATE config_cache SET fetched_at = ? WHERE range_name = ?", (now, range_name))
+                self._conn.commit()
+                return ConfigLoad(restore(json.loads(row[1])), digest, "unchanged")
+            value = parse(rows)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO config_cache (range_name, fingerprint, parsed, fetched_at, warned) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (range_name, digest, json.dumps(value, ensure_ascii=False), now, row[3] if row else None),
+            )
+            self._conn.commit()
+        return ConfigLoad(value, digest, "changed")
+
+    def needs_warning(self, range_name: str, digest: Optional[str]) -> bool:
+        """這份內容（指紋）的驗證警告是否還沒送出過。"""
+        row = self._row(range_name)
+        return digest is not None and (row is None or row[3] != digest)
+
+    def mark_warned(self, range_name: str, digest: str):
+        with self._lock:
+            self._conn.execute("UPDATE config_cache SET warned = ? WHERE range_name = ?", (digest, range_name))
+            self._conn.commit()
+
+    def invalidate(self, range_name: Optional[str] = None):
+        """清除快取，下次一定重新讀取（range_name 為 None 時清除全部）。"""
+        with self._lock:
+            if range_name is None:
+                self._conn.execute("DELETE FROM config_cache")
+            else:
+                self._conn.execute("DELETE FROM config_cache WHERE range_name = ?", (range_name,))
+            self._conn.commit()
+
+
+# ======================== 指令列 ========================
+def main():
+    parser = argparse.ArgumentParser(description="Config 分頁快取管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("invalidate", help="清除快取，下次執行立即重新讀取 Config 分頁")
+    args = parser.parse_args()
+
+    cache = ConfigCache()
+    try:
+        if args.command == "invalidate":
+            cache.invalidate()
+            print("已清除 Config 快取")
+    finally:
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
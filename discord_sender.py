@@ -0,0 +1,155 @@
+"""
+Discord Webhook 推播：合併訊息 + 依 Discord 限流標頭調整節奏。
+
+- 多個股票區塊合併成一則訊息，每則不超過 2000 字元（單一區塊過長時按行切開）
+- 依回應的 X-RateLimit-Remaining / X-RateLimit-Reset-After 決定是否要等，
+  429 時依 retry_after 重試，不再固定 sleep
+- 另受 QUOTAS 的每個 webhook 每分鐘配額節流，429 時同步讓配額桶退避
+- 共用同一個 requests.Session（連線池）
+"""
+from __future__ import annotations
+
+import time
+import zlib
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+from metrics import METRICS
+from quota import QUOTAS
+
+if TYPE_CHECKING:
+    import requests
+
+DISCORD_MAX_CHARS = 2000
+MAX_RETRIES = 5
+
+
+def pack_blocks(blocks: List[str], limit: int = DISCORD_MAX_CHARS, sep: str = "\n\n") -> List[str]:
+    """依序把區塊合併成不超過 limit 字元的訊息；不改變區塊順序。"""
+    messages: List[str] = []
+    current = ""
+    for block in blocks:
+        for piece in _split_long(block, limit):
+            candidate = f"{current}{sep}{piece}" if current else piece
+            if len(candidate) <= limit:
+                current = candidate
+            else:
+                messages.append(current)
+                current = piece
+    if current:
+        messages.append(current)
+    return messages
+
+
+def _split_long(block: str, limit: int) -> List[str]:
+    """超過 limit 的區塊按行切開，單行仍過長時硬切。"""
+    if len(block) <= limit:
+        return [block]
+    pieces, current = [], ""
+    for line in block.split("\n"):
+        while len(line) > limit:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) <= limit:
+            current = candidate
+        else:
+            pieces.append(current)
+            current = line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+class DiscordSender:
+    def __init__(self, webhook_url: Optional[str], log: Callable[[str], None] = print,
+                 session: Optional[requests.Session] = None, sleep: Callable[[float], None] = time.sleep,
+                 clock: Callable[[], float] = time.monotonic, max_chars: int = DISCORD_MAX_CHARS):
+        self.webhook_url = webhook_url
+        self.log = log
+        if session is None:
+            import requests  # 延後到第一次建立 sender 才載入
+            session = requests.Session()
+        self.session = session
+        self.sleep = sleep
+        self.clock = clock
+        self.max_chars = max_chars
+        self._blocks: List[str] = []
+        self._next_allowed = 0.0  # 依限流標頭推算的下一次可送出時間（clock 時間）
+        # 每個 webhook 一個配額桶；名稱只帶網址的雜湊，不把 token 寫進 log
+        self.quota_name = f"discord:{zlib.crc32((webhook_url or '').encode('utf-8')):08x}"
+        self.post_count = 0
+        self.rate_limited_count = 0
+
+    # ---------- 合併佇列 ----------
+    def queue(self, block: str):
+        self._blocks.append(block)
+
+    def flush(self) -> bool:
+        """依序送出佇列中所有區塊（合併後），回傳是否全部成功。"""
+        blocks, self._blocks = self._blocks, []
+        ok = True
+        for message in pack_blocks(blocks, self.max_chars):
+            ok = self.send(message) and ok
+        return ok
+
+    # ---------- 單則送出 ----------
+    def send(self, message: str) -> bool:
+        if not self.webhook_url:
+            self.log("未設定 DISCORD_WEBHOOK_URL，無法推播 Discord。")
+            return False
+        for attempt in range(MAX_RETRIES):
+            wait = self._next_allowed - self.clock()
+            if wait > 0:
+                with METRICS.span("sleep.discord_ratelimit"):
+                    self.sleep(wait)
+            QUOTAS.acquire(self.quota_name)
+            try:
+                with METRICS.span("discord.post") as span:
+                    span.bytes = len(message.encode("utf-8"))
+                    resp = self.session.post(self.webhook_url, json={"content": message}, timeout=10)
+                    span.error = resp.status_code not in (200, 204)
+            except Exception as e:
+                self.log(f"Discord 推播失敗：{e}")
+                return False
+            self.post_count += 1
+            self._update_bucket(resp)
+
+            if resp.status_code == 429:
+                self.rate_limited_count += 1
+                METRICS.add_retry("discord.post")
+                retry_after = self._retry_after(resp)
+                self.log(f"Discord 限流，{retry_after:.2f} 秒後重試（第 {attempt + 1} 次）")
+                self._next_allowed = max(self._next_allowed, self.clock() + retry_after)
+                QUOTAS.penalize(self.quota_name, retry_after=0)
+                continue
+            if resp.status_code not in (200, 204):
+                self.log(f"Discord 推播失敗，狀態碼：{resp.status_code}，回應：{resp.text}")
+                return False
+            QUOTAS.success(self.quota_name)
+            self.log("Discord 推播成功")
+            return True
+        self.log(f"Discord 推播失敗：重試 {MAX_RETRIES} 次仍被限流")
+        return False
+
+    def _update_bucket(self, resp):
+        """Remaining 為 0 時，等到 Reset-After 之後才送下一則。"""
+        remaining = resp.headers.get("X-RateLimit-Remaining")
+        reset_after = resp.headers.get("X-RateLimit-Reset-After")
+        try:
+            if remaining is not None and int(remaining) <= 0 and reset_after is not None:
+                self._next_allowed = max(self._next_allowed, self.clock() + float(reset_after))
+        except ValueError:
+            pass
+
+    @staticmethod
+    def _retry_after(resp) -> float:
+        try:
+            return float(resp.json().get("retry_after", 1.0))
+        except Exception:
+            try:
+                return float(resp.headers.get("Retry-After", 1.0))
+            except ValueError:
+                return 1.0
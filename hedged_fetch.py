@@ -0,0 +1,130 @@
+"""
+最新價避險抓取（hedged request）：主要來源逾時未回應時，提前啟動備援來源，採用先到的有效結果。
+
+- 主要來源（FinMind）每檔一個 future；備援來源（yfinance）對未解決的股票批次查詢
+- 逾時以每檔請求實際送出的時間起算（starts，由主要來源在取得配額與連線名額後記錄），
+  還排在執行緒池或連線名額後面的股票不算逾時
+- 有股票超過 hedge_delay 秒仍未回應，或主要來源全部結束，才對當時未解決的股票啟動一批備援
+  （之後再逾時的股票另起一批；hedge_delay=None 即原本的依序模式）
+- 同時有多個來源可用時依優先順序取主要來源；每檔記錄勝出來源與各來源耗時（主要來源自送出起算）
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+_POLL_SECONDS = 0.1  # 有股票尚未送出時，定期檢查是否有新送出的請求逾時
+
+
+def hedged_race(primary: Dict[str, Future], fallback: Callable[[List[str]], Dict[str, Dict]],
+                hedge_delay: Optional[float], names: Tuple[str, str] = ("finmind", "yfinance"),
+                clock: Callable[[], float] = time.monotonic, starts: Optional[Dict[str, float]] = None
+                ) -> Tuple[Dict[str, Optional[Dict]], Dict[str, Dict]]:
+    """
+    primary：stock_id → 主要來源 future（結果為價格 dict 或 None）
+    fallback：以 stock_id 清單批次查詢備援來源，回傳 stock_id → 價格 dict；
+              在獨立執行緒執行，不會排在主要來源的執行緒池後面
+    starts：stock_id → 主要來源請求實際送出的時間（同一個 clock），由主要來源執行時填入；
+            None 時全部以呼叫當下起算
+    回傳 (stock_id → 價格 dict 或 None, stock_id → {"winner", "<來源>_s", "hedged"})
+    """
+    primary_name, fallback_name = names
+    race_started = clock()
+    if starts is None:
+        starts = dict.fromkeys(primary, race_started)
+    results: Dict[str, Optional[Dict]] = {}
+    stats: Dict[str, Dict] = {sid: {"winner": None, "hedged": False} for sid in primary}
+    waiting = {future: sid for sid, future in primary.items()}
+    hedged: set = set()                       # 已交給備援的股票（每檔最多一次）
+    batches: Dict[Future, Tuple[List[str], float]] = {}
+    fallback_pool: Optional[ThreadPoolExecutor] = None
+
+    def harvest(done: Iterable[Future]):
+        for future in done:
+            sid = waiting.pop(future, None)
+            if sid is None:
+                continue
+            stats[sid][f"{primary_name}_s"] = round(clock() - starts.get(sid, race_started), 3)
+            try:
+                value = future.result()
+            except Exception:
+                value = None
+            if value and sid not in results:
+                results[sid] = value
+                stats[sid]["winner"] = primary_name
+
+    def collect(done: Iterable[Future]):
+        for future in done:
+            fallback_ids, launched = batches.pop(future)
+            try:
+                fallback_values = future.result() or {}
+            except Exception:
+                fallback_values = {}
+            elapsed = round(clock() - launched, 3)
+            for sid in fallback_ids:
+                stats[sid][f"{fallback_name}_s"] = elapsed
+                if sid not in results and fallback_values.get(sid):
+                    results[sid] = fallback_values[sid]
+                    stats[sid]["winner"] = fallback_name
+
+    try:
+        while True:
+            running = {sid for sid in waiting.values() if sid not in results}  # 已有價格的不必再等
+            now = clock()
+            overdue = {
+                sid for sid in running
+                if hedge_delay is not None and sid not in hedged and sid in starts and now - starts[sid] >= hedge_delay
+            }
+            unresolved = [sid for sid in primary if sid not in results and sid not in hedged]
+            failed = [sid for sid in unresolved if sid not in running]
+            # 1. 有股票逾時，或主要來源全部結束：當時未解決（逾時或主要來源沒給價格）的股票一次交給備援
+            if overdue or (failed and not running):
+                fallback_ids = [sid for sid in unresolved if sid in overdue or sid not in running]
+                for sid in fallback_ids:
+                    stats[sid]["hedged"] = sid in running
+                hedged.update(fallback_ids)
+                if fallback_pool is None:
+                    fallback_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hedge")
+                batches[fallback_pool.submit(fallback, fallback_ids)] = (fallback_ids, clock())
+                continue
+
+            # 2. 每檔都有結果，或兩個來源都查過：結束（各來源只查一次，與依序模式相同）
+            racing = [f for f, sid in waiting.items() if sid not in results]
+            pending = [f for f, (ids, _) in batches.items() if any(sid not in results for sid in ids)]
+            if not racing and not pending:
+                break
+
+            # 3. 等到下一個結果或下一檔逾時；尚未送出的股票定期檢查
+            timeout = None
+            if hedge_delay is not None:
+                watch = [sid for sid in running if sid not in hedged]
+                deadlines = [starts[sid] + hedge_delay - now for sid in watch if sid in starts]
+                if len(deadlines) < len(watch):
+                    deadlines.append(_POLL_SECONDS)
+                timeout = max(0.0, min(deadlines)) if deadlines else None
+            done, _ = wait(racing + pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            # 同時完成時先收主要來源，維持優先順序
+            harvest([f for f in done if f not in batches])
+            collect([f for f in done if f in batches])
+    finally:
+        if fallback_pool is not None:
+            fallback_pool.shutdown(wait=False)
+
+    for sid in primary:
+        results.setdefault(sid, None)
+    return results, stats
+
+
+def summarize(stats: Dict[str, Dict], names: Tuple[str, str] = ("finmind", "yfinance")) -> str:
+    """一行摘要：各來源勝出次數、避險啟動檔數、各來源最長耗時。"""
+    wins = {name: sum(1 for s in stats.values() if s["winner"] == name) for name in names}
+    missing = sum(1 for s in stats.values() if s["winner"] is None)
+    hedged = sum(1 for s in stats.values() if s["hedged"])
+    parts = [f"{name} 勝 {count}" for name, count in wins.items()]
+    if missing:
+        parts.append(f"無價格 {missing}")
+    timing = []
+    for name in names:
+        values = [s[f"{name}_s"] for s in stats.values() if f"{name}_s" in s]
+        if values:
+            timing.append(f"{name} 最長 {max(values):.2f} 秒")
+    return f"最新價來源：{'、'.join(parts)}（提前啟動備援 {hedged} 支）；{'、'.join(timing) or '無耗時紀錄'}"
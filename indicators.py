@@ -0,0 +1,124 @@
+"""
+向量化技術指標，推播與補齊歷史兩支程式共用，確保同一天算出的數字完全一致。
+
+均線以 sliding_window_view 對每個視窗直接加總：每一天的值只取決於該視窗內的收盤價，
+不受序列起點或長度影響（累積和相減會因起點不同產生浮點誤差）。
+EMA 與 RSI 的 Wilder 平滑是遞迴式，改用 pandas ewm(adjust=False) 整段計算，不在 Python 逐筆迴圈。
+
+新增指標：寫一個 fn(values, *params) -> np.ndarray 並以 register_indicator() 註冊，
+再在 spec 中以 (指標名, 欄位, 參數...) 使用。
+"""
+from typing import Callable, Dict, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# 輸出名稱 → (指標, 輸入欄位, 參數...)
+MA_SPECS: Dict[str, Tuple] = {
+    "ma5": ("sma", "close", 5),
+    "ma20": ("sma", "close", 20),
+    "ma60": ("sma", "close", 60),
+}
+
+
+def _as_array(values) -> np.ndarray:
+    return np.asarray(values, dtype=float)
+
+
+def sma(values, window: int) -> np.ndarray:
+    """簡單移動平均；資料不足 window 筆的位置為 NaN。"""
+    arr = _as_array(values)
+    out = np.full(arr.shape, np.nan)
+    if window <= 0 or len(arr) < window:
+        return out
+    out[window - 1:] = sliding_window_view(arr, window).mean(axis=1)
+    return out
+
+
+def _recursive_mean(arr: np.ndarray, alpha: float) -> np.ndarray:
+    """y[0] = x[0]，y[i] = alpha * x[i] + (1 - alpha) * y[i-1]。"""
+    import pandas as pd
+
+    return pd.Series(arr).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+
+
+def ema(values, span: int) -> np.ndarray:
+    """指數移動平均（alpha = 2 / (span + 1)，以第一筆為起點）。"""
+    arr = _as_array(values)
+    if len(arr) == 0:
+        return np.full(arr.shape, np.nan)
+    return _recursive_mean(arr, 2.0 / (span + 1))
+
+
+def rsi(values, period: int = 14) -> np.ndarray:
+    """Wilder RSI；前 period 筆為 NaN。起點為前 period 筆漲跌的平均，之後以 alpha = 1 / period 平滑。"""
+    arr = _as_array(values)
+    out = np.full(arr.shape, np.nan)
+    if len(arr) <= period:
+        return out
+    diff = np.diff(arr)
+    gain = np.clip(diff, 0, None)[period - 1:]
+    loss = np.clip(-diff, 0, None)[period - 1:]
+    gain[0] = np.clip(diff[:period], 0, None).mean()
+    loss[0] = np.clip(-diff[:period], 0, None).mean()
+    avg_gain = _recursive_mean(gain, 1.0 / period)
+    avg_loss = _recursive_mean(loss, 1.0 / period)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out[period:] = np.where(avg_loss == 0, 100.0, 100 - 100 / (1 + avg_gain / avg_loss))
+    return out
+
+
+def bollinger_upper(values, window: int = 20, k: float = 2.0) -> np.ndarray:
+    return _bollinger(values, window, k)
+
+
+def bollinger_lower(values, window: int = 20, k: float = 2.0) -> np.ndarray:
+    return _bollinger(values, window, -k)
+
+
+def _bollinger(values, window: int, k: float) -> np.ndarray:
+    arr = _as_array(values)
+    out = np.full(arr.shape, np.nan)
+    if len(arr) < window:
+        return out
+    windows = sliding_window_view(arr, window)
+    out[window - 1:] = windows.mean(axis=1) + k * windows.std(axis=1)
+    return out
+
+
+_REGISTRY: Dict[str, Callable[..., np.ndarray]] = {
+    "sma": sma,
+    "ema": ema,
+    "rsi": rsi,
+    "bb_upper": bollinger_upper,
+    "bb_lower": bollinger_lower,
+}
+
+
+def register_indicator(name: str, fn: Callable[..., np.ndarray]):
+    _REGISTRY[name] = fn
+
+
+def compute_indicators(columns: Mapping[str, Sequence[float]],
+                       specs: Mapping[str, Tuple] = MA_SPECS) -> Dict[str, np.ndarray]:
+    """
+    一次算出整段序列所有日期的指標。
+    columns 例：{"close": [...], "volume": [...]}；specs 例：{"vol_ma5": ("sma", "volume", 5)}
+    """
+    result = {}
+    for out_name, (indicator, field, *params) in specs.items():
+        result[out_name] = _REGISTRY[indicator](columns[field], *params)
+    return result
+
+
+def value_at(series: np.ndarray, i: int) -> Optional[float]:
+    """取出第 i 筆指標值，NaN 轉成 None（與原本「資料不足回傳 None」一致）。"""
+    v = series[i]
+    return None if np.isnan(v) else float(v)
+
+
+def calculate_ma(prices, window):
+    """最後一天的 window 日均線；資料不足時回傳 None。"""
+    if len(prices) < window:
+        return None
+    return value_at(sma(prices, window), -1)
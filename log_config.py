@@ -0,0 +1,149 @@
+"""
+兩支程式共用的 log 設定（標準 logging）。
+
+- 呼叫端只把紀錄放進佇列，由背景執行緒（QueueListener）寫檔與輸出，不再每行開關檔案
+- 檔案為 JSON Lines（LOG_FORMAT=text 可改回純文字），依大小輪替；
+  每支程式各寫自己的檔案（error-notify.log、error-history_fill.log），輪替不會被另一支程式的寫入打斷
+- 可帶結構化欄位：write_log("...", stock_id="2330", stage="fetch", duration=0.12)
+- LOG_LEVEL 控制等級；DEBUG 關閉時，debug 訊息不會被格式化
+- 子程序（推播分片 worker）以 forward_logging() 把紀錄送回主程序，由主程序唯一的檔案 handler 寫入與輪替
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+LOG_FILE = os.getenv("LOG_FILE", "error.log")                    # 實際檔名會加上程式名稱，見 log_file_for()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()          # 檔案格式：json 或 text
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_CONSOLE = os.getenv("LOG_CONSOLE", "1") == "1"                # 0：只寫檔，不輸出到主控台
+
+TW_TZ = timezone(timedelta(hours=8))
+ROOT_LOGGER = "stock"
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class TextFormatter(logging.Formatter):
+    """原本 write_log 的格式：「時間 訊息」，WARNING 以上加上等級。"""
+
+    def __init__(self, time_format: Optional[str] = "%Y年%m月%d日 %H時%M分%S秒"):
+        super().__init__()
+        self.time_format = time_format
+
+    def format(self, record: logging.LogRecord) -> str:
+        msg = record.getMessage()
+        if record.levelno >= logging.WARNING:
+            msg = f"[{record.levelname}] {msg}"
+        if self.time_format:
+            msg = f"{datetime.fromtimestamp(record.created, TW_TZ).strftime(self.time_format)} {msg}"
+        if record.exc_text:
+            msg = f"{msg}\n{record.exc_text}"
+        return msg
+
+
+class JsonFormatter(logging.Formatter):
+    """一行一筆 JSON：ts、level、logger、msg，加上呼叫端帶入的結構化欄位。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, TW_TZ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 只在呼叫端先把例外轉成文字，其餘格式化交給背景執行緒
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def log_file_for(name: str) -> str:
+    """
+    LOG_FILE 加上程式名稱：error.log → error-notify.log。
+    RotatingFileHandler 的輪替不是多程序安全的，兩支程式不可共用同一個檔案。
+    """
+    root, ext = os.path.splitext(LOG_FILE)
+    return f"{root}-{name}{ext}"
+
+
+def setup_logging(name: str, console_time_format: Optional[str] = "%Y年%m月%d日 %H時%M分%S秒") -> logging.Logger:
+    """第一次呼叫時建立佇列與背景寫入執行緒；回傳 stock.<name> logger。"""
+    global _listener
+    root = logging.getLogger(ROOT_LOGGER)
+    if _listener is None:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file_for(name), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8", delay=True,
+        )
+        file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+        handlers = [file_handler]
+        if LOG_CONSOLE:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(TextFormatter(console_time_format))
+            handlers.append(console_handler)
+
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(log_queue, *handlers)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+        root.addHandler(_QueueHandler(log_queue))
+        root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+        root.propagate = False
+    return root.getChild(name)
+
+
+def process_log_queue(mp_context) -> Tuple[object, logging.handlers.QueueListener]:
+    """
+    主程序：建立給子程序用的跨程序佇列（傳給 worker 的 initializer），收到的紀錄交給本程序同一組 handler。
+    回傳 (佇列, listener)；子程序都結束後呼叫 listener.stop()。
+    """
+    if _listener is None:
+        raise RuntimeError("尚未呼叫 setup_logging")
+    log_queue = mp_context.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *_listener.handlers)
+    listener.start()
+    return log_queue, listener
+
+
+def forward_logging(log_queue):
+    """子程序：改把紀錄送到主程序的佇列，不自己開檔（多個程序各自輪替同一個檔案會互相覆蓋）。"""
+    global _listener
+    root = logging.getLogger(ROOT_LOGGER)
+    if _listener is not None:  # 匯入主程式時建立的背景執行緒；檔案 delay=True，尚未開啟
+        _listener.stop()
+        _listener = None
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    root.propagate = False
+
+
+def shutdown_logging():
+    """送出佇列中剩下的紀錄並關閉檔案（程式結束時自動呼叫）。"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,206 @@
+"""
+逐檔均線狀態（本地 SQLite，與日 K 快取共用同一個檔案）。
+
+- 每支股票保存最近 60 筆收盤價（環狀緩衝，緊湊的 float64 BLOB）
+- 新的一天收盤只需 push 一次，不必重新取出整段歷史
+- 均線以 indicators.sma 對緩衝內的視窗計算，與補齊歷史程式寫入 Sheet1 的數字完全一致
+- 盤中「假設最新價為今日收盤」的試算均線（what_if）也由同一份狀態算出：
+
+    python ma_state.py check          # 以快取日 K 整段重算，檢查所有股票的狀態
+"""
+import argparse
+import sqlite3
+import threading
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from bar_store import BAR_STORE_PATH, TW_TZ, BarStore
+
+MA_WINDOWS: Tuple[int, ...] = (5, 20, 60)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ma_state (
+    stock_id   TEXT PRIMARY KEY,
+    windows    TEXT NOT NULL,
+    last_date  TEXT NOT NULL,
+    closes     BLOB NOT NULL,
+    updated_on TEXT NOT NULL
+);
+"""
+
+
+class RollingMA:
+    """最近 max(windows) 筆收盤價的環狀緩衝。"""
+
+    def __init__(self, windows: Sequence[int] = MA_WINDOWS):
+        self.windows = tuple(windows)
+        self.size = max(self.windows)
+        self._buf = array("d", [0.0] * self.size)
+        self._head = 0   # 下一筆寫入的位置
+        self.count = 0   # 已寫入筆數（上限為 size）
+        self.last_date: Optional[str] = None
+
+    @classmethod
+    def from_bars(cls, bars: Sequence[Dict], windows: Sequence[int] = MA_WINDOWS) -> "RollingMA":
+        state = cls(windows)
+        for bar in bars[-state.size:]:
+            state.push(bar["close"], bar["date"])
+        return state
+
+    @classmethod
+    def restore(cls, windows: Sequence[int], closes: Sequence[float], last_date: str) -> "RollingMA":
+        """由儲存的收盤價（由舊到新）還原。"""
+        state = cls(windows)
+        closes = list(closes)[-state.size:]
+        state._buf[:len(closes)] = array("d", closes)
+        state._head = len(closes) % state.size
+        state.count = len(closes)
+        state.last_date = last_date
+        return state
+
+    def _back(self, k: int) -> float:
+        """倒數第 k 筆收盤價（k=1 為最新一筆）。"""
+        return self._buf[(self._head - k) % self.size]
+
+    def closes(self) -> List[float]:
+        """由舊到新的收盤價。"""
+        return [self._back(k) for k in range(self.count, 0, -1)]
+
+    def push(self, close: float, date: str):
+        """加入新的一天收盤（O(1)，最舊的一筆被覆蓋）。"""
+        self._buf[self._head] = float(close)
+        self._head = (self._head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.last_date = date
+
+    def values(self) -> Dict[int, Optional[float]]:
+        """各視窗目前的均線；資料不足時為 None（與 calculate_ma 相同）。"""
+        from indicators import calculate_ma
+
+        closes = self.closes()
+        return {w: calculate_ma(closes[-w:], w) for w in self.windows}
+
+    def what_if(self, price: float) -> Dict[int, Optional[float]]:
+        """假設 price 為今日收盤時的均線，不改變狀態。"""
+        from indicators import calculate_ma
+
+        closes = self.closes() + [float(price)]
+        return {w: calculate_ma(closes[-w:], w) for w in self.windows}
+
+    def advance(self, bars: Sequence[Dict]) -> bool:
+        """
+        以日 K（由舊到新）推進狀態：只 push last_date 之後的收盤；
+        last_date 不在 bars 中（快取被清除或改寫）時回傳 False，由呼叫端整段重建。
+        """
+        if self.last_date is None:
+            return False
+        dates = [b["date"] for b in bars]
+        if self.last_date not in dates:
+            return False
+        for bar in bars[dates.index(self.last_date) + 1:]:
+            self.push(bar["close"], bar["date"])
+        return True
+
+    def check(self, bars: Sequence[Dict]) -> List[str]:
+        """與整段重算比對，回傳不一致的說明（空清單表示一致）。"""
+        from indicators import calculate_ma
+
+        closes = [b["close"] for b in bars if b["date"] <= (self.last_date or "")]
+        problems = []
+        for w, value in self.values().items():
+            expected = calculate_ma(closes, w)
+            if value != expected:
+                problems.append(f"MA{w} 狀態 {value} ≠ 重算 {expected}")
+        return problems
+
+
+class MAStateStore:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or BAR_STORE_PATH
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def load(self, stock_id: str) -> Optional[RollingMA]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT windows, last_date, closes FROM ma_state WHERE stock_id = ?", (stock_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        windows = tuple(int(w) for w in row[0].split(","))
+        if windows != MA_WINDOWS:
+            return None  # 視窗設定改過，整段重建
+        return RollingMA.restore(windows, array("d", row[2]), row[1])
+
+    def save_many(self, states: Dict[str, RollingMA]):
+        today = datetime.now(TW_TZ).strftime("%Y-%m-%d")
+        rows = [
+            (sid, ",".join(map(str, s.windows)), s.last_date, array("d", s.closes()).tobytes(), today)
+            for sid, s in states.items() if s.last_date
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ma_state (stock_id, windows, last_date, closes, updated_on) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def stock_ids(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT stock_id FROM ma_state ORDER BY stock_id")]
+
+
+def update_state(states: MAStateStore, stock_id: str, bars: Sequence[Dict]) -> Tuple[Optional[RollingMA], bool]:
+    """
+    取得推進到 bars 最後一天的狀態，回傳 (狀態, 是否有變更需要儲存)。
+    沒有狀態、或狀態與快取日 K 對不上時，以 bars 整段重建。
+    """
+    if not bars:
+        return None, False
+    state = states.load(stock_id)
+    if state is not None and state.last_date == bars[-1]["date"]:
+        return state, False
+    if state is None or not state.advance(bars):
+        state = RollingMA.from_bars(bars)
+    return state, True
+
+
+# ======================== 指令列 ========================
+def main():
+    parser = argparse.ArgumentParser(description="均線狀態管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("check", help="以快取日 K 整段重算，檢查所有股票的均線狀態")
+    args = parser.parse_args()
+
+    states = MAStateStore()
+    store = BarStore(states.path)
+    try:
+        if args.command == "check":
+            bad = 0
+            for stock_id in states.stock_ids():
+                state = states.load(stock_id)
+                if state is None:
+                    continue
+                start = (datetime.strptime(state.last_date, "%Y-%m-%d") - timedelta(days=120)).strftime("%Y-%m-%d")
+                problems = state.check(store.get_bars(stock_id, start, state.last_date))
+                if problems:
+                    bad += 1
+                    print(f"{stock_id}\t{state.last_date}\t{'；'.join(problems)}")
+            print(f"檢查完成：{len(states.stock_ids())} 支，不一致 {bad} 支")
+    finally:
+        store.close()
+        states.close()
+
+
+if __name__ == "__main__":
+    main()
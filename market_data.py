@@ -0,0 +1,323 @@
+"""
+單次執行用的行情資料存取層。
+
+- FinMind 日 K：同一個 (股票, 日期區間) 一次執行內只會請求一次
+- 多支股票缺同樣的近幾天時，可改用 FinMind「指定日期、全市場」查詢，一天一次請求涵蓋整份清單
+  （此查詢需 FinMind 贊助方案，以 FINMIND_DATE_WIDE=1 開啟；失敗後本次執行自動改回逐檔查詢）
+- yfinance 備援以 yf.download 一次抓整份清單，先 .TW 再 .TWO
+- 有分鐘價儲存（MinuteStore）時，yfinance 1m 只下載最後儲存時間之後的資料，並把新的分鐘價附加進去；
+  這次下載有該代號的資料才算查到（否則照常改試另一個後綴），本地有更新的分鐘價時改用並依來源標記（見 stored_source）
+"""
+from __future__ import annotations
+
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional
+
+from bar_store import TW_TZ, BarStore, missing_segments
+from market_map import MarketMap
+from metrics import METRICS
+from minute_store import MinuteStore, yfinance_rows
+from quota import QUOTAS, is_rate_limited
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+DATE_WIDE_MAX_DAYS = 5  # 缺漏區段不超過幾個日曆天時改用全市場單日查詢
+FINMIND_DATE_WIDE = os.getenv("FINMIND_DATE_WIDE", "0") == "1"  # 贊助方案才可用；預設關閉，免費方案不必每次白送一次請求
+
+
+def _timed(stage: str, fn: Callable):
+    """以 METRICS 計時一次資料來源呼叫，並記錄回傳筆數。"""
+    with METRICS.span(stage) as span:
+        result = fn()
+        if result is not None and hasattr(result, "__len__"):
+            span.items = len(result)
+        return result
+
+
+def _date_range(start_date: str, end_date: str) -> List[str]:
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    return [(start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end - start).days + 1)]
+
+
+class MarketDataLoader:
+    """
+    包裝 FinMind DataLoader，提供去重複、可批次的日 K 查詢；可在執行緒池中共用。
+    finmind_slot／yfinance_slot 未指定時使用 QUOTAS 的配額節流。
+    """
+
+    def __init__(self, dl, log: Callable[[str], None] = print, finmind_slot=None, yfinance_slot=None,
+                 markets: Optional[MarketMap] = None, minutes: Optional[MinuteStore] = None,
+                 today: Optional[str] = None):
+        self.dl = dl
+        self.log = log
+        self.markets = markets
+        self.minutes = minutes
+        self.today = today or datetime.now(TW_TZ).strftime("%Y-%m-%d")
+        self._finmind_slot = finmind_slot or (lambda: QUOTAS.slot("finmind"))
+        self._yfinance_slot = yfinance_slot or (lambda: QUOTAS.slot("yfinance"))
+        self._lock = threading.Lock()
+        self._key_locks: Dict[tuple, threading.Lock] = {}
+        self._memo: Dict[tuple, object] = {}
+        self._by_date: Dict[str, pd.DataFrame] = {}  # 全市場單日查詢結果
+        self.date_wide_supported = FINMIND_DATE_WIDE
+        self.request_count = 0
+
+    # ---------- 內部工具 ----------
+    def _once(self, key: tuple, fn: Callable):
+        """同一 key 只執行一次；並行呼叫者等待第一個完成後共用結果（例外不快取）。"""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key in self._memo:
+                return self._memo[key]
+            value = fn()
+            self._memo[key] = value
+            return value
+
+    def _finmind(self, fn: Callable, stage: str = "finmind"):
+        with self._lock:
+            self.request_count += 1
+        with self._finmind_slot():
+            return _timed(stage, fn)
+
+    def release(self, stock_ids: Iterable[str]):
+        """丟掉這些股票的逐檔日 K 查詢結果（分批處理時，處理完的一批不再佔用記憶體）。"""
+        stock_ids = set(stock_ids)
+        with self._lock:
+            for key in [k for k in self._memo if k[0] == "daily" and k[1] in stock_ids]:
+                del self._memo[key]
+                self._key_locks.pop(key, None)
+
+    # ---------- FinMind 日 K ----------
+    def prefetch(self, stock_ids: Iterable[str], store: BarStore, start_date: str, end_date: str,
+                 now: Optional[datetime] = None, extra_dates: Iterable[str] = (),
+                 is_trading_day: Optional[Callable[[str], Optional[bool]]] = None):
+        """
+        找出整份清單在快取中缺的短區段，合併成日期集合後以全市場單日查詢一次抓齊。
+        長區段（例如第一次執行的 90 天）仍由 daily() 逐檔查詢。
+        交易日曆確定休市的日子直接記為空資料，不發出請求。
+        """
+        stock_ids = list(stock_ids)
+        dates = set(extra_dates)
+        for stock_id in stock_ids:
+            for seg_start, seg_end in missing_segments(store, stock_id, start_date, end_date, now):
+                seg = _date_range(seg_start, seg_end)
+                if len(seg) <= DATE_WIDE_MAX_DAYS:
+                    dates.update(seg)
+        if is_trading_day:
+            closed = {d for d in dates if is_trading_day(d) is False}
+            if closed:
+                import pandas as pd
+                with self._lock:
+                    for date in closed:
+                        self._by_date[date] = pd.DataFrame()
+                dates -= closed
+        if not dates:
+            return
+        for date in sorted(dates):
+            self.market_day(date)
+        if self.date_wide_supported:
+            self.log(f"日 K 預先批次抓取：全市場單日查詢 {len(dates)} 天")
+
+    def market_day(self, date: str) -> Optional[pd.DataFrame]:
+        """全市場單日日 K；方案不支援時回傳 None。"""
+        if not self.date_wide_supported:
+            return None
+
+        def fetch():
+            import pandas as pd
+            df = self._finmind(lambda: self.dl.taiwan_stock_daily("", start_date=date, end_date=date),
+                               "finmind.market_day")
+            return df if df is not None else pd.DataFrame()
+
+        try:
+            df = self._once(("market_day", date), fetch)
+        except Exception as e:
+            self.date_wide_supported = False
+            self.log(f"FinMind 全市場單日查詢失敗：{e}，本次改為逐檔查詢")
+            return None
+        with self._lock:
+            self._by_date[date] = df
+        return df
+
+    def trading_dates(self, start_date: str, end_date: str) -> List[str]:
+        """FinMind TaiwanStockTradingDate：區間內的交易日清單（供交易日曆每年載入一次）。"""
+        df = self._once(
+            ("trading_dates", start_date, end_date),
+            lambda: self._finmind(
+                lambda: self.dl.get_data(dataset="TaiwanStockTradingDate", start_date=start_date, end_date=end_date),
+                "finmind.trading_dates",
+            ),
+        )
+        if df is None or df.empty or "date" not in df.columns:
+            return []
+        return [str(d)[:10] for d in df["date"]]
+
+    def stock_info(self) -> pd.DataFrame:
+        """FinMind TaiwanStockInfo：全部代號與所屬市場（供上市／上櫃對照表定期更新）。"""
+        return self._once(("stock_info",), lambda: self._finmind(lambda: self.dl.taiwan_stock_info(), "finmind.stock_info"))
+
+    def tick(self, stock_id: str, date: str, on_start: Optional[Callable[[], None]] = None) -> pd.DataFrame:
+        """
+        FinMind TaiwanStockPrice：單檔當天分鐘價（盤中最新價，不快取）。
+        on_start 在取得配額與連線名額、請求即將送出時呼叫（避險抓取以此起算逾時）。
+        """
+        def request():
+            if on_start is not None:
+                on_start()
+            return self.dl.get_data(dataset="TaiwanStockPrice", data_id=stock_id, start_date=date)
+
+        return self._finmind(request, "finmind.tick")
+
+    def prefetched(self, stock_id: str, start_date: str, end_date: str) -> Optional[pd.DataFrame]:
+        """區間內每一天都已有全市場查詢結果時，從中取出單檔日 K；否則回傳 None（不發出請求）。"""
+        import pandas as pd
+
+        dates = _date_range(start_date, end_date)
+        with self._lock:
+            frames = [self._by_date.get(d) for d in dates]
+        if not frames or any(f is None for f in frames):
+            return None
+        parts = [f[f["stock_id"] == stock_id] for f in frames if not f.empty]
+        if not parts:
+            return pd.DataFrame()
+        return pd.concat(parts, ignore_index=True)
+
+    def daily(self, stock_id: str, start_date: str, end_date: str) -> pd.DataFrame:
+        """單檔日 K；若區間內每一天都已有全市場查詢結果，直接從中取出不再請求。"""
+        df = self.prefetched(stock_id, start_date, end_date)
+        if df is not None:
+            return df
+
+        return self._once(
+            ("daily", stock_id, start_date, end_date),
+            lambda: self._finmind(
+                lambda: self.dl.taiwan_stock_daily(stock_id, start_date=start_date, end_date=end_date),
+                "finmind.daily",
+            ),
+        )
+
+    # ---------- yfinance 批次備援 ----------
+    def _yf_download(self, tickers: List[str], period: str, interval: str,
+                     start: Optional[datetime] = None) -> pd.DataFrame:
+        """yf.download 含 rate limit retry（最多 3 次，依配額退避）；有 start 時只下載該時間之後。"""
+        import pandas as pd
+        import yfinance as yf  # 只有 FinMind 失敗時才需要
+
+        def download():
+            span = {"start": start} if start is not None else {"period": period}
+            return yf.download(tickers, interval=interval, group_by="ticker", progress=False, threads=False, **span)
+
+        for attempt in range(3):
+            try:
+                with self._yfinance_slot():
+                    return _timed("yfinance.download", download)
+            except Exception as e:
+                # 配額桶已依限流退避，下一次取得額度時才會送出
+                if is_rate_limited(e) and attempt < 2:
+                    self.log(f"yfinance rate limit，依配額退避後重試（第 {attempt + 1} 次）")
+                    METRICS.add_retry("yfinance.download")
+                    continue
+                raise
+        return pd.DataFrame()
+
+    def yf_latest(self, stock_ids: Iterable[str]) -> Dict[str, Dict]:
+        """
+        以 yf.download 一次抓整份清單的最新價，回傳 stock_id → 價格 dict。
+        對照表已知市場的代號只查對應後綴；未知的先 .TW，查無再用 .TWO，查到後記入對照表。
+        """
+        results: Dict[str, Dict] = {}
+        pending = list(dict.fromkeys(stock_ids))
+        for suffix in ["TW", "TWO"]:
+            for period, interval, source, is_latest in [
+                ("1d", "1m", "today_yfinance", True),
+                ("5d", "1d", "previous_yfinance", False),
+            ]:
+                candidates = [sid for sid in pending if self._suffix_for(sid) in (None, suffix)]
+                if not candidates:
+                    continue
+                tickers = [f"{sid}.{suffix}" for sid in candidates]
+                start = self._minute_start(candidates) if interval == "1m" else None
+                key = ("yf", tuple(tickers), period, interval, start)
+                try:
+                    data = self._once(key, lambda: self._yf_download(tickers, period, interval, start))
+                except Exception as e:
+                    self.log(f"yfinance 批次下載失敗（.{suffix} {period}）：{e}")
+                    continue
+                for sid, ticker in zip(candidates, tickers):
+                    hist = _ticker_frame(data, ticker)
+                    if hist is None or hist.empty:
+                        continue  # 這個後綴查無資料：改試下一個後綴／日 K
+                    latest = hist.iloc[-1]
+                    fmt = "%Y-%m-%d %H:%M:%S" if is_latest else "%Y-%m-%d"
+                    result = {
+                        "price": float(latest["Close"]),
+                        "time": latest.name.strftime(fmt),
+                        "source": source,
+                        "is_latest": is_latest,
+                        "finmind_success": False,
+                    }
+                    if interval == "1m" and self.minutes is not None:
+                        self.minutes.append(sid, yfinance_rows(hist), "yfinance")
+                        # 增量下載從最後儲存時間開始，本地可能已有比這次下載更新的分鐘價（例如 FinMind 稍後到達的）
+                        stored = self.minutes.latest(sid, self.today)
+                        if stored and stored[0] > result["time"]:
+                            ts, price, origin = stored
+                            result.update(price=price, time=ts, source=stored_source(origin, fresh=False))
+                            self.log(f"{sid} 本地分鐘價（{origin}）比 yfinance 新，改用：{price:.2f} @ {ts}，"
+                                     f"{_age_minutes(ts):.0f} 分鐘前")
+                    results[sid] = result
+                    pending.remove(sid)
+                    if self.markets is not None:
+                        self.markets.record(sid, suffix, "probe", datetime.now(TW_TZ).strftime("%Y-%m-%d"))
+                    self.log(f"{sid} yfinance 批次取得價格（.{suffix}）：{result['price']:.2f} @ {result['time']}")
+        return results
+
+    def _minute_start(self, stock_ids: List[str]) -> Optional[datetime]:
+        """整批股票今天都已有分鐘價時，回傳其中最早的最後時間點（之後的才需要下載）；否則 None。"""
+        if self.minutes is None:
+            return None
+        lasts = [self.minutes.last_ts(sid, self.today) for sid in stock_ids]
+        if not lasts or any(last is None for last in lasts):
+            return None
+        return datetime.strptime(min(lasts), "%Y-%m-%d %H:%M:%S").replace(tzinfo=TW_TZ)
+
+    def _suffix_for(self, stock_id: str) -> Optional[str]:
+        return self.markets.suffix(stock_id) if self.markets is not None else None
+
+
+def stored_source(origin: str, fresh: bool) -> str:
+    """
+    本地分鐘價最後一筆的來源標記：本次 yfinance 下載新增的為 today_yfinance；
+    其餘為 stored_<來源>（之前執行存下的 yfinance 分鐘價，或 FinMind 分鐘價）。
+    """
+    if fresh and origin == "yfinance":
+        return "today_yfinance"
+    return f"stored_{origin}"
+
+
+def _age_minutes(ts: str) -> float:
+    """台灣時間 YYYY-MM-DD HH:MM:SS 距今幾分鐘。"""
+    stamp = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(tzinfo=TW_TZ)
+    return max(0.0, (datetime.now(TW_TZ) - stamp).total_seconds() / 60)
+
+
+def _ticker_frame(data: Optional[pd.DataFrame], ticker: str) -> Optional[pd.DataFrame]:
+    """從 yf.download 結果取出單一 ticker 的資料（去掉無成交的列）。"""
+    import pandas as pd
+
+    if data is None or data.empty:
+        return None
+    if isinstance(data.columns, pd.MultiIndex):
+        if ticker not in data.columns.get_level_values(0):
+            return None
+        hist = data[ticker]
+    else:
+        hist = data
+    if "Close" not in hist.columns:
+        return None
+    return hist.dropna(subset=["Close"])
@@ -0,0 +1,109 @@
+"""
+股票代號 → 市場（上市 .TW / 上櫃 .TWO）對照表，存在日 K 快取同一個 SQLite 檔。
+
+- 每 MARKET_MAP_REFRESH_DAYS 天由 FinMind TaiwanStockInfo 整批更新一次
+- 對照表沒有的代號，由 yfinance 第一次成功查到的後綴補上
+- yfinance 備援直接使用對照表的後綴，上櫃股不再先白查一次 .TW
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+from bar_store import BAR_STORE_PATH
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+MARKET_MAP_REFRESH_DAYS = int(os.getenv("MARKET_MAP_REFRESH_DAYS", "30"))
+# TaiwanStockInfo 的 type 欄位 → yfinance 後綴（興櫃在 Yahoo 也是 .TWO）
+_TYPE_SUFFIX = {"twse": "TW", "tpex": "TWO", "emerging": "TWO"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stock_markets (
+    stock_id   TEXT PRIMARY KEY,
+    suffix     TEXT NOT NULL,
+    source     TEXT NOT NULL,
+    updated_on TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stock_markets_meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class MarketMap:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or BAR_STORE_PATH
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        self._suffix: Dict[str, str] = {
+            sid: suffix for sid, suffix in self._conn.execute("SELECT stock_id, suffix FROM stock_markets")
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def suffix(self, stock_id: str) -> Optional[str]:
+        return self._suffix.get(stock_id)
+
+    def record(self, stock_id: str, suffix: str, source: str, today: str):
+        """記錄查詢成功的後綴（已知且相同時不寫入）。"""
+        if self._suffix.get(stock_id) == suffix:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stock_markets (stock_id, suffix, source, updated_on) VALUES (?, ?, ?, ?)",
+                (stock_id, suffix, source, today),
+            )
+            self._conn.commit()
+            self._suffix[stock_id] = suffix
+
+    def _meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM stock_markets_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def needs_refresh(self, today: str) -> bool:
+        """距離上次嘗試整批更新已超過 MARKET_MAP_REFRESH_DAYS 天（或從未更新）。"""
+        last = self._meta("refreshed_on")
+        if not last:
+            return True
+        days = (datetime.strptime(today, "%Y-%m-%d") - datetime.strptime(last, "%Y-%m-%d")).days
+        return days >= MARKET_MAP_REFRESH_DAYS
+
+    def refresh(self, fetch_info: Callable[[], Optional[pd.DataFrame]], today: str) -> int:
+        """
+        以 FinMind TaiwanStockInfo（欄位 stock_id、type）整批更新，回傳寫入筆數。
+        無論成功與否都記下嘗試日期，避免失敗時每次執行都重試。
+        """
+        rows = []
+        try:
+            df = fetch_info()
+            if df is not None and not df.empty and {"stock_id", "type"} <= set(df.columns):
+                if "date" in df.columns:
+                    df = df.sort_values("date")
+                for stock_id, market_type in zip(df["stock_id"], df["type"]):
+                    suffix = _TYPE_SUFFIX.get(str(market_type).strip().lower())
+                    if suffix:
+                        rows.append((str(stock_id).strip(), suffix, "finmind", today))
+        finally:
+            with self._lock:
+                # 同一代號可能同時有多筆（例如轉上市），以最後一筆為準
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO stock_markets (stock_id, suffix, source, updated_on) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO stock_markets_meta (key, value) VALUES ('refreshed_on', ?)", (today,)
+                )
+                self._conn.commit()
+                self._suffix.update({sid: suffix for sid, suffix, _, _ in rows})
+        return len(rows)
@@ -0,0 +1,167 @@
+"""
+單次執行的效能量測：以 span 計時每一次資料來源、Sheets 與 Discord 呼叫，執行結束時輸出摘要。
+
+    with METRICS.span("finmind.daily") as span:
+        df = ...
+        span.items = len(df)
+
+摘要依階段列出次數、錯誤、p50／p95／最大耗時、位元組與重試次數；
+另可輸出 JSON Lines（METRICS_JSONL）或 Prometheus textfile（METRICS_PROM）供外部收集。
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterator, List, Optional
+
+METRICS_JSONL = os.getenv("METRICS_JSONL")  # 每次執行每個階段附加一行 JSON
+METRICS_PROM = os.getenv("METRICS_PROM")    # node_exporter textfile collector 用的 .prom 檔（每次覆寫）
+
+_log = logging.getLogger("stock.metrics")
+
+
+class Span:
+    __slots__ = ("stage", "bytes", "items", "retries", "error")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.bytes = 0
+        self.items = 0
+        self.retries = 0
+        self.error = False
+
+
+class _Stage:
+    __slots__ = ("durations", "errors", "bytes", "items", "retries")
+
+    def __init__(self):
+        self.durations: List[float] = []
+        self.errors = 0
+        self.bytes = 0
+        self.items = 0
+        self.retries = 0
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    """nearest-rank 百分位數。"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Metrics:
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages: Dict[str, _Stage] = {}
+            self._started = self.clock()
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[Span]:
+        span = Span(stage)
+        started = self.clock()
+        try:
+            yield span
+        except BaseException:
+            span.error = True
+            raise
+        finally:
+            self.record(span, self.clock() - started)
+
+    def record(self, span: Span, duration: float):
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug(f"{span.stage} {duration:.3f}s", extra={"fields": {
+                "stage": span.stage, "duration": round(duration, 4), "bytes": span.bytes,
+                "items": span.items, "error": span.error,
+            }})
+        with self._lock:
+            stage = self._stages.setdefault(span.stage, _Stage())
+            stage.durations.append(duration)
+            stage.errors += int(span.error)
+            stage.bytes += span.bytes
+            stage.items += span.items
+            stage.retries += span.retries
+
+    def add_retry(self, stage: str, count: int = 1):
+        """不另計一次呼叫、只累加重試次數（例如 429 後重送）。"""
+        with self._lock:
+            self._stages.setdefault(stage, _Stage()).retries += count
+
+    def summary(self) -> Dict[str, Dict]:
+        with self._lock:
+            result = {}
+            for name in sorted(self._stages):
+                s = self._stages[name]
+                durations = sorted(s.durations)
+                result[name] = {
+                    "count": len(durations),
+                    "errors": s.errors,
+                    "total_s": round(sum(durations), 4),
+                    "p50_s": round(_percentile(durations, 50), 4),
+                    "p95_s": round(_percentile(durations, 95), 4),
+                    "max_s": round(durations[-1], 4) if durations else 0.0,
+                    "bytes": s.bytes,
+                    "items": s.items,
+                    "retries": s.retries,
+                }
+            return result
+
+    def elapsed(self) -> float:
+        return self.clock() - self._started
+
+    def report(self, log: Callable[[str], None], label: str = "本次執行"):
+        """輸出摘要到 log，並依環境變數輸出 JSON Lines／Prometheus textfile。"""
+        summary = self.summary()
+        log(f"⏱ {label}效能摘要：總耗時 {self.elapsed():.2f} 秒，{len(summary)} 個階段")
+        for name, s in summary.items():
+            log(
+                f"  {name:<22} 次數 {s['count']:>4}  錯誤 {s['errors']}  "
+                f"p50 {s['p50_s']:.3f}s  p95 {s['p95_s']:.3f}s  max {s['max_s']:.3f}s  "
+                f"合計 {s['total_s']:.2f}s  位元組 {s['bytes']}  筆數 {s['items']}  重試 {s['retries']}"
+            )
+        try:
+            if METRICS_JSONL:
+                self.export_jsonl(METRICS_JSONL, label, summary)
+            if METRICS_PROM:
+                self.export_prometheus(METRICS_PROM, summary)
+        except OSError as e:
+            log(f"效能摘要輸出失敗：{e}")
+
+    def export_jsonl(self, path: str, label: str, summary: Optional[Dict[str, Dict]] = None):
+        summary = self.summary() if summary is None else summary
+        ts = datetime.now(timezone(timedelta(hours=8))).isoformat(timespec="seconds")
+        with open(path, "a", encoding="utf-8") as f:
+            for name, s in summary.items():
+                f.write(json.dumps({"ts": ts, "run": label, "stage": name, **s}, ensure_ascii=False) + "\n")
+
+    def export_prometheus(self, path: str, summary: Optional[Dict[str, Dict]] = None):
+        """寫入暫存檔再改名，避免收集器讀到寫一半的檔案。"""
+        summary = self.summary() if summary is None else summary
+        lines = []
+        fields = [
+            ("calls_total", "count"), ("errors_total", "errors"), ("retries_total", "retries"),
+            ("bytes_total", "bytes"), ("seconds_total", "total_s"), ("seconds_p50", "p50_s"),
+            ("seconds_p95", "p95_s"), ("seconds_max", "max_s"),
+        ]
+        for metric, key in fields:
+            lines.append(f"# TYPE stock_notify_stage_{metric} gauge")
+            for name, s in summary.items():
+                lines.append(f'stock_notify_stage_{metric}{{stage="{name}"}} {s[key]}')
+        lines.append("# TYPE stock_notify_run_seconds gauge")
+        lines.append(f"stock_notify_run_seconds {self.elapsed():.4f}")
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+METRICS = Metrics()
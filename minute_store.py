@@ -0,0 +1,189 @@
+"""
+盤中分鐘價本地儲存（SQLite，與日 K 快取共用同一個檔案）。
+
+- 每次抓到的當天分鐘價（FinMind TaiwanStockPrice、yfinance 1m）只附加比最後一筆更新的時間點，
+  不再只留最後一筆、五分鐘後整段重抓
+- 資料表以 (stock_id, ts) 為主鍵且 WITHOUT ROWID：同一支股票同一天的分鐘價在檔案中連續存放，
+  依時間範圍讀取不必掃整張表
+- 盤中指標（VWAP、當日高低、成交量）可直接由本地資料計算，不需額外 API 呼叫：
+
+    python minute_store.py stats 2330              # 今天的筆數、時間範圍、高低、VWAP
+    python minute_store.py prune                   # 只保留最近 MINUTE_STORE_KEEP_DAYS 天
+"""
+import argparse
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bar_store import BAR_STORE_PATH, TW_TZ
+
+MINUTE_STORE_KEEP_DAYS = int(os.getenv("MINUTE_STORE_KEEP_DAYS", "20"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS minute_bars (
+    stock_id TEXT NOT NULL,
+    ts       TEXT NOT NULL,
+    price    REAL NOT NULL,
+    volume   REAL,
+    source   TEXT NOT NULL,
+    PRIMARY KEY (stock_id, ts)
+) WITHOUT ROWID;
+"""
+
+
+class MinuteStore:
+    """可在抓取執行緒池中共用；每支股票當天最後時間點快取在記憶體，附加前不必查詢。"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or BAR_STORE_PATH
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        self._last: Dict[Tuple[str, str], Optional[str]] = {}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def last_ts(self, stock_id: str, date: str) -> Optional[str]:
+        """當天最後一筆的時間（YYYY-MM-DD HH:MM:SS）；沒有資料時為 None。"""
+        key = (stock_id, date)
+        with self._lock:
+            if key not in self._last:
+                row = self._conn.execute(
+                    "SELECT MAX(ts) FROM minute_bars WHERE stock_id = ? AND ts >= ? AND ts < ?",
+                    (stock_id, date, f"{date}~"),
+                ).fetchone()
+                self._last[key] = row[0]
+            return self._last[key]
+
+    def append(self, stock_id: str, rows: Iterable[Tuple[str, float, Optional[float]]], source: str) -> int:
+        """
+        rows 為 (ts, price, volume)，時間為台灣時間；只寫入比當天最後一筆更新的時間點。
+        回傳實際新增筆數。
+        """
+        by_date: Dict[str, List[Tuple]] = {}
+        for ts, price, volume in rows:
+            by_date.setdefault(ts[:10], []).append((stock_id, ts, float(price), volume, source))
+        added = 0
+        for date, items in by_date.items():
+            last = self.last_ts(stock_id, date)
+            items = [item for item in items if last is None or item[1] > last]
+            if not items:
+                continue
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO minute_bars (stock_id, ts, price, volume, source) VALUES (?, ?, ?, ?, ?)",
+                    items,
+                )
+                self._conn.commit()
+                self._last[(stock_id, date)] = max(item[1] for item in items)
+            added += len(items)
+        return added
+
+    def latest(self, stock_id: str, date: str) -> Optional[Tuple[str, float, str]]:
+        """當天最後一筆 (ts, price, source)。"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT ts, price, source FROM minute_bars WHERE stock_id = ? AND ts >= ? AND ts < ? "
+                "ORDER BY ts DESC LIMIT 1",
+                (stock_id, date, f"{date}~"),
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def bars(self, stock_id: str, date: str) -> List[Tuple[str, float, Optional[float]]]:
+        """當天全部分鐘價 (ts, price, volume)，依時間排序。"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT ts, price, volume FROM minute_bars WHERE stock_id = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (stock_id, date, f"{date}~"),
+            ).fetchall()
+
+    def session_stats(self, stock_id: str, date: str) -> Optional[Dict]:
+        """當天筆數、開高低收、成交量與 VWAP（沒有成交量時 VWAP 為 None）。"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*), MIN(ts), MAX(ts), MAX(price), MIN(price), SUM(volume), SUM(price * volume) "
+                "FROM minute_bars WHERE stock_id = ? AND ts >= ? AND ts < ?",
+                (stock_id, date, f"{date}~"),
+            ).fetchone()
+        count, first, last, high, low, volume, notional = row
+        if not count:
+            return None
+        return {
+            "count": count, "first": first, "last": last, "high": high, "low": low,
+            "volume": volume, "vwap": notional / volume if volume else None,
+        }
+
+    def prune(self, keep_days: int = MINUTE_STORE_KEEP_DAYS, today: Optional[str] = None) -> int:
+        """刪除 keep_days 天以前的分鐘價，回傳刪除筆數。"""
+        today = today or datetime.now(TW_TZ).strftime("%Y-%m-%d")
+        cutoff = (datetime.strptime(today, "%Y-%m-%d") - timedelta(days=keep_days)).strftime("%Y-%m-%d")
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM minute_bars WHERE ts < ?", (cutoff,))
+            self._conn.commit()
+            self._last = {k: v for k, v in self._last.items() if k[1] >= cutoff}
+        return cur.rowcount
+
+
+def finmind_rows(df) -> List[Tuple[str, float, Optional[float]]]:
+    """FinMind TaiwanStockPrice（含 Time 欄位）→ (ts, price, volume)；沒有時間欄位的日資料不納入。"""
+    if df is None or df.empty or "Time" not in df.columns or "close" not in df.columns:
+        return []
+    volume_col = next((c for c in ("volume", "Trading_Volume") if c in df.columns), None)
+    rows = []
+    for rec in df.to_dict("records"):
+        if not rec.get("Time") or rec.get("close") is None:
+            continue
+        rows.append((f"{str(rec['date'])[:10]} {rec['Time']}", float(rec["close"]),
+                     rec.get(volume_col) if volume_col else None))
+    return rows
+
+
+def yfinance_rows(hist) -> List[Tuple[str, float, Optional[float]]]:
+    """yfinance 1m 資料 → (ts, price, volume)，時間轉為台灣時間。"""
+    if hist is None or hist.empty:
+        return []
+    index = hist.index
+    if getattr(index, "tz", None) is not None:
+        index = index.tz_convert(TW_TZ)
+    volumes = hist["Volume"] if "Volume" in hist.columns else [None] * len(hist)
+    return [
+        (ts.strftime("%Y-%m-%d %H:%M:%S"), float(close), None if vol is None else float(vol))
+        for ts, close, vol in zip(index, hist["Close"], volumes)
+    ]
+
+
+# ======================== 指令列 ========================
+def main():
+    parser = argparse.ArgumentParser(description="盤中分鐘價儲存管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    stats = sub.add_parser("stats", help="顯示某支股票某天的分鐘價摘要")
+    stats.add_argument("stock_id")
+    stats.add_argument("--date", help="日期 YYYY-MM-DD（預設今天）")
+    prune = sub.add_parser("prune", help="刪除舊的分鐘價")
+    prune.add_argument("--keep-days", type=int, default=MINUTE_STORE_KEEP_DAYS)
+    args = parser.parse_args()
+
+    store = MinuteStore()
+    try:
+        if args.command == "stats":
+            date = args.date or datetime.now(TW_TZ).strftime("%Y-%m-%d")
+            s = store.session_stats(args.stock_id.strip().upper(), date)
+            if s is None:
+                print(f"{args.stock_id} {date} 沒有分鐘價")
+            else:
+                vwap = f"{s['vwap']:.2f}" if s["vwap"] is not None else "無成交量"
+                print(f"{args.stock_id} {date}：{s['count']} 筆 {s['first'][11:]}～{s['last'][11:]}  "
+                      f"高 {s['high']:.2f} 低 {s['low']:.2f}  量 {s['volume'] or 0:.0f}  VWAP {vwap}")
+        elif args.command == "prune":
+            print(f"已刪除 {store.prune(args.keep_days)} 筆分鐘價")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
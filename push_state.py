@@ -0,0 +1,126 @@
+"""
+差異推播：記住每支股票上一次推播的內容（本地 SQLite，與日 K 快取共用同一個檔案），只推有明顯變化的股票。
+
+以下任一情況才推播完整區塊，其餘股票合併成一行「無明顯變化」摘要：
+- 今天第一次推播，或推播類型改變（盤中 → 昨日收盤 → 盤後）
+- 建議／行情摘要文字改變
+- 價格相對上次推播的價格變動達 PUSH_PRICE_THRESHOLD_PCT（%）
+- 價格穿越 MA5／MA20／MA60（相對均線的位置與上次推播不同）
+
+比較對象是「上次推播」而非「上次執行」，緩慢的累積變動達到門檻時仍會推播。
+PUSH_DIFF=0 時每次都推播完整區塊（原本的行為）。
+"""
+import os
+import sqlite3
+import threading
+from typing import Dict, NamedTuple, Optional
+
+from bar_store import BAR_STORE_PATH
+
+PUSH_DIFF = os.getenv("PUSH_DIFF", "1") == "1"
+PUSH_PRICE_THRESHOLD_PCT = float(os.getenv("PUSH_PRICE_THRESHOLD_PCT", "0.5"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS push_state (
+    stock_id  TEXT PRIMARY KEY,
+    date      TEXT NOT NULL,
+    mode      TEXT NOT NULL,
+    price     REAL NOT NULL,
+    ma5       REAL,
+    ma20      REAL,
+    ma60      REAL,
+    advice    TEXT NOT NULL,
+    pushed_at TEXT NOT NULL
+);
+"""
+
+
+class PushSnapshot(NamedTuple):
+    mode: str
+    price: float
+    ma5: Optional[float]
+    ma20: Optional[float]
+    ma60: Optional[float]
+    advice: str
+
+
+def _side(price: float, ma: Optional[float]) -> int:
+    """價格在均線之上 1、之下 -1、相等或無均線 0。"""
+    if ma is None:
+        return 0
+    return (price > ma) - (price < ma)
+
+
+def change_reason(prev: Optional[PushSnapshot], cur: PushSnapshot,
+                  threshold_pct: float = PUSH_PRICE_THRESHOLD_PCT) -> Optional[str]:
+    """回傳需要推播的原因；沒有明顯變化時回傳 None。"""
+    if prev is None or prev.mode != cur.mode:
+        return "首次推播"
+    if prev.advice != cur.advice:
+        return "建議改變"
+    if prev.price and abs(cur.price - prev.price) / prev.price * 100 >= threshold_pct:
+        return f"價格變動 {(cur.price - prev.price) / prev.price * 100:+.2f}%"
+    for name in ("ma5", "ma20", "ma60"):
+        before, after = _side(prev.price, getattr(prev, name)), _side(cur.price, getattr(cur, name))
+        if before and after and before != after:
+            return f"{'突破' if after > 0 else '跌破'} {name.upper()}"
+    return None
+
+
+class PushStateStore:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or BAR_STORE_PATH
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def load(self, date: str) -> Dict[str, PushSnapshot]:
+        """今天已推播過的股票（其他日期的紀錄視為沒有）。"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stock_id, mode, price, ma5, ma20, ma60, advice FROM push_state WHERE date = ?", (date,)
+            ).fetchall()
+        return {r[0]: PushSnapshot(*r[1:]) for r in rows}
+
+    def save_many(self, date: str, pushed_at: str, snapshots: Dict[str, PushSnapshot]):
+        if not snapshots:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO push_state (stock_id, date, mode, price, ma5, ma20, ma60, advice, pushed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(sid, date, *snap, pushed_at) for sid, snap in snapshots.items()],
+            )
+            self._conn.commit()
+
+
+class ChangeDetector:
+    """單次執行用：判斷每支股票是否推播，推播成功後 commit() 記下這次推播的內容。"""
+
+    def __init__(self, store: PushStateStore, date: str, enabled: bool = PUSH_DIFF,
+                 threshold_pct: float = PUSH_PRICE_THRESHOLD_PCT):
+        self.store = store
+        self.date = date
+        self.enabled = enabled
+        self.threshold_pct = threshold_pct
+        self._previous = store.load(date)
+        self._pending: Dict[str, PushSnapshot] = {}
+
+    def check(self, stock_id: str, snapshot: PushSnapshot) -> Optional[str]:
+        """回傳推播原因（None 表示略過）；要推播的股票記入待儲存清單。"""
+        reason = change_reason(self._previous.get(stock_id), snapshot, self.threshold_pct)
+        if reason is None and not self.enabled:
+            reason = "每次推播"
+        if reason is not None:
+            self._pending[stock_id] = snapshot
+        return reason
+
+    def commit(self, pushed_at: str):
+        self.store.save_many(self.date, pushed_at, self._pending)
+        self._previous.update(self._pending)
+        self._pending = {}
@@ -0,0 +1,319 @@
+"""
+API 配額節流（token bucket）：每個服務一個桶，依公開的配額發放請求額度，額度用完才等待，取代各處固定的 sleep。
+
+    with QUOTAS.slot("sheets.read"):
+        result = request.execute()
+
+- 桶容量（burst）以內的請求立即送出；之後以 (配額 - 容量) / 週期 的速率補充，
+  任一個完整週期內送出的請求數不超過配額
+- 被限流（429）時自適應退避：暫停 retry_after 秒（沒有時依連續次數 1、2、4… 秒，最多 BACKOFF_MAX 秒），
+  補充速率減半；之後每次成功恢復一成，直到回到原速率
+- 等待時間記入 METRICS 的 sleep.quota.<名稱>，被限流次數記為 quota.<名稱> 的重試
+- 桶的額度、更新時間與退避狀態存在本地 SQLite（與日 K 快取共用同一個檔案），每次取得額度都在同一個交易內
+  讀取、補充、扣除並寫回：cron 每次重新啟動不會重拿滿額的 burst，同時執行的程式（推播、補齊、分片 worker）
+  也共用同一個桶，合計不超過配額。時間以系統時鐘（time.time）計算，跨程序才能比較。
+  請求成功只在退避中才需要寫入（先以唯讀查詢確認），一般請求只有取得額度那一次短交易
+
+    python quota.py stats       # 各桶目前額度
+    python quota.py reset       # 清除已存的狀態（例如調整配額環境變數後）
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from bar_store import BAR_STORE_PATH
+from metrics import METRICS
+
+FINMIND_QUOTA_PER_HOUR = int(os.getenv("FINMIND_QUOTA_PER_HOUR", "600"))         # FinMind 註冊會員每小時 600 次
+FINMIND_BURST = int(os.getenv("FINMIND_BURST", "100"))                           # 不等待即可連續送出的請求數
+YFINANCE_QUOTA_PER_MINUTE = int(os.getenv("YFINANCE_QUOTA_PER_MINUTE", "60"))    # Yahoo 未公開，保守值
+SHEETS_READ_QUOTA_PER_MINUTE = int(os.getenv("SHEETS_READ_QUOTA_PER_MINUTE", "60"))    # 每位使用者每分鐘 60 次讀取
+SHEETS_WRITE_QUOTA_PER_MINUTE = int(os.getenv("SHEETS_WRITE_QUOTA_PER_MINUTE", "60"))  # 每位使用者每分鐘 60 次寫入
+DISCORD_QUOTA_PER_MINUTE = int(os.getenv("DISCORD_QUOTA_PER_MINUTE", "30"))      # 每個 webhook 每分鐘 30 則
+
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+MIN_RATE_FACTOR = 1 / 16
+
+# 桶名稱 → (配額, 週期秒數, 容量)；「discord:<webhook>」這類名稱取冒號前的設定
+QUOTA_SPECS: Dict[str, Tuple[int, float, int]] = {
+    "finmind": (FINMIND_QUOTA_PER_HOUR, 3600, FINMIND_BURST),
+    "yfinance": (YFINANCE_QUOTA_PER_MINUTE, 60, 10),
+    "sheets.read": (SHEETS_READ_QUOTA_PER_MINUTE, 60, 20),
+    "sheets.write": (SHEETS_WRITE_QUOTA_PER_MINUTE, 60, 20),
+    "discord": (DISCORD_QUOTA_PER_MINUTE, 60, 5),
+}
+
+_log = logging.getLogger("stock.quota")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS quota_state (
+    name          TEXT PRIMARY KEY,
+    tokens        REAL NOT NULL,
+    updated       REAL NOT NULL,
+    blocked_until REAL NOT NULL,
+    factor        REAL NOT NULL,
+    strikes       INTEGER NOT NULL
+);
+"""
+
+# 沒有 HTTP 狀態碼可查時（FinMind、yfinance 只拋出訊息），以各套件的限流訊息判斷
+_RATE_LIMIT_MESSAGES = ("Too Many Requests", "Rate limited", "upper limit")
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    """例外帶的 HTTP 狀態碼：googleapiclient HttpError 的 resp.status、requests HTTPError 的 response.status_code。"""
+    for holder in (exc, getattr(exc, "resp", None), getattr(exc, "response", None)):
+        for attr in ("status", "status_code"):
+            value = getattr(holder, attr, None) if holder is not None else None
+            if isinstance(value, int) or (isinstance(value, str) and value.isdigit()):
+                return int(value)
+    return None
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """判斷例外是否為限流：有 HTTP 狀態碼時只看是否為 429；沒有時依各套件的限流訊息（不比對訊息中的數字）。"""
+    status = _status_code(exc)
+    if status is not None:
+        return status == 429
+    text = str(exc)
+    return any(s in text for s in _RATE_LIMIT_MESSAGES)
+
+
+class QuotaStore:
+    """桶狀態的本地儲存；多個程序同時使用時以 BEGIN IMMEDIATE 交易依序更新。"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or BAR_STORE_PATH
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def update(self, name: str) -> Iterator[List]:
+        """
+        鎖定並讀出一個桶的狀態 [tokens, updated, blocked_until, factor, strikes]（沒有時為空清單），
+        呼叫端就地修改後寫回（沒有變更時不寫）；其他程序在交易結束前會等待。
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT tokens, updated, blocked_until, factor, strikes FROM quota_state WHERE name = ?", (name,)
+                ).fetchone()
+                state = list(row) if row else []
+                yield state
+                if state and state != list(row or ()):
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO quota_state (name, tokens, updated, blocked_until, factor, strikes) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (name, *state),
+                    )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def read(self, name: str) -> List:
+        """不鎖定、只讀出一個桶的狀態（沒有時為空清單）。"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT tokens, updated, blocked_until, factor, strikes FROM quota_state WHERE name = ?", (name,)
+            ).fetchone()
+        return list(row) if row else []
+
+    def stats(self) -> List[Tuple]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT name, tokens, updated, blocked_until, factor, strikes FROM quota_state ORDER BY name"
+            ).fetchall()
+
+    def reset(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM quota_state")
+            self._conn.commit()
+
+
+class TokenBucket:
+    def __init__(self, name: str, quota: int, period: float, burst: Optional[int] = None,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep,
+                 store: Optional[QuotaStore] = None):
+        self.name = name
+        self.capacity = max(1, min(quota if burst is None else burst, quota))
+        # 容量與配額相同時無法保證週期上限，至少保留 1 個額度給補充速率
+        self.rate = max(quota - self.capacity, 1) / period
+        self.clock = clock
+        self.sleep = sleep
+        self.store = store  # 有 store 時狀態跨程序共用，clock 須為系統時鐘
+        self._lock = threading.Lock()
+        self._tokens = float(self.capacity)
+        self._updated = clock()
+        self._blocked_until = 0.0
+        self._factor = 1.0
+        self.strikes = 0
+        self.waited = 0.0
+        self.throttled = 0
+
+    @contextmanager
+    def _state(self) -> Iterator[None]:
+        """持有鎖；有 store 時先載入共用狀態，結束時寫回（同一個交易）。"""
+        with self._lock:
+            if self.store is None:
+                yield
+                return
+            with self.store.update(self.name) as state:
+                if state:
+                    tokens, self._updated, self._blocked_until, self._factor, self.strikes = state
+                    self._tokens = min(self.capacity, tokens)
+                yield
+                state[:] = [self._tokens, self._updated, self._blocked_until, self._factor, self.strikes]
+
+    def _refill(self) -> float:
+        """依經過時間補充額度（呼叫端持有鎖），回傳目前時間。"""
+        now = self.clock()
+        elapsed = max(0.0, now - self._updated)  # 系統時鐘可能被校時往回調
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate * self._factor)
+        self._updated = max(self._updated, now)
+        return now
+
+    def acquire(self, n: int = 1) -> float:
+        """取得 n 個額度，不足或退避中時等待；回傳等待秒數。先預約再等待，多執行緒（與程序）依序排隊。"""
+        with self._state():
+            now = self._refill()
+            self._tokens -= n
+            deficit = -self._tokens / (self.rate * self._factor) if self._tokens < 0 else 0.0
+            wait = max(self._blocked_until - now, deficit)
+            self.waited += wait
+        if wait > 0:
+            with METRICS.span(f"sleep.quota.{self.name}"):
+                self.sleep(wait)
+        return wait
+
+    def penalize(self, retry_after: Optional[float] = None):
+        """收到 429：暫停 retry_after（或指數退避）秒、清空額度並把補充速率減半。"""
+        with self._state():
+            self.strikes += 1
+            self.throttled += 1
+            delay = retry_after if retry_after is not None else min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.strikes - 1))
+            now = self._refill()
+            self._blocked_until = max(self._blocked_until, now + delay)
+            self._tokens = min(self._tokens, 0.0)
+            self._factor = max(MIN_RATE_FACTOR, self._factor / 2)
+        METRICS.add_retry(f"quota.{self.name}")
+        _log.warning(f"{self.name} 被限流（第 {self.strikes} 次），退避 {delay:.1f} 秒，速率降為 {self._factor:.0%}")
+
+    def _backing_off(self) -> bool:
+        """目前是否有限流後的退避狀態（有 store 時以唯讀查詢共用狀態，不取得寫入鎖）。"""
+        if self.store is None:
+            return bool(self.strikes or self._factor < 1)
+        state = self.store.read(self.name)
+        return bool(state) and bool(state[4] or state[3] < 1)
+
+    def success(self):
+        """請求成功：清除連續限流次數，速率逐步恢復；沒有退避狀態時（絕大多數請求）不寫入共用狀態。"""
+        if not self._backing_off():
+            return
+        with self._state():
+            # 在同一個交易內以剛載入的共用狀態判斷，不會蓋掉其他程序剛寫入的退避
+            if self.strikes or self._factor < 1:
+                self._refill()
+                self.strikes = 0
+                self._factor = min(1.0, self._factor + 0.1)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """請求前取得一個額度；請求拋出限流例外時退避，成功時恢復速率。"""
+        self.acquire()
+        try:
+            yield
+        except Exception as e:
+            if is_rate_limited(e):
+                self.penalize()
+            raise
+        self.success()
+
+
+class QuotaManager:
+    """
+    依名稱取得（第一次使用時建立）各服務的 token bucket；整個程序共用。
+    persist=True 時桶狀態存在本地 SQLite（第一次使用時才開啟），跨次執行、跨程序共用。
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time, sleep: Callable[[float], None] = time.sleep,
+                 persist: bool = True):
+        self._lock = threading.Lock()
+        self.persist = persist
+        self.reset(clock, sleep)
+
+    def reset(self, clock: Optional[Callable[[], float]] = None, sleep: Optional[Callable[[float], None]] = None):
+        """丟掉所有桶並關閉儲存（可順便換掉時鐘，供離線效能測試使用；下次使用時依目前的 BAR_STORE_PATH 重新開啟）。"""
+        with self._lock:
+            self.clock = clock or getattr(self, "clock", time.time)
+            self._sleep = sleep or getattr(self, "_sleep", time.sleep)
+            self._buckets: Dict[str, TokenBucket] = {}
+            store = getattr(self, "_store", None)
+            if store is not None:
+                store.close()
+            self._store: Optional[QuotaStore] = None
+
+    def bucket(self, name: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                quota, period, burst = QUOTA_SPECS[name.split(":", 1)[0]]
+                if self.persist and self._store is None:
+                    self._store = QuotaStore()
+                bucket = TokenBucket(name, quota, period, burst, self.clock, self._sleep, self._store)
+                self._buckets[name] = bucket
+            return bucket
+
+    def acquire(self, name: str, n: int = 1) -> float:
+        return self.bucket(name).acquire(n)
+
+    def penalize(self, name: str, retry_after: Optional[float] = None):
+        self.bucket(name).penalize(retry_after)
+
+    def success(self, name: str):
+        self.bucket(name).success()
+
+    def slot(self, name: str):
+        return self.bucket(name).slot()
+
+
+QUOTAS = QuotaManager()
+
+
+# ======================== 指令列 ========================
+def main():
+    parser = argparse.ArgumentParser(description="API 配額狀態管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="顯示各桶目前額度與退避狀態")
+    sub.add_parser("reset", help="清除已存的配額狀態，下次執行從滿額開始")
+    args = parser.parse_args()
+
+    store = QuotaStore()
+    try:
+        if args.command == "stats":
+            now = time.time()
+            for name, tokens, updated, blocked_until, factor, strikes in store.stats():
+                blocked = f"，退避中還有 {blocked_until - now:.0f} 秒" if blocked_until > now else ""
+                print(f"{name:<20} 額度 {tokens:7.1f}（{now - updated:.0f} 秒前更新）速率 {factor:.0%}{blocked}")
+        elif args.command == "reset":
+            store.reset()
+            print("已清除配額狀態")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
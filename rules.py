@@ -0,0 +1,272 @@
+"""
+建議／行情摘要規則引擎。
+
+規則寫在 Google Sheets 的 Rules 分頁（A 類型、B 股票、C 條件、D 建議文字、E 啟用），
+啟動時編譯一次，之後每次執行對整份清單的價格／均線表向量化評估（numpy），不再逐檔走 if/elif。
+
+- 類型：盤中（intraday，含 13:31 昨日收盤推播）或盤後（after_close）
+- 股票：空白或 * 為全部股票，多支以逗號分隔；指定股票的規則優先於全部股票的規則，
+  兩者之後接內建預設規則（DEFAULT_RULES，即原本的建議文字），同一類型依序第一條成立的規則勝出
+- 條件：Python 語法的運算式，只允許下列變數、數字、比較、and／or／not、+ - * / 與 abs()：
+    price 價格、yclose 昨收、change 漲跌、pct 漲跌幅（%）、ma5／ma20／ma60 均線、
+    diff_ma5／diff_ma20／diff_ma60 價格相對均線（%）、has_ma5／has_ma20／has_ma60 是否有均線
+  均線無資料時與它比較一律不成立；例：pct <= -3、yclose <= ma20 and price > ma20（突破 MA20）
+- 建議文字可帶 {price:.2f}、{pct:+.2f} 等欄位
+"""
+import ast
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+MODES = {"intraday": "intraday", "盤中": "intraday", "after_close": "after_close", "盤後": "after_close"}
+BASE_COLUMNS = ("price", "yclose", "change", "pct", "ma5", "ma20", "ma60")
+VARIABLES = BASE_COLUMNS + ("diff_ma5", "diff_ma20", "diff_ma60", "has_ma5", "has_ma20", "has_ma60")
+_CONSTANTS = {"true": "true", "false": "false", "True": "true", "False": "false"}  # 評估時為全真／全假的陣列
+
+
+class Rule(NamedTuple):
+    mode: str
+    stocks: List[str]     # 空清單表示全部股票
+    condition: str
+    message: str
+    source: str           # 規則出處（例：Rules!A5、預設）
+
+
+class RuleSet(NamedTuple):
+    rules: List[Rule]
+    errors: List[str]
+
+
+# 原本 get_intraday_advice／get_after_close_summary 的 if/elif 階梯，依序改寫成規則
+_UP = "price > ma5 and price > ma20"
+_DOWN = "price < ma5 and price < ma20"
+DEFAULT_RULES: List[Rule] = [
+    Rule("intraday", [], "not (has_ma5 and has_ma20)", "均線資料不夠，先等等看比較好", "預設"),
+    Rule("intraday", [], f"{_UP} and diff_ma5 <= 2.8 and 3.0 <= pct <= 6.0",
+         "剛突破均線 + 今天力道很強，建議可以全部買進（但設好停損點）", "預設"),
+    Rule("intraday", [], f"{_UP} and (diff_ma5 > 7.5 or (diff_ma5 > 6.0 and pct > 4.5))",
+         "現在明顯過熱 + 漲幅很大，建議全部賣出鎖利，或至少先賣 70%~100%", "預設"),
+    Rule("intraday", [], f"{_UP} and pct > 5.0", "今天漲很多，建議先賣 50%~80% 鎖住部分利潤，剩下的看明天", "預設"),
+    Rule("intraday", [], f"{_UP} and diff_ma5 > 4.5",
+         "股價已經漲不少，現在偏貴，建議先觀望，或最多用 10%~20% 的資金試試看", "預設"),
+    Rule("intraday", [], f"{_UP} and 1.5 <= pct < 3.5", "今天有往上力道，建議先用 25%~45% 的資金分批買進", "預設"),
+    Rule("intraday", [], f"{_UP} and abs(pct) < 1.2 and pct > 0", "小漲站上均線，建議先用 10%~25% 的資金試試看", "預設"),
+    Rule("intraday", [], f"{_UP} and abs(pct) < 1.2", "站上均線但今天沒力道，建議先觀望，不要急著買", "預設"),
+    Rule("intraday", [], _UP, "漲太快了，建議先不要追，最多用 15%~30% 的資金小量進場", "預設"),
+    Rule("intraday", [], f"{_DOWN} and pct < -5.0", "今天跌很多 + 跌破均線，建議全部賣出止損，或至少先賣 70%~100%", "預設"),
+    Rule("intraday", [], f"{_DOWN} and pct < -2.5", "跌破均線 + 跌幅明顯，建議先賣 40%~70% 降低風險", "預設"),
+    Rule("intraday", [], _DOWN, "股價在均線下面，建議暫時不要買，等反彈再看", "預設"),
+    Rule("intraday", [], "pct > 7.0", "今天漲超兇，建議先賣 60%~90% 鎖住大部分利潤", "預設"),
+    Rule("intraday", [], "pct < -7.0", "今天跌超兇，建議先賣 60%~90% 避險", "預設"),
+    Rule("intraday", [], "true", "現在情況不明，先觀望比較安全，等明天再說", "預設"),
+    Rule("after_close", [], _UP, "建議明天可以買進，今天收盤價比平均價高", "預設"),
+    Rule("after_close", [], _DOWN, "建議明天不要買，今天收盤價比平均價低", "預設"),
+    Rule("after_close", [], "abs(change) < 1", "今天沒什麼變化，明天再觀察", "預設"),
+    Rule("after_close", [], "true", "今天價格有變動，明天再看情況決定要不要買", "預設"),
+]
+
+
+# ======================== 編譯 ========================
+class _Vectorize(ast.NodeTransformer):
+    """檢查運算式只用允許的語法，並把 and／or／not／連續比較改寫成 numpy 布林陣列運算（& | ~）。"""
+
+    def generic_visit(self, node):
+        raise ValueError(f"不支援的語法：{type(node).__name__}")
+
+    def visit_Expression(self, node):
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_BoolOp(self, node):
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        values = [self.visit(v) for v in node.values]
+        result = values[0]
+        for value in values[1:]:
+            result = ast.BinOp(result, op, value)
+        return result
+
+    def visit_UnaryOp(self, node):
+        operand = self.visit(node.operand)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(ast.Invert(), operand)
+        if isinstance(node.op, (ast.USub, ast.UAdd)):
+            return ast.UnaryOp(node.op, operand)
+        raise ValueError(f"不支援的運算：{type(node.op).__name__}")
+
+    def visit_BinOp(self, node):
+        if not isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.Div)):
+            raise ValueError(f"不支援的運算：{type(node.op).__name__}")
+        return ast.BinOp(self.visit(node.left), node.op, self.visit(node.right))
+
+    def visit_Compare(self, node):
+        operands = [self.visit(node.left)] + [self.visit(c) for c in node.comparators]
+        allowed = (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+        pairs = []
+        for op, left, right in zip(node.ops, operands, operands[1:]):
+            if not isinstance(op, allowed):
+                raise ValueError(f"不支援的比較：{type(op).__name__}")
+            pairs.append(ast.Compare(left, [op], [right]))
+        result = pairs[0]
+        for pair in pairs[1:]:
+            result = ast.BinOp(result, ast.BitAnd(), pair)
+        return result
+
+    def visit_Call(self, node):
+        if not (isinstance(node.func, ast.Name) and node.func.id == "abs" and len(node.args) == 1 and not node.keywords):
+            raise ValueError("只支援 abs(x)")
+        return ast.Call(ast.Name("abs", ast.Load()), [self.visit(node.args[0])], [])
+
+    def visit_Name(self, node):
+        if node.id in _CONSTANTS:
+            return ast.Name(_CONSTANTS[node.id], ast.Load())
+        if node.id not in VARIABLES:
+            raise ValueError(f"未知的變數：{node.id}")
+        return ast.Name(node.id, ast.Load())
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool):
+            return ast.Name("true" if node.value else "false", ast.Load())
+        if not isinstance(node.value, (int, float)):
+            raise ValueError(f"不支援的常數：{node.value!r}")
+        return node
+
+
+def compile_condition(condition: str) -> Callable[[Dict], object]:
+    """條件字串 → 以欄位陣列為參數、回傳布林陣列（或純量）的函式；語法不允許時拋出 ValueError。"""
+    try:
+        tree = ast.parse(condition.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"語法錯誤：{e.msg}") from None
+    tree = ast.fix_missing_locations(_Vectorize().visit(tree))
+    code = compile(tree, "<rule>", "eval")
+    test = lambda env: eval(code, {"__builtins__": {}}, env)  # noqa: E731
+    try:
+        _as_mask(test(build_env({name: [1.0] for name in BASE_COLUMNS})), 1)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"條件無法計算：{e}") from None
+    return test
+
+
+def build_env(columns: Dict[str, Sequence[Optional[float]]]) -> Dict[str, object]:
+    """BASE_COLUMNS 各欄（None 表示無資料）→ 條件運算式可用的 numpy 陣列與衍生欄位。"""
+    import numpy as np
+
+    env: Dict[str, object] = {
+        name: np.array([np.nan if v is None else v for v in columns[name]], dtype=float) for name in BASE_COLUMNS
+    }
+    n = len(env["price"])
+    with np.errstate(all="ignore"):
+        for w in ("ma5", "ma20", "ma60"):
+            ma = env[w]
+            ma[ma == 0] = np.nan  # 與原本 `if ma5` 的判斷相同：0 視為無資料
+            env[f"has_{w}"] = ~np.isnan(ma)
+            env[f"diff_{w}"] = (env["price"] - ma) / ma * 100
+    env["true"] = np.ones(n, dtype=bool)
+    env["false"] = np.zeros(n, dtype=bool)
+    env["abs"] = np.abs
+    return env
+
+
+def _as_mask(value, n: int):
+    """條件結果須為布林（陣列）；數值結果（例如只寫 pct）視為錯誤。"""
+    import numpy as np
+
+    value = np.asarray(value)
+    if value.dtype != bool:
+        raise ValueError("條件結果不是真／假")
+    return np.broadcast_to(value, (n,))
+
+
+def _check_message(message: str):
+    """建議文字中的 {欄位} 必須是已知變數。"""
+    try:
+        message.format_map({name: 1.0 for name in VARIABLES})
+    except (KeyError, ValueError, IndexError) as e:
+        raise ValueError(f"建議文字格式錯誤：{e}") from None
+
+
+def parse_rules(rows: List[List], sheet_name: str = "Rules") -> RuleSet:
+    """Rules 分頁的列（從第 2 列起）→ 規則；有問題的列略過並記錄原因。"""
+    rules, errors = [], []
+    for offset, row in enumerate(rows or []):
+        cells = [str(c).strip() for c in row] + [""] * (5 - len(row))
+        kind, stocks, condition, message, enabled = cells[:5]
+        if not (kind or condition or message):
+            continue
+        where = f"{sheet_name}!A{offset + 2}"
+        if (enabled or "Y").upper() != "Y":
+            continue
+        mode = MODES.get(kind.lower()) or MODES.get(kind)
+        try:
+            if mode is None:
+                raise ValueError(f"未知的類型：{kind}（盤中／盤後）")
+            if not message:
+                raise ValueError("缺少建議文字")
+            compile_condition(condition)
+            _check_message(message)
+        except ValueError as e:
+            errors.append(f"{where}：{e}")
+            continue
+        ids = [] if stocks in ("", "*") else [s.strip().upper() for s in stocks.split(",") if s.strip()]
+        rules.append(Rule(mode, ids, condition, message, where))
+    return RuleSet(rules, errors)
+
+
+def restore_rules(value) -> RuleSet:
+    """ConfigCache 存的 JSON → RuleSet。"""
+    rules, errors = value
+    return RuleSet([Rule(*r) for r in rules], errors)
+
+
+# ======================== 評估 ========================
+class _Compiled(NamedTuple):
+    rule: Rule
+    test: Callable[[Dict], object]
+
+
+class RuleEngine:
+    """
+    規則依序編譯一次；evaluate() 對整份清單一次計算每條規則的布林陣列，
+    每支股票取第一條成立的規則。指定股票的規則排在全部股票的規則之前，最後是 DEFAULT_RULES。
+    """
+
+    def __init__(self, rules: Sequence[Rule] = (), defaults: Sequence[Rule] = DEFAULT_RULES):
+        ordered = [r for r in rules if r.stocks] + [r for r in rules if not r.stocks] + list(defaults)
+        self._by_mode: Dict[str, List[_Compiled]] = {}
+        for rule in ordered:
+            self._by_mode.setdefault(rule.mode, []).append(_Compiled(rule, compile_condition(rule.condition)))
+
+    def evaluate(self, mode: str, stock_ids: Sequence[str], columns: Dict[str, Sequence[Optional[float]]]
+                 ) -> List[Optional[str]]:
+        """columns 為 BASE_COLUMNS 各欄（與 stock_ids 同順序，None 表示無資料）；回傳每支股票的建議文字。"""
+        import numpy as np
+
+        n = len(stock_ids)
+        if not n:
+            return []
+        env = build_env(columns)
+        with np.errstate(all="ignore"):
+            ids = np.array(stock_ids, dtype=object)
+            chosen = np.full(n, -1)
+            compiled = self._by_mode.get(mode, [])
+            for index, item in enumerate(compiled):
+                open_ = chosen < 0
+                if not open_.any():
+                    break
+                if item.rule.stocks:
+                    open_ &= np.isin(ids, item.rule.stocks)
+                hit = open_ & _as_mask(item.test(env), n)
+                chosen[hit] = index
+
+        messages: List[Optional[str]] = []
+        for i, index in enumerate(chosen):
+            if index < 0:
+                messages.append(None)
+                continue
+            message = compiled[index].rule.message
+            if "{" in message:
+                row = {name: float(env[name][i]) for name in VARIABLES}
+                try:
+                    message = message.format_map(row)
+                except (ValueError, TypeError):
+                    pass
+            messages.append(message)
+        return messages
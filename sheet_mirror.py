@@ -0,0 +1,351 @@
+"""
+Sheet1 本地鏡像（SQLite，與日 K 快取共用同一個檔案），以 (stock_id, date) 為主鍵。
+
+- 讀取一律查本地鏡像，延遲與 Sheet1 總列數無關
+- 寫入先落在鏡像（標記待送出），再由 push() 合併成批次寫入送到 Sheets；
+  送出失敗的列留在鏡像中，下次執行自動重送
+- 每次執行最多一次 sync()：依工作表的總列數分段讀取整張 Sheet1 與鏡像對帳，
+  以 Sheets 為準更新列號與內容；與鏡像不同的已同步列視為手動修改並記錄，
+  鏡像中有但 Sheets 已沒有的列視為手動刪除；尚未送出的本地寫入不被覆蓋
+- 沒有先 sync() 的執行（推播程式）依列號覆寫前，先讀回目標列的代號與日期核對；
+  不符時（手動排序、插入或刪除列）先完整 sync() 再寫入，不會蓋到別的列
+- 同一支股票同一天重複寫入時更新原本的列，不再重複新增
+
+    python sheet_mirror.py stats       # 鏡像列數、待送出列數、上次同步時間
+"""
+import argparse
+import math
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from bar_store import BAR_STORE_PATH, TW_TZ
+from sheets_gateway import SheetsGateway, row_ranges
+
+SYNCED, PENDING, QUEUED = 0, 1, 2   # 已與 Sheets 一致／待送出／已排入本次執行的寫入佇列
+NUMERIC_TOLERANCE = 0.005           # Sheets 依儲存格格式四捨五入顯示，差距在此以內視為相同
+SYNC_CHUNK_ROWS = 2000              # sync() 每次讀取幾列
+VERIFY_BATCH_RANGES = 200           # 核對列號時每次 batchGet 帶幾個範圍（範圍放在網址中，不能太多）
+_COLUMNS = ("name", "price", "ma5", "ma20", "ma60", "ts")  # Sheet1 的 B、D～H 欄
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_mirror (
+    stock_id TEXT NOT NULL,
+    date     TEXT NOT NULL,
+    row_no   INTEGER,
+    name     TEXT NOT NULL,
+    price    TEXT NOT NULL,
+    ma5      TEXT NOT NULL,
+    ma20     TEXT NOT NULL,
+    ma60     TEXT NOT NULL,
+    ts       TEXT NOT NULL,
+    state    INTEGER NOT NULL,
+    seen     INTEGER NOT NULL,
+    PRIMARY KEY (stock_id, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sheet_mirror_row ON sheet_mirror (row_no);
+CREATE TABLE IF NOT EXISTS sheet_mirror_meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _cell(value) -> str:
+    return "" if value is None else str(value)
+
+
+def _same(a: str, b: str) -> bool:
+    """數字以容許誤差比較（Sheets 回傳的是格式化後的字串），其餘比對文字。"""
+    if a == b:
+        return True
+    try:
+        return math.isclose(float(a), float(b), abs_tol=NUMERIC_TOLERANCE)
+    except ValueError:
+        return False
+
+
+def _appended_start(updated_range: str) -> Optional[int]:
+    """Sheet1!A101:H103 → 101。"""
+    m = re.search(r"!\$?[A-Z]+\$?(\d+)", updated_range)
+    return int(m.group(1)) if m else None
+
+
+class SheetMirror:
+    """可在背景送出執行緒中共用；所有 SQLite 存取都經過同一把鎖。"""
+
+    def __init__(self, path: Optional[str] = None, sheet_name: str = "Sheet1"):
+        self.path = path or BAR_STORE_PATH
+        self.sheet_name = sheet_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        # 上一個程序排入佇列但沒確認送達的列，佇列已隨程序結束，改回待送出
+        self._conn.execute("UPDATE sheet_mirror SET state = ? WHERE state = ?", (PENDING, QUEUED))
+        self._conn.commit()
+        self._gateway: Optional[SheetsGateway] = None
+        self._synced_with: Optional[SheetsGateway] = None  # 本次執行已 sync() 過的閘道，依列號寫入不必再核對
+        self._queued_appends: List[Tuple[str, str]] = []  # 排入 _gateway 新增的 (stock_id, date)，依送出順序
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM sheet_mirror_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, **values):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO sheet_mirror_meta (key, value) VALUES (?, ?)",
+            [(k, str(v)) for k, v in values.items()],
+        )
+
+    # ---------- 對帳 ----------
+    def sync(self, sheets: SheetsGateway, chunk_rows: int = SYNC_CHUNK_ROWS,
+             log: Callable[[str], None] = print) -> Dict[str, int]:
+        """
+        分段讀取 Sheet1（每段 chunk_rows 列，記憶體與總列數無關）並與鏡像對帳，回傳統計。
+        讀到工作表的總列數為止：API 會略過尾端的空白列，中間有一整段空白時不足一段不代表已讀完。
+        讀取中途失敗時拋出例外，鏡像保留先前的內容，不做刪除判斷。
+        """
+        with self._lock:
+            generation = int(self._meta("generation") or 0) + 1
+        stats = {"rows": 0, "new": 0, "edited": 0, "removed": 0}
+        edited: List[str] = []
+        total = sheets.row_count(self.sheet_name)
+        first = 2
+        while total is None or first <= total:
+            last = first + chunk_rows - 1 if total is None else min(first + chunk_rows - 1, total)
+            rows = sheets.get(f"{self.sheet_name}!A{first}:H{last}", cache=False)
+            with self._lock:
+                for offset, row in enumerate(rows):
+                    if len(row) > 2 and row[0] and row[2]:
+                        self._reconcile(row, first + offset, generation, stats, edited)
+                self._conn.commit()
+            # 取不到總列數時才退回「不足一段即讀完」的判斷
+            if total is None and len(rows) < chunk_rows:
+                break
+            first = last + 1
+
+        with self._lock:
+            # 這次沒看到的已同步列：已在 Sheets 中被手動刪除
+            cur = self._conn.execute(
+                "DELETE FROM sheet_mirror WHERE seen != ? AND state = ?", (generation, SYNCED)
+            )
+            stats["removed"] = cur.rowcount
+            # 待覆寫的列在 Sheets 中已不存在：改為新增
+            self._conn.execute(
+                "UPDATE sheet_mirror SET row_no = NULL WHERE seen != ? AND state != ? AND row_no IS NOT NULL",
+                (generation, SYNCED),
+            )
+            self._set_meta(generation=generation, synced_rows=stats["rows"],
+                           synced_at=datetime.now(TW_TZ).strftime("%Y-%m-%d %H:%M:%S"))
+            self._conn.commit()
+            self._synced_with = sheets
+
+        log(f"Sheet1 同步完成：{stats['rows']} 列，新增 {stats['new']}、手動修改 {stats['edited']}、"
+            f"手動刪除 {stats['removed']}")
+        if edited:
+            more = f" 等 {len(edited)} 列" if len(edited) > 10 else ""
+            log(f"Sheet1 手動修改的列已採用 Sheets 的內容：{'、'.join(edited[:10])}{more}")
+        return stats
+
+    def _reconcile(self, row: Sequence, row_no: int, generation: int, stats: Dict[str, int], edited: List[str]):
+        """以 Sheets 的一列更新鏡像（呼叫端持有鎖）。"""
+        stock_id, date = str(row[0]), str(row[2])
+        cells = [_cell(row[i]) if len(row) > i else "" for i in (1, 3, 4, 5, 6, 7)]
+        stats["rows"] += 1
+        existing = self._conn.execute(
+            "SELECT name, price, ma5, ma20, ma60, state FROM sheet_mirror WHERE stock_id = ? AND date = ?",
+            (stock_id, date),
+        ).fetchone()
+        if existing is not None and existing[5] != SYNCED:
+            # 本地尚未送出的寫入優先，只更新列號（之前新增其實已送達時改為覆寫，不重複新增）
+            self._conn.execute(
+                "UPDATE sheet_mirror SET row_no = ?, seen = ? WHERE stock_id = ? AND date = ?",
+                (row_no, generation, stock_id, date),
+            )
+            return
+        if existing is None:
+            stats["new"] += 1
+        elif not all(_same(a, b) for a, b in zip(existing[:5], cells[:5])):
+            stats["edited"] += 1
+            edited.append(f"{stock_id} {date}")
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sheet_mirror (stock_id, date, row_no, name, price, ma5, ma20, ma60, ts, state, seen) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (stock_id, date, row_no, *cells, SYNCED, generation),
+        )
+
+    # ---------- 讀取 ----------
+    def rows(self, stock_id: str, start_date: str, end_date: str) -> Dict[str, Tuple[Optional[int], List[str]]]:
+        """區間內每個日期的 (列號, Sheet1 A～H 欄內容)；列號為 None 表示尚未送到 Sheets。"""
+        with self._lock:
+            found = self._conn.execute(
+                f"SELECT date, row_no, {', '.join(_COLUMNS)} FROM sheet_mirror "
+                "WHERE stock_id = ? AND date >= ? AND date <= ?",
+                (stock_id, start_date, end_date),
+            ).fetchall()
+        return {r[0]: (r[1], [stock_id, r[2], r[0], *r[3:]]) for r in found}
+
+    def row_dates(self, stock_ids: Iterable[str]) -> Dict[str, List[Tuple[str, int]]]:
+        """每支股票已在 Sheets 中的 (date, 列號)，供歷史清理使用。"""
+        result: Dict[str, List[Tuple[str, int]]] = {}
+        with self._lock:
+            for stock_id in stock_ids:
+                found = self._conn.execute(
+                    "SELECT date, row_no FROM sheet_mirror WHERE stock_id = ? AND row_no IS NOT NULL",
+                    (stock_id,),
+                ).fetchall()
+                if found:
+                    result[stock_id] = found
+        return result
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sheet_mirror WHERE state != ?", (SYNCED,)).fetchone()[0]
+
+    # ---------- 寫入 ----------
+    def write(self, stock_id: str, stock_name, date: str, price, ma5, ma20, ma60, timestamp):
+        """寫入鏡像並標記待送出；已有列號的覆寫原本的列，否則由 push() 新增。"""
+        cells = [_cell(v) for v in (stock_name, price, ma5, ma20, ma60, timestamp)]
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sheet_mirror (stock_id, date, row_no, name, price, ma5, ma20, ma60, ts, state, seen) "
+                "VALUES (?, ?, NULL, ?, ?, ?, ?, ?, ?, ?, 0) "
+                "ON CONFLICT (stock_id, date) DO UPDATE SET name = excluded.name, price = excluded.price, "
+                "ma5 = excluded.ma5, ma20 = excluded.ma20, ma60 = excluded.ma60, ts = excluded.ts, "
+                "state = excluded.state",
+                (stock_id, date, *cells, PENDING),
+            )
+            self._conn.commit()
+
+    def _mismatched_rows(self, sheets: SheetsGateway, targets: Sequence[Tuple[str, str, int]]) -> List[str]:
+        """讀回 (stock_id, date, 列號) 各列的 A～C 欄，回傳代號或日期與鏡像不符的列（呼叫端不持有鎖）。"""
+        expected = {row_no: (stock_id, date) for stock_id, date, row_no in targets}
+        ranges = sorted(row_ranges(expected))
+        mismatched = []
+        for i in range(0, len(ranges), VERIFY_BATCH_RANGES):
+            part = ranges[i:i + VERIFY_BATCH_RANGES]
+            values = sheets.batch_get([f"{self.sheet_name}!A{start}:C{end}" for start, end in part])
+            for (start, end), cells in zip(part, values):
+                for row_no in range(start, end + 1):
+                    row = cells[row_no - start] if row_no - start < len(cells) else []
+                    found = (_cell(row[0]) if row else "", _cell(row[2]) if len(row) > 2 else "")
+                    if found != expected[row_no]:
+                        mismatched.append(f"第 {row_no} 列（應為 {' '.join(expected[row_no])}）")
+        return mismatched
+
+    def push(self, sheets: SheetsGateway, chunk_rows: int = SYNC_CHUNK_ROWS,
+             log: Callable[[str], None] = print) -> bool:
+        """
+        待送出的列排入 sheets 的寫入佇列後 flush()（連同佇列中其他寫入）；
+        送達的列標記為已同步，新增列依 append 回傳的範圍記下列號。回傳 flush() 的結果。
+        這個閘道沒有 sync() 過時，依列號覆寫前先核對目標列；不符時先完整 sync()。
+        核對失敗時覆寫的列留到下次執行，新增列與其他寫入照常送出。
+        """
+        target = f"{self.sheet_name}!A2"
+        with self._lock:
+            if sheets is not self._gateway:
+                # 換了一個閘道（常駐模式的下一次執行），先前佇列中的寫入已不存在，改回待送出
+                self._conn.execute("UPDATE sheet_mirror SET state = ? WHERE state = ?", (PENDING, QUEUED))
+                self._conn.commit()
+                self._gateway = sheets
+                self._queued_appends = []
+            targets = [] if self._synced_with is sheets else self._conn.execute(
+                "SELECT stock_id, date, row_no FROM sheet_mirror WHERE state = ? AND row_no IS NOT NULL", (PENDING,)
+            ).fetchall()
+
+        verified = True
+        if targets:
+            try:
+                mismatched = self._mismatched_rows(sheets, targets)
+                if mismatched:
+                    more = f" 等 {len(mismatched)} 列" if len(mismatched) > 5 else ""
+                    log(f"{self.sheet_name} 列號與鏡像不符（可能手動排序、插入或刪除列）：{'、'.join(mismatched[:5])}{more}，"
+                        "重新同步後再寫入")
+                    self.sync(sheets, chunk_rows, log)
+            except Exception as e:
+                log(f"{self.sheet_name} 核對列號失敗：{e}，本次只新增列，覆寫留待下次執行")
+                verified = False
+
+        with self._lock:
+            pending = self._conn.execute(
+                f"SELECT stock_id, date, row_no, {', '.join(_COLUMNS)} FROM sheet_mirror WHERE state = ? "
+                + ("" if verified else "AND row_no IS NULL ")
+                + "ORDER BY row_no IS NULL, row_no, stock_id, date",
+                (PENDING,),
+            ).fetchall()
+            for stock_id, date, row_no, name, *rest in pending:
+                values = [[stock_id, name, date, *rest]]
+                if row_no:
+                    sheets.queue_update(f"{self.sheet_name}!A{row_no}:H{row_no}", values)
+                else:
+                    sheets.queue_append(target, values)
+                    self._queued_appends.append((stock_id, date))
+            self._conn.executemany(
+                "UPDATE sheet_mirror SET state = ? WHERE stock_id = ? AND date = ?",
+                [(QUEUED, r[0], r[1]) for r in pending],
+            )
+            self._conn.commit()
+
+        ok = sheets.flush() and verified
+
+        with self._lock:
+            updated_range = sheets.take_appended(target)
+            start = _appended_start(updated_range) if updated_range else None
+            if start is not None and self._queued_appends:
+                self._conn.executemany(
+                    "UPDATE sheet_mirror SET row_no = ?, state = ? WHERE stock_id = ? AND date = ?",
+                    [(start + i, SYNCED, *key) for i, key in enumerate(self._queued_appends)],
+                )
+                self._queued_appends = []
+            if not sheets.pending_updates:
+                self._conn.execute(
+                    "UPDATE sheet_mirror SET state = ? WHERE state = ? AND row_no IS NOT NULL", (SYNCED, QUEUED)
+                )
+            self._conn.commit()
+        return ok
+
+    def apply_deletes(self, row_numbers: Iterable[int]):
+        """Sheets 刪除列之後同步鏡像：移除被刪的列，下方的列號往上遞補。"""
+        with self._lock:
+            for start, end in row_ranges(row_numbers):  # 由下往上，前面的調整不影響後面的範圍
+                self._conn.execute("DELETE FROM sheet_mirror WHERE row_no >= ? AND row_no <= ?", (start, end))
+                self._conn.execute(
+                    "UPDATE sheet_mirror SET row_no = row_no - ? WHERE row_no > ?", (end - start + 1, end)
+                )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Optional[str]]:
+        with self._lock:
+            total, pending = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(state != ?), 0) FROM sheet_mirror", (SYNCED,)
+            ).fetchone()
+            return {"rows": total, "pending": pending, "synced_at": self._meta("synced_at"),
+                    "synced_rows": self._meta("synced_rows")}
+
+
+# ======================== 指令列 ========================
+def main():
+    parser = argparse.ArgumentParser(description="Sheet1 本地鏡像")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="顯示鏡像列數、待送出列數與上次同步時間")
+    args = parser.parse_args()
+
+    mirror = SheetMirror()
+    try:
+        if args.command == "stats":
+            s = mirror.stats()
+            print(f"鏡像 {s['rows']} 列，待送出 {s['pending']} 列；"
+                  f"上次同步 {s['synced_at'] or '（尚未同步）'}（Sheet1 {s['synced_rows'] or 0} 列）")
+    finally:
+        mirror.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Google Sheets 批次存取閘道。
+
+啟動時以一次 values.batchGet 讀取所有需要的範圍，執行期間的寫入先排入佇列，
+結束時合併成一次 values.append（新增列）與 values.batchUpdate（覆寫範圍，每 500 個範圍一次）送出，
+並統計本次執行實際呼叫了幾次 Sheets API（每次呼叫的耗時與傳輸量記入 METRICS）。
+讀取與寫入分別受 QUOTAS 的 sheets.read／sheets.write 每分鐘配額節流，429 時退避後重送。
+刪除列以一次 spreadsheets.batchUpdate 的 deleteDimension 送出，不做整段清除重寫。
+"""
+import json
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from metrics import METRICS
+from quota import QUOTAS, is_rate_limited
+
+BATCH_UPDATE_MAX_RANGES = 500  # 單次 batchUpdate 最多帶幾個範圍，避免請求過大
+MAX_RETRIES = 3                # 被限流時最多重送幾次
+_QUOTA_FOR_STAGE = {"batch_get": "sheets.read", "get": "sheets.read", "metadata": "sheets.read"}  # 其餘為寫入
+
+
+def row_ranges(row_numbers: Iterable[int]) -> List[Tuple[int, int]]:
+    """列號合併成連續範圍 (起始列, 結束列)，由下往上排列。"""
+    ranges: List[Tuple[int, int]] = []
+    for row in sorted(set(row_numbers), reverse=True):
+        if ranges and ranges[-1][0] == row + 1:
+            ranges[-1] = (row, ranges[-1][1])
+        else:
+            ranges.append((row, row))
+    return ranges
+
+
+class SheetsGateway:
+    def __init__(self, service, spreadsheet_id: str, log: Callable[[str], None] = print):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.log = log
+        self.call_count = 0
+        self._cache: Dict[str, List[List]] = {}
+        self._appends: Dict[str, List[List]] = {}
+        self._updates: Dict[str, List[List]] = {}
+        self._sheet_ids: Dict[str, int] = {}
+        self._row_counts: Dict[str, Optional[int]] = {}
+        self._appended: Dict[str, str] = {}  # 範圍 → 最近一次 append 實際寫入的範圍（updatedRange）
+
+    def _execute(self, request, stage: str):
+        quota = _QUOTA_FOR_STAGE.get(stage, "sheets.write")
+        for attempt in range(MAX_RETRIES + 1):
+            self.call_count += 1
+            try:
+                with QUOTAS.slot(quota), METRICS.span(f"sheets.{stage}") as span:
+                    result = request.execute()
+                    body = getattr(request, "body", None) or ""
+                    span.bytes = len(body) + len(json.dumps(result or {}, ensure_ascii=False).encode("utf-8"))
+                return result
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == MAX_RETRIES:
+                    raise
+                METRICS.add_retry(f"sheets.{stage}")
+                self.log(f"Sheets 限流，依配額退避後重試（第 {attempt + 1} 次）")
+
+    # ---------- 讀取 ----------
+    def prefetch(self, ranges: List[str], optional: Iterable[str] = ()):
+        """
+        一次 batchGet 讀取多個範圍，結果供之後的 get() 直接使用。
+        optional 的範圍所在分頁可以不存在：batchGet 因此失敗時去掉它們重讀一次，並視為空白。
+        """
+        ranges = [r for r in dict.fromkeys(ranges) if r not in self._cache]
+        optional = [r for r in dict.fromkeys(optional) if r not in self._cache and r not in ranges]
+        if not ranges and not optional:
+            return
+        try:
+            values = self.batch_get(ranges + optional)
+        except Exception as e:
+            if not optional or "Unable to parse range" not in str(e):
+                raise
+            self.log(f"選用分頁不存在，視為空白：{', '.join(optional)}")
+            values = (self.batch_get(ranges) if ranges else []) + [[] for _ in optional]
+        for requested, rows in zip(ranges + optional, values):
+            self._cache[requested] = rows
+
+    def batch_get(self, ranges: List[str]) -> List[List[List]]:
+        """一次 batchGet 讀取多個範圍（不快取），依 ranges 的順序回傳各範圍的值。"""
+        result = self._execute(
+            self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id,
+                ranges=ranges
+            ),
+            "batch_get",
+        )
+        value_ranges = result.get("valueRanges", [])
+        return [value_ranges[i].get("values", []) if i < len(value_ranges) else [] for i in range(len(ranges))]
+
+    def get(self, range_name: str, refresh: bool = False, cache: bool = True) -> List[List]:
+        """讀取單一範圍；已 prefetch 過的直接回傳快取。cache=False 時不保留結果（分段掃描用）。"""
+        if refresh or range_name not in self._cache:
+            result = self._execute(
+                self.service.spreadsheets().values().get(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=range_name
+                ),
+                "get",
+            )
+            values = result.get("values", [])
+            if not cache:
+                return values
+            self._cache[range_name] = values
+        return self._cache[range_name]
+
+    # ---------- 寫入（延後到 flush） ----------
+    def queue_append(self, range_name: str, rows: List[List]):
+        self._appends.setdefault(range_name, []).extend(rows)
+
+    def queue_update(self, range_name: str, values: List[List]):
+        self._updates[range_name] = values
+
+    @property
+    def pending_rows(self) -> int:
+        return sum(len(rows) for rows in self._appends.values())
+
+    @property
+    def pending_updates(self) -> int:
+        return len(self._updates)
+
+    def flush(self) -> bool:
+        """送出所有排隊中的寫入：每個範圍一次 append，覆寫合併成 batchUpdate；失敗的項目留在佇列。"""
+        ok = True
+        for range_name, rows in list(self._appends.items()):
+            try:
+                result = self._execute(
+                    self.service.spreadsheets().values().append(
+                        spreadsheetId=self.spreadsheet_id,
+                        range=range_name,
+                        valueInputOption="USER_ENTERED",
+                        body={"values": rows}
+                    ),
+                    "append",
+                )
+                self.log(f"Sheets 批次新增成功：{range_name} 共 {len(rows)} 筆")
+                updated_range = ((result or {}).get("updates") or {}).get("updatedRange")
+                if updated_range:
+                    self._appended[range_name] = updated_range
+                del self._appends[range_name]
+            except Exception as e:
+                self.log(f"Sheets 批次新增失敗：{range_name} 共 {len(rows)} 筆：{e}")
+                ok = False
+
+        items = list(self._updates.items())
+        for i in range(0, len(items), BATCH_UPDATE_MAX_RANGES):
+            data = [{"range": r, "values": v} for r, v in items[i:i + BATCH_UPDATE_MAX_RANGES]]
+            try:
+                self._execute(
+                    self.service.spreadsheets().values().batchUpdate(
+                        spreadsheetId=self.spreadsheet_id,
+                        body={"valueInputOption": "USER_ENTERED", "data": data}
+                    ),
+                    "batch_update",
+                )
+                self.log(f"Sheets 批次更新成功：{len(data)} 個範圍")
+                for item in data:
+                    # 只更新讀過的範圍，逐列覆寫不會累積在快取裡
+                    if item["range"] in self._cache:
+                        self._cache[item["range"]] = item["values"]
+                    del self._updates[item["range"]]
+            except Exception as e:
+                self.log(f"Sheets 批次更新失敗：{len(data)} 個範圍：{e}")
+                ok = False
+        return ok
+
+    def take_appended(self, range_name: str) -> Optional[str]:
+        """取出（並清除）range_name 最近一次 append 實際寫入的範圍，例如 Sheet1!A101:H103。"""
+        return self._appended.pop(range_name, None)
+
+    # ---------- 工作表資訊 ----------
+    def _load_properties(self):
+        """一次 spreadsheets.get 取得各工作表的 sheetId 與目前的總列數（含尾端空白列）。"""
+        result = self._execute(
+            self.service.spreadsheets().get(
+                spreadsheetId=self.spreadsheet_id,
+                fields="sheets.properties(sheetId,title,gridProperties.rowCount)"
+            ),
+            "metadata",
+        )
+        for sheet in result.get("sheets", []):
+            props = sheet.get("properties", {})
+            self._sheet_ids[props.get("title")] = props.get("sheetId")
+            self._row_counts[props.get("title")] = (props.get("gridProperties") or {}).get("rowCount")
+
+    def row_count(self, sheet_name: str) -> Optional[int]:
+        """工作表目前的總列數（每次重新查詢，append 會讓它變大）；取不到時為 None。"""
+        self._load_properties()
+        if sheet_name not in self._sheet_ids:
+            raise KeyError(f"找不到工作表：{sheet_name}")
+        return self._row_counts.get(sheet_name)
+
+    # ---------- 刪除列 ----------
+    def _sheet_id(self, sheet_name: str) -> int:
+        if sheet_name not in self._sheet_ids:
+            self._load_properties()
+        if sheet_name not in self._sheet_ids:
+            raise KeyError(f"找不到工作表：{sheet_name}")
+        return self._sheet_ids[sheet_name]
+
+    def delete_rows(self, sheet_name: str, row_numbers: Iterable[int]) -> int:
+        """
+        刪除指定列（列號從 1 起算），回傳刪除的範圍數。
+        連續的列合併成一個 deleteDimension、由下往上排列，後面的刪除不受前面影響；
+        全部放在同一個 batchUpdate，整批成功或整批失敗，不會只刪一半。
+        """
+        if self.pending_updates:
+            raise RuntimeError("尚有排隊中的覆寫，刪除列會讓其列號失效，請先 flush()")
+        rows = set(row_numbers)
+        if not rows:
+            return 0
+        sheet_id = self._sheet_id(sheet_name)
+        ranges = row_ranges(rows)
+        requests = [
+            {"deleteDimension": {"range": {
+                "sheetId": sheet_id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end,
+            }}}
+            for start, end in ranges
+        ]
+        self._execute(
+            self.service.spreadsheets().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={"requests": requests}
+            ),
+            "delete_rows",
+        )
+        self._cache.clear()  # 列號已改變，快取的範圍不再正確
+        self.log(f"Sheets 刪除 {sheet_name} 共 {len(rows)} 列（{len(ranges)} 個範圍）")
+        return len(ranges)
+
+    def report(self, label: Optional[str] = None):
+        self.log(f"{label or '本次執行'} Sheets API 呼叫 {self.call_count} 次")
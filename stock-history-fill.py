@@ -1,16 +1,26 @@
+import logging
 import os
-import re
 from dotenv import load_dotenv
 load_dotenv()
 
 import json
-import time
 from datetime import datetime, timedelta, timezone
-import pandas as pd
 from FinMind.data import DataLoader
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-import gc
+
+from bar_store import BarStore, sync_daily_bars
+from config_cache import ConfigCache
+from indicators import MA_SPECS, compute_indicators, value_at
+from log_config import setup_logging
+from ma_state import MAStateStore, RollingMA
+from market_data import MarketDataLoader
+from metrics import METRICS
+from minute_store import MinuteStore
+from quota import QUOTAS
+from sheet_mirror import SheetMirror
+from sheets_gateway import SheetsGateway
+from trading_calendar import TradingCalendar
 
 # ======================== 環境變數 ========================
 GOOGLE_SHEETS_CREDENTIALS = os.getenv("GOOGLE_SHEETS_CREDENTIALS")
@@ -34,18 +44,21 @@ STOCK_NAME_MAP = {
 
 SHEET_NAME = "Sheet1"
 CONFIG_SHEET_NAME = "Config"
+CONFIG_RANGE = f"{CONFIG_SHEET_NAME}!A2:C"
 
-# 關鍵參數：Render 512MiB 安全設定
+# 關鍵參數：記憶體上限由批次大小決定（Render 512MiB 以預設值即可）
 BATCH_DAYS = 90           # 90天≈63交易日，足以計算MA60
-SLEEP_BETWEEN_STOCKS = 60   # 每支股票處理完休息 60 秒
-SLEEP_BETWEEN_WRITES = 8    # 每寫 8 筆休息一次（防 Google API 限流）
+FILL_CHUNK_STOCKS = int(os.getenv("FILL_CHUNK_STOCKS", "50"))            # 每批處理幾支股票
+FILL_SHEET_CHUNK_ROWS = int(os.getenv("FILL_SHEET_CHUNK_ROWS", "2000"))  # 每次讀取 Sheet1 幾列
+HISTORY_KEEP_ROWS = int(os.getenv("HISTORY_KEEP_ROWS", "0"))            # 每支股票保留幾筆歷史；0 為不清理
 
 # ======================== 工具函式 ========================
-def write_log(msg):
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open("error.log", "a", encoding="utf-8") as f:
-        f.write(f"{now_str} {msg}\n")
-    print(msg)
+logger = setup_logging("history_fill", console_time_format=None)  # 主控台維持只印訊息
+
+
+def write_log(msg, level=logging.INFO, **fields):
+    """寫入 log（背景執行緒寫檔）；fields 為結構化欄位，例如 stock_id、stage、duration。"""
+    logger.log(level, msg, extra={"fields": fields} if fields else None)
 
 def get_sheets_service():
     try:
@@ -59,224 +72,168 @@ def get_sheets_service():
         write_log("✅ Google Sheets 連線成功")
         return service
     except Exception as e:
-        write_log(f"⚠️ Google Sheets 連線失敗：{e}")
+        write_log(f"⚠️ Google Sheets 連線失敗：{e}", level=logging.WARNING)
         return None
 
-def load_stock_list_from_sheets(service):
-    """從 Config 分頁讀取股票清單（C欄=Y 才納入），失敗時回傳 None 使用預設清單。"""
-    if not service:
+def load_stock_list_from_sheets(sheets: SheetsGateway, cache: ConfigCache):
+    """從 Config 分頁讀取股票清單（C欄=Y 才納入，經推播程式共用的本地快取），失敗時回傳 None 使用預設清單。"""
+    if not sheets:
         return None, None
-    try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{CONFIG_SHEET_NAME}!A2:C"
-        ).execute()
-        rows = result.get("values", [])
-        if not rows:
-            write_log("Config 分頁無資料，使用預設清單")
-            return None, None
-
-        stock_list = []
-        stock_name_map = {}
-
-        for row in rows:
-            if not row or not str(row[0]).strip():
-                continue
-            stock_id = str(row[0]).strip().upper()
-            stock_name = str(row[1]).strip() if len(row) > 1 and row[1] else stock_id
-            enabled = str(row[2]).strip().upper() if len(row) > 2 and row[2] else "Y"
-
-            if enabled != "Y":
-                continue
-            if not re.match(r'^[0-9]{4,6}[A-Z]?$', stock_id):
-                write_log(f"⚠️ 代號格式錯誤，跳過：{stock_id}")
-                continue
-            if stock_id in stock_name_map:
-                continue
-
-            stock_list.append(stock_id)
-            stock_name_map[stock_id] = stock_name
-
-        write_log(f"從 Config 分頁載入 {len(stock_list)} 支股票：{stock_list}")
-        return stock_list, stock_name_map
-    except Exception as e:
-        write_log(f"讀取 Config 分頁失敗：{e}，使用預設清單")
+    loaded = cache.load(sheets, CONFIG_RANGE)
+    watchlist = loaded.value
+    if watchlist is None:
+        write_log(f"讀取 Config 分頁失敗：{loaded.error}，使用預設清單", level=logging.WARNING)
         return None, None
+    if loaded.status == "stale":
+        write_log(f"讀取 Config 分頁失敗：{loaded.error}，沿用上次快取的股票清單", level=logging.WARNING)
+    if not watchlist.rows:
+        write_log("Config 分頁無資料，使用預設清單")
+        return None, None
+    if loaded.status == "changed":
+        for stock_id in watchlist.invalid:
+            write_log(f"⚠️ 代號格式錯誤，跳過：{stock_id}", level=logging.WARNING)
 
+    write_log(f"從 Config 分頁載入 {len(watchlist.stock_ids)} 支股票：{watchlist.stock_ids}")
+    return watchlist.stock_ids, watchlist.names
 
-def load_history_from_sheets(service, stock_id=None):
-    if not service:
-        return []
-    try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2:H"
-        ).execute()
-        values = result.get("values", [])
-        history = []
-        for row in values:
-            if len(row) >= 4 and (stock_id is None or row[0] == stock_id):
-                try:
-                    price = float(row[3]) if row[3] else None
-                except:
-                    price = None
-                history.append({
-                    "date": row[2],
-                    "price": price,
-                    "ma5": row[4] if len(row) > 4 else None,
-                    "ma20": row[5] if len(row) > 5 else None,
-                    "ma60": row[6] if len(row) > 6 else None,
-                    "timestamp": row[7] if len(row) > 7 else row[2]
-                })
-        return history
-    except Exception as e:
-        write_log(f"讀取 Sheets 失敗：{e}")
-        return []
 
-def update_row_in_sheets(service, stock_id, date, stock_name, price, ma5, ma20, ma60, timestamp):
+def _row_complete(row):
+    """價格、MA5、MA20 都有值的列視為已完整，不再覆寫。"""
     try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2:H"
-        ).execute()
-        values = result.get("values", [])
-        for idx, row in enumerate(values):
-            if len(row) > 2 and row[0] == stock_id and row[2] == date:
-                update_range = f"{SHEET_NAME}!A{idx+2}:H{idx+2}"
-                update_values = [[stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp]]
-                service.spreadsheets().values().update(
-                    spreadsheetId=GOOGLE_SHEET_ID,
-                    range=update_range,
-                    valueInputOption="USER_ENTERED",
-                    body={"values": update_values}
-                ).execute()
-                write_log(f"{stock_id} 覆蓋 Sheets 成功：{date} - {price if price else 'None'}")
-                return True
-        # 沒找到就新增
-        values = [[stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp]]
-        service.spreadsheets().values().append(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2",
-            valueInputOption="USER_ENTERED",
-            body={"values": values}
-        ).execute()
-        write_log(f"{stock_id} 新增 Sheets 成功：{date} - {price if price else 'None'}")
-        return True
-    except Exception as e:
-        write_log(f"{stock_id} 更新/新增 Sheets 失敗：{e}")
-        return False
-
-def calculate_ma(prices, window):
-    if len(prices) < window:
-        return None
-    return pd.Series(prices).rolling(window).mean().iloc[-1]
-
-def trim_history_to_limit(service, stock_id, limit=500):
-    if not service:
+        price = float(row[3]) if len(row) > 3 and row[3] else None
+    except ValueError:
+        price = None
+    return price is not None and all(len(row) > i and row[i] not in ("", "無資料") for i in (4, 5))
+
+
+def rows_to_trim(row_dates, keep):
+    """每支股票依日期保留最新 keep 筆，回傳其餘的列號。"""
+    doomed = []
+    for items in row_dates.values():
+        if len(items) > keep:
+            items.sort()
+            doomed.extend(row_no for _, row_no in items[:-keep])
+    return doomed
+
+
+def trim_history(sheets: SheetsGateway, mirror: SheetMirror, stock_ids, keep):
+    """
+    依本地鏡像的列號，一次刪除所有股票超出 keep 筆的舊列（deleteDimension，不清除重寫），
+    再把鏡像的列號往上遞補；仍有未送出的寫入時不刪除。
+    """
+    doomed = rows_to_trim(mirror.row_dates(stock_ids), keep)
+    if not doomed:
+        return
+    if sheets.pending_rows or sheets.pending_updates or mirror.pending:
+        write_log("尚有未送出的 Sheets 寫入，本次略過歷史清理", level=logging.WARNING)
         return
     try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2:H"
-        ).execute()
-        values = result.get("values", [])
-        stock_rows = [row for row in values if len(row) > 0 and row[0] == stock_id]
-        if len(stock_rows) <= limit:
-            return
-        # 保留最新的 limit 筆
-        keep_rows = stock_rows[-limit:]
-        keep_dates = {row[2] for row in keep_rows}
-        new_values = [row for row in values if len(row) == 0 or row[0] != stock_id or row[2] in keep_dates]
-        service.spreadsheets().values().clear(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2:H",
-            body={}
-        ).execute()
-        if new_values:
-            service.spreadsheets().values().update(
-                spreadsheetId=GOOGLE_SHEET_ID,
-                range=f"{SHEET_NAME}!A2",
-                valueInputOption="USER_ENTERED",
-                body={"values": new_values}
-            ).execute()
-        write_log(f"{stock_id} 清理完成，保留最新 {len(keep_rows)} 筆")
+        sheets.delete_rows(SHEET_NAME, doomed)
+        mirror.apply_deletes(doomed)
+        write_log(f"歷史清理完成：每支股票保留最新 {keep} 筆，共刪除 {len(doomed)} 列")
     except Exception as e:
-        write_log(f"{stock_id} 清理歷史資料失敗：{e}")
+        write_log(f"歷史清理失敗：{e}", level=logging.WARNING)
 
 # ======================== 主補齊函式 ========================
-def fill_missing_history(service, dl, stock_list, stock_name_map):
-    tz = timezone(timedelta(hours=8))
-    now = datetime.now(tz)
-    end_date = now.strftime("%Y-%m-%d")
-
-    for stock_id in stock_list:
-        stock_name = stock_name_map.get(stock_id, stock_id)
-        write_log(f"開始處理 {stock_id} ({stock_name})")
-
-        # 讀取目前歷史（只用來比對）
-        history = load_history_from_sheets(service, stock_id)
-        history_map = {h["date"]: h for h in history}
+def fill_stock(mirror: SheetMirror, loader, store, ma_states, stock_id, stock_name, start_date, end_date, now):
+    """補齊單一股票：同步日 K、計算均線，鏡像中缺少或不完整的日期寫入鏡像待送出；回傳寫入筆數。"""
+    write_log(f"開始處理 {stock_id} ({stock_name})")
+    write_log(f"{stock_id} 下載範圍：{start_date} ~ {end_date}", stock_id=stock_id)
 
-        # 只下載最近 BATCH_DAYS 天
-        start_date = (now - timedelta(days=BATCH_DAYS)).strftime("%Y-%m-%d")
-        write_log(f"{stock_id} 下載範圍：{start_date} ~ {end_date}")
-
-        try:
-            df = dl.taiwan_stock_daily(stock_id, start_date=start_date, end_date=end_date)
-        except Exception as e:
-            write_log(f"{stock_id} FinMind 取得歷史資料失敗：{e}，跳過")
-            continue
-
-        if df.empty:
-            write_log(f"{stock_id} 最近 {BATCH_DAYS} 天無資料，跳過")
+    try:
+        bars = sync_daily_bars(
+            store, stock_id, start_date, end_date,
+            fetch_daily=loader.daily,
+            now=now,
+        )
+    except Exception as e:
+        write_log(f"{stock_id} FinMind 取得歷史資料失敗：{e}，跳過", stock_id=stock_id, level=logging.WARNING)
+        return 0
+
+    if not bars:
+        write_log(f"{stock_id} 最近 {BATCH_DAYS} 天無資料，跳過", stock_id=stock_id)
+        return 0
+
+    closes = [b["close"] for b in bars]
+    # 一次算出所有日期的 MA5/20/60
+    ma = compute_indicators({"close": closes}, MA_SPECS)
+
+    # 以整段重算的結果檢查推播程式累計的均線狀態，並以這次的日 K 重建
+    state = ma_states.load(stock_id)
+    covered = [b for b in bars if state is not None and b["date"] <= state.last_date]
+    if covered and covered[-1]["date"] == state.last_date and len(covered) >= state.count:
+        problems = state.check(covered)
+        if problems:
+            write_log(f"{stock_id} 均線狀態與重算不一致：{'；'.join(problems)}，已重建",
+                      stock_id=stock_id, level=logging.WARNING)
+    ma_states.save_many({stock_id: RollingMA.from_bars(bars)})
+
+    existing = mirror.rows(stock_id, start_date, end_date)
+    updated = 0
+    for i, bar in enumerate(bars):
+        date = bar["date"]
+        if date in existing and _row_complete(existing[date][1]):
             continue
+        mirror.write(
+            stock_id, stock_name, date, closes[i],
+            value_at(ma["ma5"], i), value_at(ma["ma20"], i), value_at(ma["ma60"], i),
+            f"{date} 00:00:00",
+        )
+        updated += 1
 
-        dates = df["date"].tolist()
-        closes = df["close"].tolist()
-
-        updated = 0
-        for i, date in enumerate(dates):
-            price = closes[i]
-
-            ma5  = calculate_ma(closes[:i+1], 5)   if i+1 >= 5  else None
-            ma20 = calculate_ma(closes[:i+1], 20)  if i+1 >= 20 else None
-            ma60 = calculate_ma(closes[:i+1], 60)  if i+1 >= 60 else None
-
-            timestamp = f"{date} 00:00:00"
-
-            exist = history_map.get(date)
-            need_update = True
-
-            if exist:
-                if all([
-                    exist.get("price") not in (None, '', 'None'),
-                    exist.get("ma5")  not in (None, '', '無資料'),
-                    exist.get("ma20") not in (None, '', '無資料'),
-                ]):
-                    need_update = False
-
-            if need_update:
-                success = update_row_in_sheets(
-                    service, stock_id, date, stock_name, price, ma5, ma20, ma60, timestamp
-                )
-                if success:
-                    updated += 1
-
-            # 每寫幾筆休息一下
-            if (i + 1) % SLEEP_BETWEEN_WRITES == 0:
-                time.sleep(5)
+    write_log(f"{stock_id} 本次完成：排入更新/補齊 {updated} 筆（最近 {BATCH_DAYS} 天）", stock_id=stock_id)
+    return updated
 
-        write_log(f"{stock_id} 本次完成：更新/補齊 {updated} 筆（最近 {BATCH_DAYS} 天）")
 
-        # 強制釋放記憶體
-        del df, dates, closes
-        gc.collect()
+def fill_missing_history(sheets: SheetsGateway, mirror: SheetMirror, dl, store, stock_list, stock_name_map):
+    """
+    串流補齊：先把 Sheet1 同步到本地鏡像（本次唯一一次讀取 Sheet1），再每 FILL_CHUNK_STOCKS 支股票一批
+    抓日 K → 算均線 → 寫入鏡像並送出這批的寫入；FinMind 請求依每小時配額節流，不再固定休息。
+    """
+    tz = timezone(timedelta(hours=8))
+    now = datetime.now(tz)
+    end_date = now.strftime("%Y-%m-%d")
+    start_date = (now - timedelta(days=BATCH_DAYS)).strftime("%Y-%m-%d")
 
-        # 每支股票處理完休息
-        time.sleep(SLEEP_BETWEEN_STOCKS)
+    try:
+        with METRICS.span("stage.sheets_sync"):
+            mirror.sync(sheets, FILL_SHEET_CHUNK_ROWS, log=write_log)
+    except Exception as e:
+        write_log(f"讀取 Sheets 失敗：{e}，結束補齊", level=logging.WARNING)
+        return
 
-        # 可選：清理舊資料（建議先註解，等資料補齊再開啟）
-        # trim_history_to_limit(service, stock_id, limit=500)
+    loader = MarketDataLoader(dl, log=write_log)  # FinMind 請求依 QUOTAS 每小時配額節流
+    calendar = TradingCalendar(store.path)
+    ma_states = MAStateStore(store.path)
+    try:
+        for i in range(0, len(stock_list), FILL_CHUNK_STOCKS):
+            chunk = stock_list[i:i + FILL_CHUNK_STOCKS]
+            # 這批缺的近幾天日 K 先以全市場單日查詢補齊（已查過的日期不重複請求）；
+            # 交易日曆（由推播程式維護）確定休市的日子不發請求
+            try:
+                loader.prefetch(chunk, store, start_date, end_date, now=now,
+                                is_trading_day=calendar.is_trading_day)
+            except Exception as e:
+                write_log(f"日 K 預先批次抓取失敗：{e}，改為逐檔查詢", level=logging.WARNING)
+
+            for stock_id in chunk:
+                fill_stock(mirror, loader, store, ma_states, stock_id,
+                           stock_name_map.get(stock_id, stock_id), start_date, end_date, now)
+
+            # 每批處理完就送出寫入並釋放這批的日 K，記憶體上限由批次大小決定
+            loader.release(chunk)
+            with METRICS.span("stage.sheets_flush"):
+                mirror.push(sheets, FILL_SHEET_CHUNK_ROWS, log=write_log)
+    finally:
+        calendar.close()
+        ma_states.close()
+
+    finmind_quota = QUOTAS.bucket("finmind")
+    if finmind_quota.waited:
+        write_log(f"FinMind 配額節流共等待 {finmind_quota.waited:.1f} 秒")
+
+    if HISTORY_KEEP_ROWS > 0:
+        trim_history(sheets, mirror, stock_list, HISTORY_KEEP_ROWS)
 
 # ======================== 主程式 ========================
 def main():
@@ -289,11 +246,39 @@ def main():
     dl = DataLoader()
     dl.login_by_token(FINMIND_TOKEN)
 
-    sheets_stock_list, sheets_stock_name_map = load_stock_list_from_sheets(service)
+    # Sheet1 不整份讀入，由 fill_missing_history 分段同步到本地鏡像
+    sheets = SheetsGateway(service, GOOGLE_SHEET_ID, log=write_log)
+    config_cache = ConfigCache()
+    try:
+        sheets_stock_list, sheets_stock_name_map = load_stock_list_from_sheets(sheets, config_cache)
+    finally:
+        config_cache.close()
     active_stock_list = sheets_stock_list if sheets_stock_list else STOCK_LIST
     active_stock_name_map = sheets_stock_name_map if sheets_stock_name_map else STOCK_NAME_MAP
 
-    fill_missing_history(service, dl, active_stock_list, active_stock_name_map)
+    store = BarStore()
+    mirror = SheetMirror(store.path, SHEET_NAME)
+    try:
+        with METRICS.span("stage.fill"):
+            fill_missing_history(sheets, mirror, dl, store, active_stock_list, active_stock_name_map)
+        # 每批已送出寫入，這裡只重送先前失敗留在佇列的項目；仍失敗的列留在鏡像，下次執行再送
+        with METRICS.span("stage.sheets_flush"):
+            mirror.push(sheets, FILL_SHEET_CHUNK_ROWS, log=write_log)
+    finally:
+        mirror.close()
+        store.close()
+
+    # 補齊每天收盤後執行一次，順便清掉舊的盤中分鐘價
+    minutes = MinuteStore()
+    try:
+        pruned = minutes.prune()
+        if pruned:
+            write_log(f"已清除 {pruned} 筆舊的盤中分鐘價")
+    finally:
+        minutes.close()
+
+    sheets.report()
+    METRICS.report(write_log, "補齊歷史")
 
     write_log("=== 補齊流程結束 ===")
 
@@ -1,20 +1,38 @@
+import argparse
+import logging
 import os
-import re
+import signal
+import zlib
 from dotenv import load_dotenv
 load_dotenv()
 
 import json
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
-import pandas as pd
-from FinMind.data import DataLoader
-import requests
-import yfinance as yf
 import time
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+# pandas、FinMind、yfinance、googleapiclient 等重量級套件一律在第一次使用時才 import，
+# 讓盤前／非交易日的提早結束不必付出載入成本（見 tools/startup_benchmark.py）
+from bar_store import MARKET_CLOSE_HOUR, BarStore, sync_daily_bars
+from config_cache import ConfigCache
+from discord_sender import DiscordSender
+from hedged_fetch import hedged_race, summarize as summarize_price_race
+from log_config import forward_logging, process_log_queue, setup_logging
+from ma_state import MAStateStore, update_state
+from market_data import MarketDataLoader
+from market_map import MarketMap
+from metrics import METRICS
+from minute_store import MinuteStore, finmind_rows
+from push_state import ChangeDetector, PushSnapshot, PushStateStore
+from quota import QUOTAS
+from rules import BASE_COLUMNS as RULE_COLUMNS, DEFAULT_RULES, RuleEngine, RuleSet, parse_rules, restore_rules
+from sheet_mirror import SheetMirror
+from sheets_gateway import SheetsGateway
+from trading_calendar import TradingCalendar
 
 # ======================== 環境變數 ========================
 GOOGLE_SHEETS_CREDENTIALS = os.getenv("GOOGLE_SHEETS_CREDENTIALS")
@@ -29,6 +47,10 @@ if not all([GOOGLE_SHEETS_CREDENTIALS, GOOGLE_SHEET_ID, FINMIND_TOKEN]):
 STOCK_LIST = ["2330", "6770", "3481", "2337", "2344", "2409", "2367", "3374", "3324", "00642U", "0050", "2231"]
 SHEET_NAME = "Sheet1"
 CONFIG_SHEET_NAME = "Config"  # Google Sheets 股票清單分頁名稱
+CONFIG_RANGE = f"{CONFIG_SHEET_NAME}!A2:C"
+COUNT_RANGE = f"{SHEET_NAME}!J1:K1"  # J1: 日期, K1: 計數
+RULES_SHEET_NAME = "Rules"  # 自訂建議規則分頁（選用，見 rules.py）
+RULES_RANGE = f"{RULES_SHEET_NAME}!A2:E"
 
 STOCK_NAME_MAP = {
     "2330": "台積電",
@@ -45,9 +67,43 @@ STOCK_NAME_MAP = {
     "2231": "為升"
 }
 
+# 抓取階段並行設定：整體執行緒上限 + 各資料來源同時連線上限（避免被限流）
+FETCH_MAX_WORKERS = int(os.getenv("FETCH_MAX_WORKERS", "8"))
+PROVIDER_CONCURRENCY = {
+    "finmind": int(os.getenv("FINMIND_CONCURRENCY", "4")),
+    "yfinance": int(os.getenv("YFINANCE_CONCURRENCY", "2")),
+}
+# 最新價避險：FinMind 超過幾秒仍未回應就同時啟動 yfinance 批次備援（設為 off 則依序：FinMind 全部失敗才用 yfinance）
+_hedge = os.getenv("PRICE_HEDGE_DELAY", "3").strip().lower()
+PRICE_HEDGE_DELAY = None if _hedge in ("", "off", "none") else float(_hedge)
+# 分片模式：清單分給 NOTIFY_SHARDS 個 worker 程序抓取與計算（1 為不分片）
+NOTIFY_SHARDS = max(1, int(os.getenv("NOTIFY_SHARDS", "1")))
+
+
+def _make_provider_semaphores(shards: int = 1) -> Dict[str, threading.BoundedSemaphore]:
+    """各來源連線上限依程序數平分：分片 worker 各拿 1/shards（至少 1 條），全部 worker 合計不超過設定值。"""
+    return {
+        name: threading.BoundedSemaphore(max(1, limit // shards))
+        for name, limit in PROVIDER_CONCURRENCY.items()
+    }
+
+
+_provider_semaphores = _make_provider_semaphores()
+
+
+@contextmanager
+def provider_slot(provider: str):
+    """先依配額取得請求額度，再取得連線名額（等待配額時不佔連線）；被限流時由配額桶退避。"""
+    sem = _provider_semaphores[provider]
+    with QUOTAS.slot(provider), sem:
+        yield
+
 # ==========================================================
 def get_sheets_service():
     try:
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
+
         creds_json = GOOGLE_SHEETS_CREDENTIALS
         credentials_info = json.loads(creds_json)
         credentials = service_account.Credentials.from_service_account_info(
@@ -58,143 +114,161 @@ def get_sheets_service():
         write_log("✅ Google Sheets 連線成功")
         return service
     except Exception as e:
-        write_log(f"⚠️ Google Sheets 連線失敗：{e}")
+        write_log(f"⚠️ Google Sheets 連線失敗：{e}", level=logging.WARNING)
         return None
 
 
-def load_stock_list_from_sheets(service):
-    """從 Config 分頁讀取股票清單，含格式驗證。失敗時回傳 None 使用預設清單。"""
-    if not service:
+def load_stock_list_from_sheets(sheets: SheetsGateway, cache: ConfigCache):
+    """
+    從 Config 分頁讀取股票清單（經本地快取，見 config_cache.py），含格式驗證。失敗時回傳 None 使用預設清單。
+    內容未變更時沿用上次解析結果；格式錯誤的 Discord 警告同一份內容只送一次。
+    """
+    if not sheets:
+        return None, None
+    loaded = cache.load(sheets, CONFIG_RANGE)
+    watchlist = loaded.value
+    if watchlist is None:
+        write_log(f"讀取 Config 分頁失敗：{loaded.error}，使用預設清單", level=logging.WARNING)
+        return None, None
+    if loaded.status == "fresh":
+        write_log("Config 快取未過期，沿用上次股票清單")
+    elif loaded.status == "unchanged":
+        write_log("Config 分頁未變更，沿用上次股票清單")
+    elif loaded.status == "stale":
+        write_log(f"讀取 Config 分頁失敗：{loaded.error}，沿用上次快取的股票清單", level=logging.WARNING)
+    else:
+        for stock_id, enabled in watchlist.disabled:
+            write_log(f"{stock_id} 啟用欄為 {enabled}，跳過", stock_id=stock_id)
+        for stock_id in watchlist.invalid:
+            write_log(f"⚠️ 代號格式錯誤，跳過：{stock_id}", level=logging.WARNING)
+        for stock_id in watchlist.duplicates:
+            write_log(f"⚠️ 代號重複，跳過：{stock_id}")
+
+    if not watchlist.rows:
+        write_log("Config 分頁無資料，使用預設清單")
         return None, None
-    try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{CONFIG_SHEET_NAME}!A2:C"
-        ).execute()
-        rows = result.get("values", [])
-        if not rows:
-            write_log("Config 分頁無資料，使用預設清單")
-            return None, None
-
-        stock_list = []
-        stock_name_map = {}
-        invalid = []
-
-        for row in rows:
-            if not row or not str(row[0]).strip():
-                continue
-            stock_id = str(row[0]).strip().upper()
-            stock_name = str(row[1]).strip() if len(row) > 1 and row[1] else stock_id
-            enabled = str(row[2]).strip().upper() if len(row) > 2 and row[2] else "Y"
-
-            if enabled != "Y":
-                write_log(f"{stock_id} 啟用欄為 {enabled}，跳過")
-                continue
-
-            if not re.match(r'^[0-9]{4,6}[A-Z]?$', stock_id):
-                invalid.append(stock_id)
-                write_log(f"⚠️ 代號格式錯誤，跳過：{stock_id}")
-                continue
-
-            if stock_id in stock_name_map:
-                write_log(f"⚠️ 代號重複，跳過：{stock_id}")
-                continue
-
-            stock_list.append(stock_id)
-            stock_name_map[stock_id] = stock_name
 
-        if invalid:
+    # 同一份 Config 內容只警告一次，不再每次執行重複推送
+    if (watchlist.invalid or not watchlist.stock_ids) and cache.needs_warning(CONFIG_RANGE, loaded.fingerprint):
+        if watchlist.invalid:
             send_discord_push(
-                f"⚠️ **Config 分頁有 {len(invalid)} 筆代號格式錯誤，已跳過**\n"
-                f"錯誤代號：{', '.join(invalid)}\n"
+                f"⚠️ **Config 分頁有 {len(watchlist.invalid)} 筆代號格式錯誤，已跳過**\n"
+                f"錯誤代號：{', '.join(watchlist.invalid)}\n"
                 f"格式說明：4～6 碼數字，可接一個英文字母（例：2330、00642U）"
             )
-
-        if not stock_list:
+        if not watchlist.stock_ids:
             send_discord_push("⚠️ **Config 分頁所有代號均無效，改用程式內建預設清單**")
-            return None, None
+        cache.mark_warned(CONFIG_RANGE, loaded.fingerprint)
 
-        write_log(f"從 Config 分頁載入 {len(stock_list)} 支股票：{stock_list}")
-        return stock_list, stock_name_map
-    except Exception as e:
-        write_log(f"讀取 Config 分頁失敗：{e}，使用預設清單")
+    if not watchlist.stock_ids:
         return None, None
 
+    if loaded.status == "changed":
+        write_log(f"從 Config 分頁載入 {len(watchlist.stock_ids)} 支股票：{watchlist.stock_ids}")
+    return watchlist.stock_ids, watchlist.names
+
+
+_discord_sender: Optional[DiscordSender] = None
 
-def try_yfinance(stock_id: str, suffix: str):
-    """用指定後綴向 yfinance 取得價格，含 rate limit retry。"""
-    tw_symbol = f"{stock_id}.{suffix}"
-    for attempt in range(3):
-        try:
-            ticker = yf.Ticker(tw_symbol)
-            hist = ticker.history(period="1d", interval="1m")
-            if not hist.empty:
-                latest = hist.iloc[-1]
-                price = float(latest["Close"])
-                time_str = latest.name.strftime("%Y-%m-%d %H:%M:%S")
-                write_log(f"{stock_id} yfinance 取得最新分鐘價（.{suffix}）：{price:.2f} @ {time_str}")
-                return {"price": price, "time": time_str, "source": "today_yfinance", "is_latest": True, "finmind_success": False}
-
-            hist_daily = ticker.history(period="5d")
-            if not hist_daily.empty:
-                latest = hist_daily.iloc[-1]
-                price = float(latest["Close"])
-                date_str = latest.name.strftime("%Y-%m-%d")
-                write_log(f"{stock_id} yfinance 取得最近日收盤價（.{suffix}）：{price:.2f} ({date_str})")
-                return {"price": price, "time": date_str, "source": "previous_yfinance", "is_latest": False, "finmind_success": False}
-
-            return None  # 無資料，換後綴試試
-        except Exception as e:
-            if "Too Many Requests" in str(e) or "Rate limited" in str(e):
-                if attempt < 2:
-                    write_log(f"{stock_id} yfinance rate limit（.{suffix}），等 3 秒後重試（第 {attempt + 1} 次）")
-                    time.sleep(3)
-                else:
-                    write_log(f"{stock_id} yfinance 備援失敗（.{suffix}）：{e}")
-                    return None
-            else:
-                write_log(f"{stock_id} yfinance 異常（.{suffix}）：{e}")
-                return None
-    return None
+
+def get_discord_sender() -> DiscordSender:
+    """整個程式共用一個 sender（同一個 requests.Session 與限流狀態）。"""
+    global _discord_sender
+    if _discord_sender is None:
+        _discord_sender = DiscordSender(DISCORD_WEBHOOK_URL, log=write_log)
+    return _discord_sender
 
 
 def send_discord_push(message: str):
-    if not DISCORD_WEBHOOK_URL:
-        write_log("未設定 DISCORD_WEBHOOK_URL，無法推播 Discord。")
+    """立即送出一則訊息（警告類通知用）。"""
+    get_discord_sender().send(message)
+
+
+def queue_discord_push(message: str):
+    """排入推播佇列，由 flush_discord_pushes() 合併後依序送出。"""
+    get_discord_sender().queue(message)
+
+
+def flush_discord_pushes() -> bool:
+    sender = get_discord_sender()
+    ok = sender.flush()
+    write_log(f"Discord 推播送出 {sender.post_count} 次請求，遭限流 {sender.rate_limited_count} 次")
+    return ok
+
+
+def detect_change(detector: ChangeDetector, unchanged: List[str], stock_id: str, stock_name: str,
+                  snapshot: PushSnapshot) -> bool:
+    """與上次推播相比有明顯變化時回傳 True；否則記入「無明顯變化」摘要並回傳 False。"""
+    reason = detector.check(stock_id, snapshot)
+    if reason is None:
+        unchanged.append(f"{stock_id} {stock_name} {snapshot.price:.2f}")
+        write_log(f"{stock_id} 與上次推播相比無明顯變化，略過完整區塊", stock_id=stock_id)
+        return False
+    write_log(f"{stock_id} 推播原因：{reason}", stock_id=stock_id)
+    return True
+
+
+logger = setup_logging("notify")
+
+
+def write_log(msg, level=logging.INFO, **fields):
+    """寫入 log（背景執行緒寫檔）；fields 為結構化欄位，例如 stock_id、stage、duration。"""
+    logger.log(level, msg, extra={"fields": fields} if fields else None)
+
+
+# ======================== 交易日判斷 ========================
+def refresh_trading_calendar(calendar: TradingCalendar, loader: MarketDataLoader, store: BarStore, today: str):
+    """今天不在本地交易日曆中時，向 FinMind 載入今年日曆（每天最多一次）；失敗則由日 K 快取推導。"""
+    if not calendar.needs_refresh(today):
         return
-    data = {"content": message}
     try:
-        resp = requests.post(DISCORD_WEBHOOK_URL, json=data, timeout=10)
-        if resp.status_code != 204:
-            write_log(f"Discord 推播失敗，狀態碼：{resp.status_code}，回應：{resp.text}")
-        else:
-            write_log("Discord 推播成功")
+        if calendar.refresh_year(int(today[:4]), loader.trading_dates, today):
+            write_log(f"交易日曆已更新（FinMind）：{today[:4]} 年")
     except Exception as e:
-        write_log(f"Discord 推播失敗：{e}")
+        write_log(f"交易日曆載入失敗：{e}，改由日 K 快取推導", level=logging.WARNING)
+    if not calendar.covers(today):
+        calendar.learn_from_store(store, today)
 
 
-def write_log(msg):
-    now_str = datetime.now().strftime('%Y年%m月%d日 %H時%M分%S秒')
-    with open("error.log", "a", encoding="utf-8") as f:
-        f.write(f"{now_str} {msg}\n")
-    print(f"{now_str} {msg}")
+def refresh_market_map(markets: MarketMap, loader: MarketDataLoader, today: str):
+    """上市／上櫃對照表每 MARKET_MAP_REFRESH_DAYS 天由 FinMind TaiwanStockInfo 整批更新一次。"""
+    if not markets.needs_refresh(today):
+        return
+    try:
+        count = markets.refresh(loader.stock_info, today)
+        write_log(f"上市／上櫃對照表已更新：{count} 筆")
+    except Exception as e:
+        write_log(f"上市／上櫃對照表更新失敗：{e}，沿用既有對照與 yfinance 探測結果", level=logging.WARNING)
 
 
-# ======================== 交易日判斷 ========================
-def is_trading_day(dl: DataLoader, check_date: str, is_after_close: bool) -> bool:
+def is_trading_day(calendar: TradingCalendar, loader: MarketDataLoader, check_date: str,
+                   is_after_close: bool) -> bool:
     """
     判斷指定日期是否為台股交易日
-    - 盤後：優先檢查當天是否有日K資料
+    - 本地交易日曆有涵蓋該日期時直接查表，不發出任何請求
+    - 盤後：優先檢查當天是否有日K資料（全市場單日查詢，結果同時供後續整份清單使用）
     - 盤中：檢查昨天是否有交易資料（用來推估今天是否可能開盤）
+    FinMind 探測到開盤時記入交易日曆，同一時段之後的執行不再探測（盤中推估的結果盤後仍會以日 K 確認一次）。
     """
+    answer = calendar.is_trading_day(check_date)
+    if answer is not None:
+        write_log(f"交易日曆：{check_date} {'為交易日' if answer else '休市'}")
+        return answer
+    if calendar.probed_open(check_date, is_after_close):
+        write_log(f"交易日曆：{check_date} 稍早已確認為交易日")
+        return True
+
     symbol_for_check = "2330"  # 使用台積電作為代表股票
 
     try:
         if is_after_close:
             # 盤後：檢查今天是否有日K資料
-            df = dl.taiwan_stock_daily(symbol_for_check, start_date=check_date, end_date=check_date)
+            df = loader.market_day(check_date)
+            if df is None:
+                df = loader.daily(symbol_for_check, check_date, check_date)
             if not df.empty:
                 write_log(f"盤後檢查：{check_date} 有日K資料，視為交易日")
+                calendar.record_open(check_date, after_close=True)
                 return True
             else:
                 write_log(f"盤後檢查：{check_date} 無日K資料，視為非交易日")
@@ -203,40 +277,51 @@ def is_trading_day(dl: DataLoader, check_date: str, is_after_close: bool) -> boo
             # 盤中：查最近 7 天內是否有交易資料（避免週一查到週日誤判休市）
             start = (datetime.strptime(check_date, "%Y-%m-%d") - timedelta(days=7)).strftime("%Y-%m-%d")
             yesterday = (datetime.strptime(check_date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
-            df = dl.taiwan_stock_daily(symbol_for_check, start_date=start, end_date=yesterday)
+            df = loader.daily(symbol_for_check, start, yesterday)
             if not df.empty:
                 write_log(f"盤中檢查：最近 7 天內有交易資料，今天很可能為交易日")
+                calendar.record_open(check_date, after_close=False)
                 return True
             else:
                 write_log(f"盤中檢查：最近 7 天內無交易資料，今天很可能休市")
                 return False
     except Exception as e:
-        write_log(f"交易日檢查 FinMind 失敗：{e}，改用 yfinance 確認")
+        write_log(f"交易日檢查 FinMind 失敗：{e}，改用 yfinance 確認", level=logging.WARNING)
         try:
+            import yfinance as yf
             ticker = yf.Ticker("2330.TW")
-            hist = ticker.history(period="2d")
+            with provider_slot("yfinance"), METRICS.span("yfinance.history"):
+                hist = ticker.history(period="2d")
             if not hist.empty:
                 write_log("yfinance 確認有資料，視為交易日")
                 return True
         except Exception as e2:
-            write_log(f"yfinance 也失敗：{e2}")
+            write_log(f"yfinance 也失敗：{e2}", level=logging.WARNING)
         write_log("無法確認交易日，預設為交易日（避免漏跑）")
         return True
 
 
 # ======================== 價格取得函式 ========================
-def get_latest_available_price(dl, stock_id: str):
-    tz = timezone(timedelta(hours=8))
-    today = datetime.now(tz).strftime("%Y-%m-%d")
+def get_finmind_price(loader: MarketDataLoader, stock_id: str, today: str,
+                      on_start: Optional[Callable[[], None]] = None):
+    """
+    FinMind 當天最新價：先分鐘價，再當天日收盤；都沒有時回傳 None（交由 yfinance 批次備援）。
+    分鐘價的新時間點附加到本地分鐘價儲存（FinMind 只能整天查詢，已存過的時間點不重複寫入）。
+    on_start：分鐘價請求實際送出時呼叫（避險抓取的逾時起點）。
+    """
+    import pandas as pd
+
     try:
-        df = dl.get_data(dataset="TaiwanStockPrice", data_id=stock_id, start_date=today)
+        df = loader.tick(stock_id, today, on_start=on_start)
+        if loader.minutes is not None:
+            loader.minutes.append(stock_id, finmind_rows(df), "finmind")
         if df is not None and not df.empty and 'close' in df.columns:
             latest = df.iloc[-1]
             time_str = latest["date"]
             if "Time" in df.columns and pd.notna(latest.get("Time", None)):
                 time_str = f"{latest['date']} {latest['Time']}"
             price = float(latest["close"])
-            write_log(f"{stock_id} 取得當天最新分鐘價（FinMind）：{price:.2f} @ {time_str}")
+            write_log(f"{stock_id} 取得當天最新分鐘價（FinMind）：{price:.2f} @ {time_str}", stock_id=stock_id)
             return {
                 "price": price,
                 "time": time_str,
@@ -245,13 +330,13 @@ def get_latest_available_price(dl, stock_id: str):
                 "finmind_success": True
             }
     except Exception as e:
-        write_log(f"{stock_id} FinMind 當天分鐘價失敗：{e}")
+        write_log(f"{stock_id} FinMind 當天分鐘價失敗：{e}", stock_id=stock_id, level=logging.WARNING)
 
     try:
-        df_day = dl.taiwan_stock_daily(stock_id, start_date=today, end_date=today)
+        df_day = loader.daily(stock_id, today, today)
         if not df_day.empty:
             price = float(df_day.iloc[0]["close"])
-            write_log(f"{stock_id} 取得當天日收盤價（FinMind）：{price:.2f}")
+            write_log(f"{stock_id} 取得當天日收盤價（FinMind）：{price:.2f}", stock_id=stock_id)
             return {
                 "price": price,
                 "time": f"{today} 收盤",
@@ -260,61 +345,38 @@ def get_latest_available_price(dl, stock_id: str):
                 "finmind_success": True
             }
     except Exception as e:
-        write_log(f"{stock_id} FinMind 當天日收盤價失敗：{e}")
+        write_log(f"{stock_id} FinMind 當天日收盤價失敗：{e}", stock_id=stock_id, level=logging.WARNING)
 
-    write_log(f"{stock_id} FinMind 今天完全無資料 → 改用 yfinance 備援（自動偵測 .TW / .TWO）")
-    for suffix in ["TW", "TWO"]:
-        result = try_yfinance(stock_id, suffix)
-        if result:
-            return result
-
-    write_log(f"{stock_id} FinMind 與 yfinance 都無法取得任何價格")
+    write_log(f"{stock_id} FinMind 今天完全無資料 → 改用 yfinance 備援（自動偵測 .TW / .TWO）", stock_id=stock_id)
     return None
 
 
-def get_today_close(dl, stock_id: str, date_str: str) -> Optional[float]:
-    try:
-        df = dl.taiwan_stock_daily(stock_id, start_date=date_str, end_date=date_str)
-        if not df.empty:
-            return float(df.iloc[0]["close"])
-        return None
-    except Exception as e:
-        write_log(f"{stock_id} 取得 {date_str} 收盤價失敗：{e}")
-        return None
-
-
-def get_prev_close(dl, stock_id: str, before_date: str) -> Optional[float]:
-    """取得 before_date 之前最近一個交易日的收盤價（最多往回找 7 天，解決週一查到週日的問題）"""
-    try:
-        start = (datetime.strptime(before_date, "%Y-%m-%d") - timedelta(days=7)).strftime("%Y-%m-%d")
-        yesterday = (datetime.strptime(before_date, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
-        df = dl.taiwan_stock_daily(stock_id, start_date=start, end_date=yesterday)
-        if not df.empty:
-            return float(df.iloc[-1]["close"])
-        return None
-    except Exception as e:
-        write_log(f"{stock_id} 取得前一交易日收盤價失敗：{e}")
+def get_stock_data(stock_id: str, instant: Optional[Dict], bars: List[Dict], now: datetime,
+                   prev_trading_day: Optional[str] = None) -> Optional[Dict]:
+    """
+    由最新價與日 K 組出推播用資料。
+    前一交易日收盤取 bars 中 prev_trading_day 那一筆（交易日曆未涵蓋時取今天之前的最後一筆）；
+    當天收盤取 bars 中今天那筆，不再另外查詢。
+    """
+    if not instant:
         return None
 
-
-def get_stock_data(dl, stock_id: str) -> Optional[Dict]:
-    now = datetime.now(timezone(timedelta(hours=8)))
     today = now.strftime("%Y-%m-%d")
     is_after_close = now.hour > 13 or (now.hour == 13 and now.minute >= 30)
 
-    instant = get_latest_available_price(dl, stock_id)
-    if not instant:
-        return None
-
-    yesterday_close = get_prev_close(dl, stock_id, today)
-    if yesterday_close is None:
-        yesterday_close = instant["price"]
+    prev_bar = next((b for b in bars if b["date"] == prev_trading_day), None) if prev_trading_day else None
+    if prev_bar is None:
+        prev_bars = [b for b in bars if b["date"] < today]
+        prev_bar = prev_bars[-1] if prev_bars else None
+    yesterday_close = prev_bar["close"] if prev_bar else instant["price"]
+    today_close = next((b["close"] for b in bars if b["date"] == today), None)
 
     result = {
         "stock_id": stock_id,
         "latest_price": instant["price"],
         "latest_time": instant["time"],
         "yesterday_close": yesterday_close,
+        "today_close": today_close,
         "date": today,
         "is_after_close": is_after_close,
         "source": instant["source"],
@@ -323,148 +385,451 @@ def get_stock_data(dl, stock_id: str) -> Optional[Dict]:
     }
 
     if is_after_close:
-        close_price = get_today_close(dl, stock_id, today)
-        if close_price:
-            result["close_price"] = close_price
-        else:
-            result["close_price"] = instant["price"]
+        result["close_price"] = today_close if today_close else instant["price"]
         result["close_time"] = instant["time"]
 
     return result
 
 
-def calculate_ma(prices, window):
-    if len(prices) < window:
+def ma_history_range(now: datetime):
+    """均線所需日 K 範圍：近 90 天（≈63交易日，足以計算MA60）。"""
+    return (now - timedelta(days=90)).strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d")
+
+
+def get_ma_bars(loader: MarketDataLoader, store: BarStore, stock_id: str, now: datetime) -> List[Dict]:
+    """取得均線用日 K，已快取的日期不重抓。"""
+    start_date, end_date = ma_history_range(now)
+    try:
+        return sync_daily_bars(store, stock_id, start_date, end_date, fetch_daily=loader.daily, now=now)
+    except Exception as e:
+        write_log(f"{stock_id} 取得均線歷史資料失敗：{e}，均線以無資料顯示", stock_id=stock_id, level=logging.WARNING)
+        return []
+
+
+def login_finmind():
+    """登入 FinMind，失敗時回傳 None。"""
+    from FinMind.data import DataLoader
+    dl = DataLoader()
+    try:
+        dl.login_by_token(FINMIND_TOKEN)
+    except Exception as e:
+        write_log(f"FinMind 登入失敗：{e}", level=logging.WARNING)
         return None
-    return pd.Series(prices).rolling(window).mean().iloc[-1]
+    return dl
 
 
-# ======================== Google Sheets ========================
-def save_to_sheets(service, stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp):
-    if not service:
-        return False
+def make_loader(ctx, today: str) -> MarketDataLoader:
+    """單次執行用的資料載入器（ctx 為 NotifyContext 或 ShardContext）；請求依配額與各來源連線上限節流。"""
+    return MarketDataLoader(
+        ctx.dl, log=write_log,
+        finmind_slot=lambda: provider_slot("finmind"),
+        yfinance_slot=lambda: provider_slot("yfinance"),
+        markets=ctx.markets,
+        minutes=ctx.minutes,
+        today=today,
+    )
+
+
+# ======================== 抓取階段 ========================
+def fetch_all_stocks(loader: MarketDataLoader, store: BarStore, ma_states: MAStateStore,
+                     stock_list: List[str], now: datetime, prev_trading_day: Optional[str],
+                     calendar: Optional[TradingCalendar] = None) -> Dict[str, Dict]:
+    """
+    抓取整份清單，回傳 stock_id → bundle（順序由呼叫端決定）。
+    1. 有給 calendar 時，缺漏的近幾天日 K 以全市場單日查詢一次補齊（分片時由協調者先做好，傳 None）
+    2. 各股 FinMind 查詢以有上限的執行緒池並行（最新價先送出，再抓均線日 K）
+    3. FinMind 取不到價格、或請求送出後超過 PRICE_HEDGE_DELAY 秒仍未回應的股票，交給 yfinance 批次下載，
+       先到的有效價格勝出（同時到達時以 FinMind 為準）
+    4. 均線狀態只 push 上次之後的新收盤（O(1)），有變更的整批存回
+    """
+    started = time.monotonic()
+    today = now.strftime("%Y-%m-%d")
+    if calendar is not None:
+        prefetch_recent_bars(loader, store, calendar, stock_list, now)
+
+    workers = max(1, min(FETCH_MAX_WORKERS, len(stock_list)))
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch")
+    # 各檔 FinMind 最新價請求實際送出的時間：還排在執行緒池或連線名額後面的股票不算逾時
+    price_started: Dict[str, float] = {}
     try:
-        values = [[stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp]]
-        service.spreadsheets().values().append(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=f"{SHEET_NAME}!A2",
-            valueInputOption="USER_ENTERED",
-            body={"values": values}
-        ).execute()
-        write_log(f"{stock_id} 寫入 Sheets 成功：{date} - {price:.2f}")
-        return True
+        price_futures = {
+            stock_id: pool.submit(
+                get_finmind_price, loader, stock_id, today,
+                lambda sid=stock_id: price_started.setdefault(sid, time.monotonic()),
+            )
+            for stock_id in stock_list
+        }
+        bar_futures = {
+            stock_id: pool.submit(get_ma_bars, loader, store, stock_id, now)
+            for stock_id in stock_list
+        }
+        instants, race_stats = hedged_race(price_futures, loader.yf_latest, PRICE_HEDGE_DELAY,
+                                           starts=price_started)
+        bars_by_stock = {}
+        for stock_id, future in bar_futures.items():
+            try:
+                bars_by_stock[stock_id] = future.result()
+            except Exception as e:
+                write_log(f"{stock_id} 抓取資料發生未預期錯誤：{e}", stock_id=stock_id, level=logging.WARNING)
+                bars_by_stock[stock_id] = []
+    finally:
+        # 被 yfinance 搶先的 FinMind 查詢不必等它結束
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    for stock_id in stock_list:
+        if not instants[stock_id]:
+            write_log(f"{stock_id} FinMind 與 yfinance 都無法取得任何價格", stock_id=stock_id)
+    write_log(summarize_price_race(race_stats))
+
+    bundles = {}
+    changed_states = {}
+    for stock_id in stock_list:
+        bars = bars_by_stock[stock_id]
+        ma_state, changed = update_state(ma_states, stock_id, bars)
+        if changed:
+            changed_states[stock_id] = ma_state
+        bundles[stock_id] = {
+            "stock": get_stock_data(stock_id, instants[stock_id], bars, now, prev_trading_day),
+            "ma": ma_state,
+            "price_race": race_stats[stock_id],
+        }
+    ma_states.save_many(changed_states)
+    write_log(
+        f"抓取階段完成：{len(stock_list)} 支股票，FinMind 請求 {loader.request_count} 次，"
+        f"耗時 {time.monotonic() - started:.1f} 秒"
+    )
+    return bundles
+
+
+def prefetch_recent_bars(loader: MarketDataLoader, store: BarStore, calendar: TradingCalendar,
+                         stock_list: List[str], now: datetime):
+    """當天的全市場日 K 收盤（14:00）後才會有，盤中不查，免得每次執行白白用掉一次請求。"""
+    start_date, end_date = ma_history_range(now)
+    today = now.strftime("%Y-%m-%d")
+    extra_dates = [today] if now.hour >= MARKET_CLOSE_HOUR and calendar.is_trading_day(today) is not False else []
+    try:
+        loader.prefetch(stock_list, store, start_date, end_date, now=now, extra_dates=extra_dates,
+                        is_trading_day=calendar.is_trading_day)
     except Exception as e:
-        write_log(f"{stock_id} 寫入 Sheets 失敗：{e}")
-        return False
+        write_log(f"日 K 預先批次抓取失敗：{e}，改為逐檔查詢", level=logging.WARNING)
 
 
-# ======================== 盤中建議 ========================
-def get_intraday_advice(latest, ma5, ma20, pct):
-    if not (ma5 and ma20):
-        return "均線資料不夠，先等等看比較好"
-
-    diff_ma5 = (latest - ma5) / ma5 * 100 if ma5 else 0
-
-    if latest > ma5 and latest > ma20:
-        if diff_ma5 <= 2.8 and 3.0 <= pct <= 6.0:
-            return "剛突破均線 + 今天力道很強，建議可以全部買進（但設好停損點）"
-        elif diff_ma5 > 7.5 or (diff_ma5 > 6.0 and pct > 4.5):
-            return "現在明顯過熱 + 漲幅很大，建議全部賣出鎖利，或至少先賣 70%~100%"
-        elif pct > 5.0:
-            return "今天漲很多，建議先賣 50%~80% 鎖住部分利潤，剩下的看明天"
-        elif diff_ma5 > 4.5:
-            return "股價已經漲不少，現在偏貴，建議先觀望，或最多用 10%~20% 的資金試試看"
-        elif 1.5 <= pct < 3.5:
-            return "今天有往上力道，建議先用 25%~45% 的資金分批買進"
-        elif abs(pct) < 1.2:
-            if pct > 0:
-                return "小漲站上均線，建議先用 10%~25% 的資金試試看"
-            else:
-                return "站上均線但今天沒力道，建議先觀望，不要急著買"
-        else:
-            return "漲太快了，建議先不要追，最多用 15%~30% 的資金小量進場"
+def persist_prefetched_bars(loader: MarketDataLoader, store: BarStore, stock_list: List[str], now: datetime):
+    """
+    把全市場單日查詢取得的日 K 與 coverage 寫入本地快取（不發出請求），
+    分片 worker 讀同一個快取就不必再逐檔查詢；預先抓取沒涵蓋的區段留給 worker 逐檔補。
+    """
+    start_date, end_date = ma_history_range(now)
+    for stock_id in stock_list:
+        try:
+            sync_daily_bars(store, stock_id, start_date, end_date, fetch_daily=loader.prefetched, now=now)
+        except Exception as e:
+            write_log(f"{stock_id} 預先抓取的日 K 寫入快取失敗：{e}", stock_id=stock_id, level=logging.WARNING)
 
-    elif latest < ma5 and latest < ma20:
-        if pct < -5.0:
-            return "今天跌很多 + 跌破均線，建議全部賣出止損，或至少先賣 70%~100%"
-        elif pct < -2.5:
-            return "跌破均線 + 跌幅明顯，建議先賣 40%~70% 降低風險"
-        else:
-            return "股價在均線下面，建議暫時不要買，等反彈再看"
 
-    elif abs(pct) > 7.0:
-        if pct > 7.0:
-            return "今天漲超兇，建議先賣 60%~90% 鎖住大部分利潤"
-        else:
-            return "今天跌超兇，建議先賣 60%~90% 避險"
+# ======================== 分片抓取 ========================
+def shard_of(stock_id: str, shards: int) -> int:
+    """穩定的分片編號：內建 hash() 每個程序的雜湊種子不同，改用 crc32，同一支股票永遠落在同一個分片。"""
+    return zlib.crc32(stock_id.encode("utf-8")) % shards
 
-    else:
-        return "現在情況不明，先觀望比較安全，等明天再說"
 
+def split_shards(stock_list: List[str], shards: int) -> List[List[str]]:
+    """依 shard_of 切分清單，各分片內保持原本順序。"""
+    parts: List[List[str]] = [[] for _ in range(shards)]
+    for stock_id in stock_list:
+        parts[shard_of(stock_id, shards)].append(stock_id)
+    return parts
 
-def get_after_close_summary(latest, ma5, ma20, change):
-    if ma5 and latest > ma5 and ma20 and latest > ma20:
-        return "建議明天可以買進，今天收盤價比平均價高"
-    elif ma5 and latest < ma5 and ma20 and latest < ma20:
-        return "建議明天不要買，今天收盤價比平均價低"
-    elif abs(change) < 1:
-        return "今天沒什麼變化，明天再觀察"
-    else:
-        return "今天價格有變動，明天再看情況決定要不要買"
+
+class ShardContext:
+    """分片 worker 程序內的資源：只有抓取與均線計算用到的 FinMind 連線與本地儲存，常駐模式下跨次沿用。"""
+
+    def __init__(self):
+        self.dl = None
+        self.store = BarStore()
+        self.markets = MarketMap()
+        self.minutes = MinuteStore()
+        self.ma_states = MAStateStore()
+
+
+_shard_ctx: Optional[ShardContext] = None
+
+
+def _init_shard_worker(log_queue, shards: int):
+    """
+    worker 程序啟動：log 送回協調者寫入，各來源連線上限依分片數平分。
+    配額不必另外切分：桶狀態存在共用的 SQLite（見 quota.py），協調者與各 worker 從同一個桶取得額度。
+    """
+    global _shard_ctx, _provider_semaphores
+    forward_logging(log_queue)
+    _provider_semaphores = _make_provider_semaphores(shards)
+    _shard_ctx = ShardContext()
+
+
+def fetch_shard(stock_list: List[str], now: datetime, prev_trading_day: Optional[str]) -> Dict[str, Dict]:
+    """在 worker 程序中抓取並計算一個分片（不推播、不寫 Sheets），bundle 交回協調者。"""
+    ctx = _shard_ctx
+    if ctx.dl is None:
+        ctx.dl = login_finmind()
+        if ctx.dl is None:
+            raise RuntimeError("FinMind 登入失敗")
+    loader = make_loader(ctx, now.strftime("%Y-%m-%d"))
+    return fetch_all_stocks(loader, ctx.store, ctx.ma_states, stock_list, now, prev_trading_day)
+
+
+def fetch_sharded(ctx: "NotifyContext", loader: MarketDataLoader, stock_list: List[str],
+                  now: datetime) -> Dict[str, Dict]:
+    """
+    協調者：近幾天日 K 的全市場查詢先做一次並寫入共用的本地快取，
+    再把各分片交給 worker 程序並行抓取；某個分片失敗時改由協調者自己抓，不影響其他分片。
+    """
+    started = time.monotonic()
+    prefetch_recent_bars(loader, ctx.store, ctx.calendar, stock_list, now)
+    persist_prefetched_bars(loader, ctx.store, stock_list, now)
+    prev_trading_day = ctx.calendar.previous_trading_day(now.strftime("%Y-%m-%d"))
+    parts = split_shards(stock_list, ctx.shards)
+    futures = {}
+    try:
+        pool = ctx.shard_pool()
+        for i, part in enumerate(parts):
+            if part:
+                futures[i] = pool.submit(fetch_shard, part, now, prev_trading_day)
+    except Exception as e:
+        write_log(f"無法啟動分片 worker：{e}，改由協調者抓取", level=logging.WARNING)
+    bundles: Dict[str, Dict] = {}
+    failed = False
+    for i, part in enumerate(parts):
+        if not part:
+            continue
+        try:
+            if i in futures:
+                bundles.update(futures[i].result())
+                continue
+        except Exception as e:
+            write_log(f"分片 {i + 1}/{ctx.shards} 失敗：{e}，改由協調者抓取 {len(part)} 支", level=logging.WARNING)
+        failed = True
+        bundles.update(fetch_all_stocks(loader, ctx.store, ctx.ma_states, part, now, prev_trading_day))
+    if failed:
+        ctx.close_shard_pool()  # worker 可能已損壞，下次重建
+    write_log(
+        f"分片抓取完成：{ctx.shards} 個分片（{'／'.join(str(len(p)) for p in parts)} 支），"
+        f"耗時 {time.monotonic() - started:.1f} 秒"
+    )
+    return bundles
+
+
+# ======================== Google Sheets ========================
+def save_to_sheets(mirror: SheetMirror, stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp):
+    """
+    寫入 Sheet1 本地鏡像，執行結束時由 mirror.push() 在背景批次送出；
+    同一天已寫過的股票覆寫原本的列，不重複新增。
+    """
+    if not mirror:
+        return False
+    mirror.write(stock_id, stock_name, date, price, ma5, ma20, ma60, timestamp)
+    write_log(f"{stock_id} 排入 Sheets 寫入：{date} - {price:.2f}", stock_id=stock_id)
+    return True
+
+
+# ======================== 建議規則 ========================
+def load_rule_engine(sheets: SheetsGateway, ctx: "NotifyContext") -> RuleEngine:
+    """
+    從 Rules 分頁載入自訂規則（經本地快取，見 rules.py），內容變更時才重新編譯；
+    分頁不存在或讀取失敗時只用預設規則。有問題的規則略過，Discord 警告同一份內容只送一次。
+    """
+    loaded = ctx.config_cache.load(sheets, RULES_RANGE, parse=parse_rules, restore=restore_rules, missing_ok=True)
+    ruleset = loaded.value
+    if ruleset is None:
+        write_log(f"讀取 Rules 分頁失敗：{loaded.error}，使用預設規則", level=logging.WARNING)
+        ruleset = RuleSet([], [])
+    elif loaded.status == "stale":
+        write_log(f"讀取 Rules 分頁失敗：{loaded.error}，沿用上次快取的規則", level=logging.WARNING)
+
+    if ctx.rule_engine is None or ctx.rule_engine[0] != loaded.fingerprint:
+        ctx.rule_engine = (loaded.fingerprint, RuleEngine(ruleset.rules))
+        write_log(f"規則引擎：自訂規則 {len(ruleset.rules)} 條 + 預設規則 {len(DEFAULT_RULES)} 條")
+
+    if ruleset.errors and ctx.config_cache.needs_warning(RULES_RANGE, loaded.fingerprint):
+        for error in ruleset.errors:
+            write_log(f"⚠️ 規則有誤，略過：{error}", level=logging.WARNING)
+        send_discord_push(
+            f"⚠️ **Rules 分頁有 {len(ruleset.errors)} 條規則有誤，已略過**\n" + "\n".join(ruleset.errors[:10])
+        )
+        ctx.config_cache.mark_warned(RULES_RANGE, loaded.fingerprint)
+    return ctx.rule_engine[1]
+
+
+def evaluate_advice(engine: RuleEngine, bundles: Dict[str, Dict], stock_list: List[str],
+                    is_yesterday_push: bool, is_today_push: bool) -> Dict[str, str]:
+    """
+    依本次推播類型組出整份清單的價格／均線表，每種類型呼叫一次規則引擎（向量化），回傳 stock_id → 建議文字。
+    昨日收盤推播以昨收為價格、漲跌 0 評估盤中規則（與原本相同）。
+    """
+    groups: Dict[str, List] = {}
+    for stock_id in stock_list:
+        bundle = bundles.get(stock_id)
+        stock = bundle["stock"] if bundle else None
+        if not stock:
+            continue
+        ma = bundle["ma"].values() if bundle["ma"] else {}
+        latest, yesterday_close = stock["latest_price"], stock["yesterday_close"]
+        change = latest - yesterday_close
+        pct = change / yesterday_close * 100 if yesterday_close != 0 else 0
+        if is_yesterday_push:
+            mode, latest, change, pct = "intraday", yesterday_close, 0, 0
+        elif is_today_push and stock["is_after_close"]:
+            mode = "after_close"
+        else:
+            mode = "intraday"
+        groups.setdefault(mode, []).append(
+            (stock_id, (latest, yesterday_close, change, pct, ma.get(5), ma.get(20), ma.get(60)))
+        )
+
+    advice: Dict[str, str] = {}
+    for mode, items in groups.items():
+        stock_ids = [stock_id for stock_id, _ in items]
+        columns = {name: [values[i] for _, values in items] for i, name in enumerate(RULE_COLUMNS)}
+        advice.update(zip(stock_ids, engine.evaluate(mode, stock_ids, columns)))
+    return advice
 
 
 # ======================== 主程式 ========================
-def main():
+class NotifyContext:
+    """跨次執行共用的連線與快取；單次執行用完即關，常駐模式則整天沿用。"""
+
+    def __init__(self, shards: int = 1):
+        self.service = None
+        self.dl = None
+        self.shards = shards
+        self._shard_pool: Optional[ProcessPoolExecutor] = None
+        self._shard_log_listener = None  # 接收 worker log 的 QueueListener
+        self.store: Optional[BarStore] = None
+        self.calendar = TradingCalendar()
+        self.markets = MarketMap()
+        self.ma_states = MAStateStore()
+        self.push_states = PushStateStore()
+        self.minutes = MinuteStore()
+        self.mirror = SheetMirror(sheet_name=SHEET_NAME)
+        self.config_cache = ConfigCache()
+        self.rule_engine: Optional[Tuple[Optional[str], RuleEngine]] = None  # (Rules 指紋, 編譯好的引擎)
+
+    def ensure_clients(self) -> bool:
+        if self.service is None:
+            self.service = get_sheets_service()
+            if not self.service:
+                write_log("無法連線 Google Sheets，結束執行")
+                return False
+        if self.dl is None:
+            self.dl = login_finmind()
+            if self.dl is None:
+                return False
+        if self.store is None:
+            self.store = BarStore()
+        return True
+
+    def shard_pool(self) -> ProcessPoolExecutor:
+        """分片 worker 程序池（spawn：不繼承本程序的 SQLite 連線），常駐模式下跨次沿用。"""
+        if self._shard_pool is None:
+            import multiprocessing
+            mp_context = multiprocessing.get_context("spawn")
+            log_queue, self._shard_log_listener = process_log_queue(mp_context)
+            self._shard_pool = ProcessPoolExecutor(
+                max_workers=self.shards,
+                mp_context=mp_context,
+                initializer=_init_shard_worker,
+                initargs=(log_queue, self.shards),
+            )
+        return self._shard_pool
+
+    def close_shard_pool(self, wait: bool = False):
+        if self._shard_pool is not None:
+            self._shard_pool.shutdown(wait=wait, cancel_futures=True)
+            self._shard_pool = None
+        if self._shard_log_listener is not None:
+            self._shard_log_listener.stop()  # 寫完佇列中剩下的 worker 紀錄
+            self._shard_log_listener = None
+
+    def close(self):
+        self.close_shard_pool(wait=True)
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        self.calendar.close()
+        self.markets.close()
+        self.ma_states.close()
+        self.push_states.close()
+        self.minutes.close()
+        self.mirror.close()
+        self.config_cache.close()
+
+
+def main(ctx: Optional[NotifyContext] = None):
     tz = timezone(timedelta(hours=8))
     now = datetime.now(tz)
     now_str = now.strftime("%Y年%m月%d日 %H時%M分%S秒")
-    today_date = now.strftime("%Y-%m-%d")
-    hour = now.hour
-    minute = now.minute
 
     write_log(f"🕐 台灣時間：{now_str}")
 
     # 台灣時間 09:00 前為盤前，略過本次執行
-    if hour < 9:
+    if now.hour < 9:
         write_log("盤前時段（09:00 前），略過本次執行")
         return
 
-    service = get_sheets_service()
-    if not service:
-        write_log("無法連線 Google Sheets，結束執行")
-        return
-
-    dl = DataLoader()
+    own_ctx = ctx is None
+    ctx = ctx or NotifyContext(NOTIFY_SHARDS)
     try:
-        dl.login_by_token(FINMIND_TOKEN)
-    except Exception as e:
-        write_log(f"FinMind 登入失敗：{e}")
-        return
+        # 本地交易日曆確定休市時，不必連線 Sheets / FinMind 就結束
+        if ctx.calendar.is_trading_day(now.strftime("%Y-%m-%d")) is False:
+            write_log(f"交易日曆：今天 {now.strftime('%Y-%m-%d')} 休市，結束本次執行")
+            return
+        if ctx.ensure_clients():
+            METRICS.reset()
+            try:
+                run_notify(ctx, now)
+            finally:
+                METRICS.report(write_log)
+    finally:
+        if own_ctx:
+            ctx.close()
+
+
+def run_notify(ctx: NotifyContext, now: datetime):
+    now_str = now.strftime("%Y年%m月%d日 %H時%M分%S秒")
+    today_date = now.strftime("%Y-%m-%d")
+    hour = now.hour
+    minute = now.minute
+    service = ctx.service
 
     # ==================== 交易日檢查 ====================
     is_after_close = hour > 13 or (hour == 13 and minute >= 30)
 
-    if not is_trading_day(dl, today_date, is_after_close):
+    loader = make_loader(ctx, today_date)
+
+    refresh_trading_calendar(ctx.calendar, loader, ctx.store, today_date)
+    if not is_trading_day(ctx.calendar, loader, today_date, is_after_close):
         write_log(f"今天 {today_date} 判斷為非交易日，結束本次執行")
         return
 
     write_log("通過交易日檢查，開始處理股票資料...")
+    refresh_market_map(ctx.markets, loader, today_date)
+
+    # ──────────────── 一次 batchGet 讀取推播計數（與過期的 Config、Rules） ────────────────
+    sheets = SheetsGateway(service, GOOGLE_SHEET_ID, log=write_log)
+    try:
+        sheets.prefetch(([CONFIG_RANGE] if ctx.config_cache.expired(CONFIG_RANGE) else []) + [COUNT_RANGE],
+                        optional=[RULES_RANGE] if ctx.config_cache.expired(RULES_RANGE) else [])
+    except Exception as e:
+        write_log(f"Sheets 批次讀取失敗：{e}，改為逐一讀取", level=logging.WARNING)
 
     # ──────────────── 從 Config 分頁讀取股票清單 ────────────────
-    sheets_stock_list, sheets_stock_name_map = load_stock_list_from_sheets(service)
+    sheets_stock_list, sheets_stock_name_map = load_stock_list_from_sheets(sheets, ctx.config_cache)
     active_stock_list = sheets_stock_list if sheets_stock_list else STOCK_LIST
     active_stock_name_map = sheets_stock_name_map if sheets_stock_name_map else STOCK_NAME_MAP
 
     # ──────────────── 使用 Google Sheets 記錄當天推播批次計數 ────────────────
-    count_range = f"{SHEET_NAME}!J1:K1"  # J1: 日期, K1: 計數
-
     current_count = 1
     try:
-        result = service.spreadsheets().values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range=count_range
-        ).execute()
-        values = result.get('values', [])
+        values = sheets.get(COUNT_RANGE)
         if values and len(values) > 0 and len(values[0]) >= 2:
             sheet_date = str(values[0][0]).strip() if values[0][0] else ""
             sheet_count_str = str(values[0][1]).strip() if len(values[0]) > 1 else ""
@@ -473,7 +838,25 @@ def main():
             else:
                 write_log(f"Sheets 日期不符或無效：{sheet_date}，本次從 1 開始")
     except Exception as e:
-        write_log(f"讀取 Sheets 計數失敗：{e}，本次視為第 1 次")
+        write_log(f"讀取 Sheets 計數失敗：{e}，本次視為第 1 次", level=logging.WARNING)
+
+    # ==================== 原有推播時間判斷 ====================
+    is_yesterday_push = (hour == 13 and 31 <= minute < 59)
+    is_today_push = (hour >= 14)
+
+    # ──────────────── 抓取階段：所有股票資料到齊後才開始推播 ────────────────
+    # 分片模式下 worker 只負責抓取與計算；推播、Sheets 寫入與計數都由這裡（協調者）依清單順序做一次
+    with METRICS.span("stage.fetch"):
+        if ctx.shards > 1 and len(active_stock_list) > 1:
+            bundles = fetch_sharded(ctx, loader, active_stock_list, now)
+        else:
+            bundles = fetch_all_stocks(loader, ctx.store, ctx.ma_states, active_stock_list, now,
+                                       ctx.calendar.previous_trading_day(today_date), calendar=ctx.calendar)
+
+    # 建議文字：整份清單一次交給規則引擎計算（Rules 分頁＋預設規則）
+    with METRICS.span("stage.rules"):
+        engine = load_rule_engine(sheets, ctx)
+        advice_map = evaluate_advice(engine, bundles, active_stock_list, is_yesterday_push, is_today_push)
 
     # ──────────────── 推播批次標題 ────────────────
     title_text = "盤中更新"
@@ -488,49 +871,40 @@ def main():
         "════════════════════════════════════════════════════════════",
         ""
     ]
-    send_discord_push("\n".join(batch_title))
-    time.sleep(1.0)  # 縮短為 1 秒，避免卡太久
-
-    # ==================== 原有推播時間判斷 ====================
-    is_yesterday_push = (hour == 13 and 31 <= minute < 59)
-    is_today_push = (hour >= 14)
+    queue_discord_push("\n".join(batch_title))
 
     success = True  # 用來判斷是否完整執行所有股票
     holiday_skipped = 0  # 記錄因今日無即時資料（國定假日）而跳過的股票數
+    detector = ChangeDetector(ctx.push_states, today_date)
+    unchanged: List[str] = []  # 與上次推播相比無明顯變化的股票，合併成一行摘要
 
     for stock_id in active_stock_list:
         stock_name = active_stock_name_map.get(stock_id, stock_id)
-        stock = get_stock_data(dl, stock_id)
+        bundle = bundles[stock_id]
+        stock = bundle["stock"]
         if not stock:
-            write_log(f"{stock_id} 無法取得資料，跳過")
+            write_log(f"{stock_id} 無法取得資料，跳過", stock_id=stock_id)
             success = False
-            send_discord_push(
+            queue_discord_push(
                 f"⚠️ **{stock_id} {stock_name}** 無法取得資料，本次已跳過\n"
                 f"可能原因：代號錯誤 / 已下市 / 暫時性 API 問題"
             )
             continue
 
-        # 取得近 90 天收盤價計算均線（90天≈63交易日，足以計算MA60）
-        try:
-            df = dl.taiwan_stock_daily(
-                stock_id,
-                start_date=(now - timedelta(days=90)).strftime("%Y-%m-%d"),
-                end_date=now.strftime("%Y-%m-%d")
-            )
-            closes = df["close"].tolist() if not df.empty else []
-        except Exception as e:
-            write_log(f"{stock_id} 取得均線歷史資料失敗：{e}，均線以無資料顯示")
-            closes = []
-
-        ma5 = calculate_ma(closes, 5)
-        ma20 = calculate_ma(closes, 20)
-        ma60 = calculate_ma(closes, 60)
+        ma_state = bundle["ma"]
+        ma = ma_state.values() if ma_state else {}
+        ma5, ma20, ma60 = ma.get(5), ma.get(20), ma.get(60)
 
         ma5_str = f"{ma5:.2f}" if ma5 is not None else "無資料"
         ma20_str = f"{ma20:.2f}" if ma20 is not None else "無資料"
         ma60_str = f"{ma60:.2f}" if ma60 is not None else "無資料"
 
         latest = stock["latest_price"]
+        # 盤中試算：以最新價當作今日收盤的均線（狀態尚未含今天時才有意義）
+        what_if = ma_state.what_if(latest) if ma_state and ma_state.last_date < today_date else {}
+        what_if_str = "／".join(
+            f"{w}日 {what_if[w]:.2f}" if what_if.get(w) is not None else f"{w}日 無資料" for w in (5, 20, 60)
+        )
         yesterday_close = stock["yesterday_close"]
         change = latest - yesterday_close
         pct = change / yesterday_close * 100 if yesterday_close != 0 else 0
@@ -546,6 +920,10 @@ def main():
         else:
             if stock["source"] == "today_yfinance":
                 source_note = f"（{stock['latest_time']}）（yfinance 備援）"
+            elif stock["source"] == "stored_yfinance":
+                source_note = f"（{stock['latest_time']}，之後無新成交）（yfinance 備援）"
+            elif stock["source"] == "stored_finmind":
+                source_note = f"（{stock['latest_time']}）（FinMind 稍早的分鐘價）"
             else:
                 source_note = f"（{stock['latest_time']} 收盤）（yfinance 備援）"
 
@@ -559,6 +937,10 @@ def main():
         ]
 
         if is_yesterday_push:
+            advice = advice_map[stock_id]
+            snapshot = PushSnapshot("yesterday", yesterday_close, ma5, ma20, ma60, advice)
+            if not detect_change(detector, unchanged, stock_id, stock_name, snapshot):
+                continue
             msg = header + [
                 f"---",
                 f"【{stock_id} {stock_name} 昨日收盤價 {now.strftime('%Y年%m月%d日')}】",
@@ -568,24 +950,24 @@ def main():
                 f"5日均線：{ma5_str}",
                 f"20日均線：{ma20_str}",
                 f"60日均線：{ma60_str}",
-                f"建議：{get_intraday_advice(yesterday_close, ma5, ma20, 0)}",
+                f"建議：{advice}",
                 "※ 資料來源：FinMind"
             ]
-            send_discord_push("\n".join(msg))
-            write_log(f"{stock_id} 推播昨日收盤價完成")
-            time.sleep(1.0)
+            queue_discord_push("\n".join(msg))
+            write_log(f"{stock_id} 昨日收盤價已排入推播", stock_id=stock_id)
             continue
 
         if is_today_push and stock["is_after_close"]:
-            close_price_for_sheet = get_today_close(dl, stock_id, stock["date"])
+            close_price_for_sheet = stock["today_close"]
             if close_price_for_sheet is None:
-                write_log(f"{stock_id} 盤後寫入：FinMind 當天日K尚未有資料，跳過寫入")
+                write_log(f"{stock_id} 盤後寫入：FinMind 當天日K尚未有資料，跳過寫入", stock_id=stock_id)
                 close_price = stock["latest_price"]
                 close_note = f"{stock['latest_time']} （當前最新價）"
             else:
                 close_price = close_price_for_sheet
                 close_note = f"{stock['latest_time']} （日K正式收盤）"
 
+            summary = advice_map[stock_id]
             msg = header + [
                 f"---",
                 f"【{stock_id} {stock_name} 價格監控 {now.strftime('%Y年%m月%d日')}】",
@@ -598,28 +980,35 @@ def main():
                 f"20日均線：{ma20_str}",
                 f"60日均線：{ma60_str}",
                 f"今日收盤：{close_price:.2f} 元{close_note}",
-                f"行情摘要：{get_after_close_summary(latest, ma5, ma20, change)}",
+                f"行情摘要：{summary}",
                 footnote
             ]
 
             if close_price_for_sheet is not None:
                 save_to_sheets(
-                    service, stock_id, stock_name, stock["date"],
+                    ctx.mirror, stock_id, stock_name, stock["date"],
                     close_price_for_sheet, ma5, ma20, ma60, now_str
                 )
 
-            send_discord_push("\n".join(msg))
-            write_log(f"{stock_id} 推播盤後資訊完成")
-            time.sleep(1.0)
+            # Sheets 照常寫入；Discord 只推有明顯變化的股票
+            snapshot = PushSnapshot("after_close", latest, ma5, ma20, ma60, summary)
+            if detect_change(detector, unchanged, stock_id, stock_name, snapshot):
+                queue_discord_push("\n".join(msg))
+                write_log(f"{stock_id} 盤後資訊已排入推播", stock_id=stock_id)
             continue
 
         # 盤中推播 — 若今日無即時資料（國定假日），略過避免推出舊收盤
         if not stock["is_latest"]:
-            write_log(f"{stock_id} 今日無即時資料（可能為國定假日），略過盤中推播")
+            write_log(f"{stock_id} 今日無即時資料（可能為國定假日），略過盤中推播", stock_id=stock_id)
             holiday_skipped += 1
             success = False
             continue
 
+        advice = advice_map[stock_id]
+        snapshot = PushSnapshot("intraday", latest, ma5, ma20, ma60, advice)
+        if not detect_change(detector, unchanged, stock_id, stock_name, snapshot):
+            continue
+
         msg = header + [
             f"---",
             f"【{stock_id} {stock_name} 盤中監控 {now.strftime('%Y年%m月%d日')}】",
@@ -631,36 +1020,126 @@ def main():
             f"5日均線：{ma5_str}",
             f"20日均線：{ma20_str}",
             f"60日均線：{ma60_str}",
-            f"建議：{get_intraday_advice(latest, ma5, ma20, pct)}",
+            f"以最新價試算均線：{what_if_str}",
+            f"建議：{advice}",
             footnote
         ]
 
-        send_discord_push("\n".join(msg))
-        write_log(f"{stock_id} 盤中推播完成")
-        time.sleep(1.0)  # 個股間隔，避免太密集
+        queue_discord_push("\n".join(msg))
+        write_log(f"{stock_id} 盤中資訊已排入推播", stock_id=stock_id)
 
     # ──────────────── 國定假日：所有股票盤中均無即時資料 ────────────────
     if not is_yesterday_push and not is_today_push and holiday_skipped == len(active_stock_list):
-        send_discord_push(
+        queue_discord_push(
             "📢 今日所有股票均無即時交易資料（可能為國定假日），本次略過盤中推播"
         )
 
+    if unchanged:
+        queue_discord_push(
+            f"🔕 與上次推播相比無明顯變化（{len(unchanged)} 支）：" + "、".join(unchanged)
+        )
+
     # ──────────────── 只有完整執行才更新計數到 Sheets ────────────────
     if success:
-        try:
-            update_values = [[today_date, current_count]]
-            service.spreadsheets().values().update(
-                spreadsheetId=GOOGLE_SHEET_ID,
-                range=count_range,
-                valueInputOption="USER_ENTERED",
-                body={"values": update_values}
-            ).execute()
-            write_log(f"本次推播完成，更新 Sheets 計數：{today_date} 第 {current_count} 次")
-        except Exception as e:
-            write_log(f"更新 Sheets 計數失敗：{e}")
+        sheets.queue_update(COUNT_RANGE, [[today_date, current_count]])
+        write_log(f"本次推播完成，更新 Sheets 計數：{today_date} 第 {current_count} 次")
     else:
         write_log(f"本次推播未完整執行 {len(active_stock_list)} 支股票，不更新計數")
 
+    def push_sheets():
+        with METRICS.span("stage.sheets_flush"):
+            return ctx.mirror.push(sheets, log=write_log)
+
+    # ──────────────── Sheets 寫入在背景送出，同時合併送出本次所有推播（依清單順序） ────────────────
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets") as pool:
+        sheets_pushed = pool.submit(push_sheets)
+        with METRICS.span("stage.discord_flush"):
+            pushed = flush_discord_pushes()
+        # 全部送達才記下這次推播的內容，失敗時下次照常完整推播
+        if pushed:
+            detector.commit(now_str)
+        if not sheets_pushed.result():
+            write_log("部分 Sheets 寫入失敗，已留在本地鏡像，下次執行重送", level=logging.WARNING)
+    sheets.report()
+
+
+
+# ======================== 常駐排程模式 ========================
+DAEMON_INTERVAL_MINUTES = int(os.getenv("DAEMON_INTERVAL_MINUTES", "5"))
+DAEMON_START = (9, 0)    # 盤中 09:00～13:30、13:31 特殊時段、14:00 後盤後，皆由 main() 依時間判斷
+DAEMON_END = (15, 55)    # 與原本 */5 0-7（UTC）排程的最後一次相同
+
+
+def next_tick(after: datetime) -> datetime:
+    """回傳 after 之後（含）下一個排程時間：週一至週五 09:00～15:55，每 DAEMON_INTERVAL_MINUTES 分鐘。"""
+    t = after.replace(second=0, microsecond=0)
+    if t < after:
+        t += timedelta(minutes=1)
+    remainder = t.minute % DAEMON_INTERVAL_MINUTES
+    if remainder:
+        t += timedelta(minutes=DAEMON_INTERVAL_MINUTES - remainder)
+    while True:
+        start = t.replace(hour=DAEMON_START[0], minute=DAEMON_START[1])
+        end = t.replace(hour=DAEMON_END[0], minute=DAEMON_END[1])
+        if t.weekday() < 5 and start <= t <= end:
+            return t
+        if t.weekday() < 5 and t < start:
+            t = start
+        else:
+            t = (t + timedelta(days=1)).replace(hour=DAEMON_START[0], minute=DAEMON_START[1])
+
+
+def run_daemon():
+    """常駐模式：連線、HTTP 連線池與快取整天沿用，依內建排程執行並記錄每次延遲與耗時。"""
+    tz = timezone(timedelta(hours=8))
+    stopping = threading.Event()
+
+    def handle_stop(signum, frame):
+        write_log(f"收到結束訊號（{signum}），完成目前工作後停止")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    ctx = NotifyContext(NOTIFY_SHARDS)
+    write_log(f"常駐模式啟動：每 {DAEMON_INTERVAL_MINUTES} 分鐘，"
+              f"{DAEMON_START[0]:02d}:{DAEMON_START[1]:02d}～{DAEMON_END[0]:02d}:{DAEMON_END[1]:02d}（週一至週五）")
+    try:
+        while not stopping.is_set():
+            tick = next_tick(datetime.now(tz))
+            write_log(f"下一次執行：{tick.strftime('%Y-%m-%d %H:%M')}")
+            # 分段等待，讓結束訊號與系統時間校正能及時生效
+            while not stopping.is_set():
+                remaining = (tick - datetime.now(tz)).total_seconds()
+                if remaining <= 0:
+                    break
+                stopping.wait(min(remaining, 30))
+            if stopping.is_set():
+                break
+
+            started = time.monotonic()
+            lag = (datetime.now(tz) - tick).total_seconds()
+            try:
+                main(ctx)
+            except Exception as e:
+                # 連線可能已失效，下次重建
+                write_log(f"排程執行發生錯誤：{e}，下次重新建立連線", level=logging.WARNING)
+                ctx.close()
+                ctx = NotifyContext(NOTIFY_SHARDS)
+            write_log(f"⏱ 排程 {tick.strftime('%H:%M')} 啟動延遲 {lag:.2f} 秒，執行耗時 {time.monotonic() - started:.2f} 秒")
+    finally:
+        ctx.close()
+        write_log("常駐模式結束")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="多股自動推播")
+    parser.add_argument("--daemon", action="store_true", help="常駐模式：內建盤中排程，連線與快取跨次沿用")
+    parser.add_argument("--shards", type=int, default=NOTIFY_SHARDS,
+                        help="分片數：清單分給幾個 worker 程序抓取（預設 NOTIFY_SHARDS）")
+    args = parser.parse_args()
+    NOTIFY_SHARDS = max(1, args.shards)
+    if args.daemon:
+        run_daemon()
+    else:
+        main()
\ No newline at end of file
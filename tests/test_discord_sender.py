@@ -0,0 +1,34 @@
+from discord_sender import pack_blocks
+
+
+def test_pack_blocks_merges_in_order_within_limit():
+    blocks = ["a" * 8, "b" * 8, "c" * 8]
+    messages = pack_blocks(blocks, limit=20)
+    assert messages == ["a" * 8 + "\n\n" + "b" * 8, "c" * 8]
+    assert all(len(m) <= 20 for m in messages)
+
+
+def test_pack_blocks_block_exactly_at_limit_is_sent_alone():
+    assert pack_blocks(["x" * 10, "y"], limit=10) == ["x" * 10, "y"]
+
+
+def test_pack_blocks_splits_long_block_on_lines():
+    block = "\n".join(["l1" * 3, "l2" * 3, "l3" * 3])  # 三行各 6 字元
+    messages = pack_blocks([block], limit=13)
+    assert messages == ["l1" * 3 + "\n" + "l2" * 3, "l3" * 3]
+
+
+def test_pack_blocks_hard_splits_overlong_line():
+    messages = pack_blocks(["z" * 25], limit=10)
+    assert messages == ["z" * 10, "z" * 10, "z" * 5]
+
+
+def test_pack_blocks_keeps_all_text():
+    blocks = [f"股票 {i}\n" + "價格 " * i for i in range(30)]
+    messages = pack_blocks(blocks, limit=100)
+    assert all(len(m) <= 100 for m in messages)
+    assert "".join(messages).replace("\n", "") == "".join(blocks).replace("\n", "")
+
+
+def test_pack_blocks_empty():
+    assert pack_blocks([]) == []
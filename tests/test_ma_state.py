@@ -0,0 +1,114 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from indicators import calculate_ma, sma
+from ma_state import MA_WINDOWS, MAStateStore, RollingMA, update_state
+
+
+def make_bars(n: int, seed: int = 7):
+    rng = random.Random(seed)
+    price, start = 100.0, date(2024, 1, 1)
+    bars = []
+    for i in range(n):
+        price = round(max(1.0, price * (1 + rng.uniform(-0.05, 0.05))), 2)
+        bars.append({"date": (start + timedelta(days=i)).isoformat(), "close": price})
+    return bars
+
+
+def expected(closes, windows=MA_WINDOWS):
+    return {w: calculate_ma(closes, w) for w in windows}
+
+
+def test_values_match_full_recompute_while_pushing():
+    bars = make_bars(150)
+    state = RollingMA()
+    for i, bar in enumerate(bars):
+        state.push(bar["close"], bar["date"])
+        assert state.values() == expected([b["close"] for b in bars[:i + 1]])
+    assert state.last_date == bars[-1]["date"]
+    assert state.count == max(MA_WINDOWS)
+
+
+def test_values_equal_indicators_sma_bit_for_bit():
+    closes = [b["close"] for b in make_bars(90)]
+    state = RollingMA.from_bars(make_bars(90))
+    for w, value in state.values().items():
+        assert value == float(sma(closes, w)[-1])
+
+
+def test_short_history_has_no_long_averages():
+    state = RollingMA.from_bars(make_bars(10))
+    values = state.values()
+    assert values[5] is not None
+    assert values[20] is None and values[60] is None
+
+
+def test_what_if_does_not_change_state():
+    bars = make_bars(80)
+    state = RollingMA.from_bars(bars)
+    before = (state.values(), state.closes(), state.last_date)
+    assert state.what_if(123.45) == expected([b["close"] for b in bars] + [123.45])
+    assert (state.values(), state.closes(), state.last_date) == before
+
+
+def test_advance_pushes_only_new_bars():
+    bars = make_bars(100)
+    state = RollingMA.from_bars(bars[:70])
+    assert state.advance(bars[:90])
+    assert state.last_date == bars[89]["date"]
+    assert state.values() == expected([b["close"] for b in bars[:90]])
+
+
+def test_advance_refuses_when_last_date_is_missing():
+    bars = make_bars(100)
+    state = RollingMA.from_bars(bars[:70])
+    assert not state.advance(bars[75:])
+    assert not RollingMA().advance(bars)
+
+
+def test_check_reports_mismatch():
+    bars = make_bars(80)
+    state = RollingMA.from_bars(bars)
+    assert state.check(bars) == []
+    changed = [dict(b) for b in bars]
+    changed[-1]["close"] += 1
+    assert len(state.check(changed)) == len(MA_WINDOWS)
+
+
+@pytest.fixture
+def states(tmp_path):
+    s = MAStateStore(str(tmp_path / "market.db"))
+    yield s
+    s.close()
+
+
+def test_store_roundtrip_keeps_ring_order(states):
+    bars = make_bars(137)  # 環狀緩衝已繞過好幾圈
+    states.save_many({"2330": RollingMA.from_bars(bars)})
+    loaded = states.load("2330")
+    assert loaded.closes() == [b["close"] for b in bars[-max(MA_WINDOWS):]]
+    assert loaded.last_date == bars[-1]["date"]
+    loaded.push(200.0, "2099-01-01")
+    assert loaded.values() == expected([b["close"] for b in bars] + [200.0])
+    assert states.load("0050") is None
+
+
+def test_update_state_advances_or_rebuilds(states):
+    bars = make_bars(120)
+    state, changed = update_state(states, "2330", bars[:100])
+    assert changed
+    states.save_many({"2330": state})
+
+    state, changed = update_state(states, "2330", bars[:100])
+    assert not changed
+
+    state, changed = update_state(states, "2330", bars[:110])
+    assert changed and state.values() == expected([b["close"] for b in bars[:110]])
+
+    # 快取被改寫、對不上 last_date 時整段重建
+    rewritten = [dict(b, date=f"2030-{b['date'][5:]}") for b in bars[:60]]
+    state, changed = update_state(states, "2330", rewritten)
+    assert changed and state.last_date == rewritten[-1]["date"]
+    assert update_state(states, "2330", []) == (None, False)
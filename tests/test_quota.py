@@ -0,0 +1,152 @@
+import pytest
+
+from quota import BACKOFF_BASE, QuotaStore, TokenBucket, is_rate_limited
+
+
+class FakeClock:
+    """虛擬時鐘：sleep 直接把時間往前推。"""
+
+    def __init__(self, now: float = 1_000.0):
+        self.now = now
+        self.slept = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = QuotaStore(str(tmp_path / "market.db"))
+    yield s
+    s.close()
+
+
+def test_burst_is_free_then_refill_rate_applies(clock):
+    bucket = TokenBucket("t", quota=10, period=60, burst=3, clock=clock, sleep=clock.sleep)
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+    # 之後以 (10 - 3) / 60 的速率補充
+    assert bucket.acquire() == pytest.approx(60 / 7)
+    assert bucket.acquire() == pytest.approx(60 / 7)
+    assert clock.slept == pytest.approx([60 / 7, 60 / 7])
+
+
+def test_period_never_exceeds_quota(clock):
+    bucket = TokenBucket("t", quota=10, period=60, burst=4, clock=clock, sleep=clock.sleep)
+    start = clock.now
+    sent = []
+    for _ in range(40):
+        bucket.acquire()
+        sent.append(clock.now)
+    for t in sent:
+        assert sum(1 for s in sent if t <= s < t + 60) <= 10
+    assert clock.now > start
+
+
+def test_burst_equal_to_quota_keeps_one_token_for_refill(clock):
+    bucket = TokenBucket("t", quota=5, period=60, clock=clock, sleep=clock.sleep)
+    assert bucket.capacity == 5
+    assert bucket.rate == pytest.approx(1 / 60)
+
+
+def test_idle_time_refills_up_to_capacity(clock):
+    bucket = TokenBucket("t", quota=10, period=60, burst=3, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        bucket.acquire()
+    clock.now += 3600
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.acquire() > 0
+
+
+def test_penalize_blocks_and_halves_rate_until_successes(clock):
+    bucket = TokenBucket("t", quota=10, period=60, burst=3, clock=clock, sleep=clock.sleep)
+    bucket.penalize(retry_after=5)
+    assert bucket.strikes == 1 and bucket._factor == 0.5
+    # 額度已清空，以減半的速率補充一個額度比 retry_after 還久
+    assert bucket.acquire() == pytest.approx(2 * 60 / 7)
+
+    bucket.success()
+    assert bucket.strikes == 0 and bucket._factor == pytest.approx(0.6)
+    for _ in range(10):
+        bucket.success()
+    assert bucket._factor == 1.0
+
+
+def test_retry_after_blocks_even_with_tokens_left(clock):
+    bucket = TokenBucket("t", quota=600, period=60, burst=100, clock=clock, sleep=clock.sleep)
+    bucket.penalize(retry_after=5)
+    clock.now += 1  # 補回的額度足夠，但仍在退避中
+    assert bucket.acquire() == pytest.approx(4)
+
+
+def test_penalize_without_retry_after_backs_off_exponentially(clock):
+    bucket = TokenBucket("t", quota=10, period=60, burst=3, clock=clock, sleep=clock.sleep)
+    bucket.penalize()
+    first = bucket._blocked_until - clock.now
+    bucket.penalize()
+    second = bucket._blocked_until - clock.now
+    assert first == pytest.approx(BACKOFF_BASE)
+    assert second == pytest.approx(2 * BACKOFF_BASE)
+
+
+def test_slot_penalizes_only_rate_limit_errors(clock):
+    bucket = TokenBucket("t", quota=10, period=60, burst=3, clock=clock, sleep=clock.sleep)
+    with pytest.raises(RuntimeError):
+        with bucket.slot():
+            raise RuntimeError("Too Many Requests")
+    assert bucket.throttled == 1
+    with pytest.raises(ValueError):
+        with bucket.slot():
+            raise ValueError("bad input")
+    assert bucket.throttled == 1
+
+
+def test_is_rate_limited_prefers_status_code():
+    class HttpError(Exception):
+        def __init__(self, status):
+            super().__init__("Too Many Requests")
+            self.status_code = status
+
+    assert is_rate_limited(HttpError(429))
+    assert not is_rate_limited(HttpError(500))
+    assert is_rate_limited(Exception("Rate limited. Try after a while."))
+    assert not is_rate_limited(Exception("timeout"))
+
+
+def test_persisted_state_is_shared_between_buckets(clock, store, tmp_path):
+    first = TokenBucket("shared", quota=10, period=60, burst=3, clock=clock, sleep=clock.sleep, store=store)
+    for _ in range(3):
+        first.acquire()
+
+    # 另一個程序（另一條連線）重新建立同名的桶：不會重拿滿額的 burst
+    other_store = QuotaStore(store.path)
+    try:
+        second = TokenBucket("shared", quota=10, period=60, burst=3, clock=clock, sleep=clock.sleep,
+                             store=other_store)
+        assert second.acquire() == pytest.approx(60 / 7)
+        second.penalize(retry_after=30)
+    finally:
+        other_store.close()
+    assert first.acquire() == pytest.approx(30)  # 退避狀態也共用
+
+
+def test_success_without_backoff_does_not_write(clock, store):
+    bucket = TokenBucket("shared", quota=10, period=60, burst=3, clock=clock, sleep=clock.sleep, store=store)
+    bucket.acquire()
+    before = store._conn.total_changes
+    for _ in range(20):
+        bucket.success()
+    assert store._conn.total_changes == before
+
+    bucket.penalize(retry_after=1)
+    bucket.success()
+    tokens, updated, blocked_until, factor, strikes = store.read("shared")
+    assert strikes == 0 and factor == pytest.approx(0.6)
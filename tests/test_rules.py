@@ -0,0 +1,100 @@
+import pytest
+
+from rules import (
+    BASE_COLUMNS, DEFAULT_RULES, Rule, RuleEngine, build_env, compile_condition, parse_rules, restore_rules,
+)
+
+
+def columns(rows):
+    """[{price:..., ma5:...}, ...] → BASE_COLUMNS 各欄的清單（缺的欄位為 None）。"""
+    return {name: [row.get(name) for row in rows] for name in BASE_COLUMNS}
+
+
+@pytest.mark.parametrize("condition", [
+    "__import__('os').system('true')",
+    "price.__class__",
+    "max(price, 1)",
+    "abs(price, 1)",
+    "abs(x=price)",
+    "price in (1, 2)",
+    "price is None",
+    "price ** 2 > 1",
+    "price // 2 > 1",
+    "'a' == 'a'",
+    "[price][0] > 1",
+    "(lambda: 1)()",
+    "unknown > 1",
+    "price if pct else ma5",
+    "pct >",
+])
+def test_compile_rejects_disallowed_syntax(condition):
+    with pytest.raises(ValueError):
+        compile_condition(condition)
+
+
+def test_compile_rejects_non_boolean_result():
+    with pytest.raises(ValueError):
+        compile_condition("pct + 1")
+
+
+def test_condition_is_vectorized_and_nan_compares_false():
+    test = compile_condition("yclose <= ma20 < price and not (pct < -3 or abs(change) > 10)")
+    env_rows = [
+        {"price": 105, "yclose": 99, "change": 6, "pct": 6.1, "ma20": 100},    # 突破 MA20
+        {"price": 105, "yclose": 101, "change": 4, "pct": 4.0, "ma20": 100},   # 昨天已在均線上
+        {"price": 105, "yclose": 99, "change": 6, "pct": 6.1, "ma20": None},   # 無均線
+        {"price": 120, "yclose": 99, "change": 21, "pct": 21.2, "ma20": 100},  # 漲幅過大
+    ]
+    assert list(test(build_env(columns(env_rows)))) == [True, False, False, False]
+
+
+def test_parse_rules_collects_errors_and_skips_disabled():
+    rows = [
+        ["盤中", "2330, 0050", "pct >= 3", "強勢 {pct:+.1f}%", "Y"],
+        ["盤後", "*", "price > ma5", "站上五日線", ""],
+        ["盤中", "", "pct < -3", "停用", "N"],
+        ["每週", "", "pct > 0", "x", "Y"],
+        ["盤中", "", "open > 1", "x", "Y"],
+        ["盤中", "", "pct > 0", "{volume}", "Y"],
+        ["盤中", "", "pct > 0", "", "Y"],
+        [],
+    ]
+    parsed = parse_rules(rows)
+    assert [(r.mode, r.stocks, r.source) for r in parsed.rules] == [
+        ("intraday", ["2330", "0050"], "Rules!A2"),
+        ("after_close", [], "Rules!A3"),
+    ]
+    assert [e.split("：", 1)[0] for e in parsed.errors] == ["Rules!A5", "Rules!A6", "Rules!A7", "Rules!A8"]
+    assert restore_rules([[list(r) for r in parsed.rules], parsed.errors]) == parsed
+
+
+def test_default_rules_compile_and_match_original_ladder():
+    engine = RuleEngine()
+    rows = [
+        {"price": 10, "yclose": 10, "change": 0, "pct": 0},                                   # 無均線
+        {"price": 104, "yclose": 100, "change": 4, "pct": 4.0, "ma5": 102, "ma20": 100},    # 剛突破 + 強勢
+        {"price": 95, "yclose": 101, "change": -6, "pct": -5.9, "ma5": 100, "ma20": 102},   # 跌破 + 大跌
+        {"price": 100, "yclose": 100, "change": 0, "pct": 0, "ma5": 100, "ma20": 100},      # 不明
+    ]
+    advice = engine.evaluate("intraday", ["A", "B", "C", "D"], columns(rows))
+    assert advice == [DEFAULT_RULES[0].message, DEFAULT_RULES[1].message, DEFAULT_RULES[9].message,
+                      DEFAULT_RULES[14].message]
+    assert engine.evaluate("after_close", ["B"], columns(rows[1:2])) == [DEFAULT_RULES[15].message]
+    assert engine.evaluate("intraday", [], columns([])) == []
+
+
+def test_stock_rules_take_precedence_and_messages_are_formatted():
+    rules = [
+        Rule("intraday", [], "pct > 1", "全部 {pct:+.1f}%", "Rules!A2"),
+        Rule("intraday", ["2330"], "pct > 1", "台積 {price:.0f}", "Rules!A3"),
+    ]
+    engine = RuleEngine(rules)
+    rows = [{"price": 600, "yclose": 590, "change": 10, "pct": 1.7}] * 2
+    assert engine.evaluate("intraday", ["2330", "0050"], columns(rows)) == ["台積 600", "全部 +1.7%"]
+
+
+def test_no_matching_rule_without_defaults():
+    engine = RuleEngine([Rule("intraday", [], "pct > 1", "漲", "Rules!A2")], defaults=())
+    rows = [{"price": 1, "yclose": 1, "change": 0, "pct": 0}]
+    assert engine.evaluate("intraday", ["2330"], columns(rows)) == [None]
+    assert engine.evaluate("after_close", ["2330"], columns(rows)) == [None]
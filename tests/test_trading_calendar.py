@@ -0,0 +1,89 @@
+import pytest
+
+from bar_store import BarStore
+from trading_calendar import TradingCalendar
+
+# 2024-01：1/1 元旦休市，1/6、1/7 週末
+JAN_2024 = ["2024-01-02", "2024-01-03", "2024-01-04", "2024-01-05", "2024-01-08", "2024-01-09"]
+
+
+@pytest.fixture
+def calendar(tmp_path):
+    cal = TradingCalendar(str(tmp_path / "market.db"))
+    yield cal
+    cal.close()
+
+
+def test_refresh_year_covers_until_last_returned_date(calendar):
+    assert calendar.refresh_year(2024, lambda start, end: JAN_2024, today="2024-01-10")
+    assert calendar.covers("2024-01-01") and calendar.covers("2024-01-09")
+    assert not calendar.covers("2024-01-10")
+    assert calendar.is_trading_day("2024-01-01") is False
+    assert calendar.is_trading_day("2024-01-08") is True
+    assert calendar.is_trading_day("2024-01-06") is False
+    assert calendar.is_trading_day("2024-01-10") is None
+    assert calendar.is_trading_day("2023-12-29") is None
+
+
+def test_previous_trading_day_skips_weekends_and_needs_coverage(calendar):
+    calendar.refresh_year(2024, lambda start, end: JAN_2024, today="2024-01-10")
+    assert calendar.previous_trading_day("2024-01-08") == "2024-01-05"
+    assert calendar.previous_trading_day("2024-01-07") == "2024-01-05"
+    assert calendar.previous_trading_day("2024-01-03") == "2024-01-02"
+    assert calendar.previous_trading_day("2024-01-10") == "2024-01-09"  # 今天不在日曆中也可以
+    assert calendar.previous_trading_day("2024-01-02") is None          # 前一交易日在去年，未涵蓋
+    assert calendar.previous_trading_day("2024-01-11") is None
+
+
+def test_calendar_is_persisted(tmp_path, calendar):
+    calendar.refresh_year(2024, lambda start, end: JAN_2024, today="2024-01-10")
+    reopened = TradingCalendar(calendar.path)
+    try:
+        assert reopened.is_trading_day("2024-01-09") is True
+        assert reopened.previous_trading_day("2024-01-08") == "2024-01-05"
+    finally:
+        reopened.close()
+
+
+def test_empty_refresh_is_tried_once_a_day(calendar):
+    assert not calendar.refresh_year(2024, lambda start, end: [], today="2024-01-10")
+    assert not calendar.needs_refresh("2024-01-10")
+    assert calendar.needs_refresh("2024-01-11")
+    assert calendar.is_trading_day("2024-01-10") is None
+
+
+def test_probed_open_needs_after_close_confirmation_after_close(calendar):
+    assert not calendar.probed_open("2024-01-10", after_close=False)
+    calendar.record_open("2024-01-10", after_close=False)
+    assert calendar.probed_open("2024-01-10", after_close=False)
+    assert not calendar.probed_open("2024-01-10", after_close=True)
+
+    calendar.record_open("2024-01-10", after_close=True)
+    calendar.record_open("2024-01-10", after_close=False)  # 盤中的推估不會蓋掉盤後的確認
+    assert calendar.probed_open("2024-01-10", after_close=True)
+
+
+def test_probed_days_are_dropped_once_the_calendar_covers_them(calendar):
+    calendar.record_open("2024-01-09", after_close=True)
+    calendar.record_open("2024-01-10", after_close=True)
+    calendar.refresh_year(2024, lambda start, end: JAN_2024, today="2024-01-10")
+    reopened = TradingCalendar(calendar.path)
+    try:
+        assert not reopened.probed_open("2024-01-09", after_close=False)
+        assert reopened.probed_open("2024-01-10", after_close=True)
+    finally:
+        reopened.close()
+
+
+def test_learn_from_store_uses_cached_bar_dates(tmp_path, calendar):
+    store = BarStore(calendar.path)
+    try:
+        bars = [{"date": d, "close": 100.0} for d in JAN_2024]
+        store.upsert_bars("2330", bars)
+        store.set_coverage("2330", "2024-01-01", "2024-01-09")
+        calendar.learn_from_store(store, today="2024-01-09")
+    finally:
+        store.close()
+    assert calendar.covers("2024-01-08") and not calendar.covers("2024-01-09")  # 今天不推導
+    assert calendar.is_trading_day("2024-01-05") is True
+    assert calendar.is_trading_day("2024-01-06") is False
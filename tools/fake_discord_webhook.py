@@ -0,0 +1,142 @@
+"""
+本機假 Discord Webhook，模擬 Discord 的限流行為，用來驗證 discord_sender。
+
+- 每個視窗（預設 2 秒）最多接受 N 則（預設 5），超過回 429 + retry_after
+- 每次回應帶 X-RateLimit-Limit / Remaining / Reset-After 標頭
+- content 超過 2000 字元回 400
+
+單獨啟動（再把 DISCORD_WEBHOOK_URL 指到印出的網址）：
+    python tools/fake_discord_webhook.py --port 8765
+
+直接跑一次驗證（啟動假伺服器並用 DiscordSender 送出 N 個股票區塊）：
+    python tools/fake_discord_webhook.py --demo 12
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class RateLimitState:
+    def __init__(self, limit: int, window: float, clock=time.monotonic):
+        self.limit = limit
+        self.window = window
+        self.clock = clock  # 離線效能測試改用虛擬時鐘
+        self.lock = threading.Lock()
+        self.window_start = clock()
+        self.used = 0
+        self.accepted = []
+        self.rejected_429 = 0
+        self.rejected_400 = 0
+
+    def take(self):
+        """回傳 (是否接受, 剩餘次數, 距離重置秒數)。"""
+        with self.lock:
+            now = self.clock()
+            if now - self.window_start >= self.window:
+                self.window_start = now
+                self.used = 0
+            reset_after = self.window - (now - self.window_start)
+            if self.used >= self.limit:
+                self.rejected_429 += 1
+                return False, 0, reset_after
+            self.used += 1
+            return True, self.limit - self.used, reset_after
+
+
+def make_handler(state: RateLimitState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int, body: dict = None, remaining: int = 0, reset_after: float = 0.0):
+            payload = json.dumps(body).encode() if body is not None else b""
+            self.send_response(status)
+            self.send_header("X-RateLimit-Limit", str(state.limit))
+            self.send_header("X-RateLimit-Remaining", str(remaining))
+            self.send_header("X-RateLimit-Reset-After", f"{reset_after:.3f}")
+            if payload:
+                self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            if payload:
+                self.wfile.write(payload)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length) or b"{}")
+            content = data.get("content", "")
+            ok, remaining, reset_after = state.take()
+            if not ok:
+                self._reply(429, {"message": "You are being rate limited.", "retry_after": round(reset_after, 3),
+                                  "global": False}, 0, reset_after)
+                return
+            if len(content) > 2000:
+                with state.lock:
+                    state.rejected_400 += 1
+                self._reply(400, {"message": "content must be 2000 or fewer in length."}, remaining, reset_after)
+                return
+            with state.lock:
+                state.accepted.append(content)
+            self._reply(204, None, remaining, reset_after)
+
+    return Handler
+
+
+def start_server(port: int = 0, limit: int = 5, window: float = 2.0):
+    state = RateLimitState(limit, window)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/webhook"
+    return server, state, url
+
+
+def demo(blocks: int, limit: int, window: float):
+    from discord_sender import DiscordSender
+
+    server, state, url = start_server(0, limit, window)
+    sender = DiscordSender(url, log=lambda msg: None)
+    sample = "\n".join(["═" * 47, "🆕 新推播 🆕", "═" * 47] + [f"欄位 {i}：123.45 元" for i in range(10)])
+    for i in range(blocks):
+        sender.queue(f"【{i:04d}】\n{sample}")
+    started = time.monotonic()
+    ok = sender.flush()
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    received = "\n\n".join(state.accepted)
+    in_order = all(received.find(f"【{i:04d}】") < received.find(f"【{i + 1:04d}】") for i in range(blocks - 1))
+    print(f"區塊 {blocks} 個 → 訊息 {len(state.accepted)} 則，POST {sender.post_count} 次，"
+          f"429 {state.rejected_429} 次，400 {state.rejected_400} 次，耗時 {elapsed:.2f} 秒")
+    print(f"全部成功：{ok}，順序正確：{in_order}，最長訊息 {max(map(len, state.accepted), default=0)} 字元")
+    return ok and in_order and state.rejected_400 == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機假 Discord Webhook（含限流）")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--limit", type=int, default=5, help="每個視窗最多接受幾則")
+    parser.add_argument("--window", type=float, default=2.0, help="限流視窗秒數")
+    parser.add_argument("--demo", type=int, metavar="N", help="啟動後用 DiscordSender 送出 N 個區塊並回報結果")
+    args = parser.parse_args()
+
+    if args.demo:
+        sys.exit(0 if demo(args.demo, args.limit, args.window) else 1)
+
+    server, state, url = start_server(args.port, args.limit, args.window)
+    print(f"假 Discord Webhook 已啟動：{url}（每 {args.window} 秒最多 {args.limit} 則），Ctrl+C 結束")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"共接受 {len(state.accepted)} 則，429 {state.rejected_429} 次，400 {state.rejected_400} 次")
+
+
+if __name__ == "__main__":
+    main()
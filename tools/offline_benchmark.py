@@ -0,0 +1,611 @@
+"""
+離線效能測試：以本機假的 FinMind DataLoader、yfinance、Google Sheets service 與 Discord Webhook
+執行真正的進入點（推播程式 main()、補齊程式 main()），量測牆鐘時間、各 API 呼叫次數與峰值記憶體。
+
+- 假來源可設定延遲（真的 sleep，模擬網路 I/O，並行效果可反映在牆鐘時間）、錯誤率與 429 行為
+- 程式內刻意的等待（配額節流、限流退避、Discord 限流等待）改走虛擬時鐘，不真的等；
+  報表的「虛擬等待秒」是虛擬時鐘多走的時間（並行執行緒的等待互相重疊，不相加）
+- Discord 沿用 tools/fake_discord_webhook.py 的限流規則（改用虛擬時鐘）
+
+    python tools/offline_benchmark.py                          # 12 / 100 / 1000 支
+    python tools/offline_benchmark.py --sizes 12 100 --skip-fill
+    python tools/offline_benchmark.py --finmind-tick-empty      # 模擬免費方案：盤中價全部走 yfinance 備援
+    python tools/offline_benchmark.py --json bench.json         # 輸出結果供前後比較
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from datetime import datetime, timedelta, timezone
+from types import ModuleType
+from typing import Dict, List
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+TW_TZ = timezone(timedelta(hours=8))
+_real_sleep = time.sleep
+
+
+# ======================== 虛擬時鐘 ========================
+class VirtualClock:
+    """
+    取代程式內刻意的等待：sleep 只把呼叫端執行緒的虛擬時間往前推。
+    每個執行緒各自累計（同時等待的執行緒互相重疊，不會相加），第一次使用時從目前最前面的虛擬時間開始；
+    elapsed 為最前面的虛擬時間比真實時間多走了多少。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.elapsed = 0.0
+
+    def _offset(self) -> float:
+        offset = getattr(self._local, "offset", None)
+        if offset is None:
+            offset = self._local.offset = self.elapsed
+        return offset
+
+    def sleep(self, seconds: float):
+        if seconds and seconds > 0:
+            with self._lock:
+                self._local.offset = self._offset() + seconds
+                self.elapsed = max(self.elapsed, self._local.offset)
+
+    def monotonic(self) -> float:
+        return time.monotonic() + self._offset()
+
+
+class FakeService:
+    """共用：呼叫計數、延遲、錯誤率。"""
+
+    def __init__(self, name: str, latency: float, error_rate: float, seed: int):
+        self.name = name
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.errors = 0
+
+    def hit(self, method: str, error: str = "Internal Server Error", error_type: type = Exception):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            _real_sleep(self.latency)
+        if fail:
+            raise error_type(error)
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+# ======================== 假行情世界 ========================
+def is_otc(stock_id: str) -> bool:
+    """假世界的市場規則：3 開頭為上櫃（.TWO），其餘為上市（.TW）。"""
+    return stock_id.startswith("3")
+
+
+def trading_days(start: str, end: str) -> List[str]:
+    d = datetime.strptime(start, "%Y-%m-%d")
+    last = datetime.strptime(end, "%Y-%m-%d")
+    days = []
+    while d <= last:
+        if d.weekday() < 5:
+            days.append(d.strftime("%Y-%m-%d"))
+        d += timedelta(days=1)
+    return days
+
+
+def fake_close(stock_id: str, date: str) -> float:
+    base = 20 + zlib.crc32(stock_id.encode()) % 500
+    day = datetime.strptime(date, "%Y-%m-%d").toordinal()
+    return round(base * (1 + 0.05 * math.sin(day / 7 + base)), 2)
+
+
+class FakeDataLoader(FakeService):
+    """FinMind DataLoader 的替身（只實作本專案用到的方法）。"""
+
+    def __init__(self, universe: List[str], now: datetime, latency: float, error_rate: float,
+                 tick_empty: bool, date_wide: bool, seed: int = 1):
+        super().__init__("finmind", latency, error_rate, seed)
+        self.universe = list(universe)
+        self.now = now
+        self.tick_empty = tick_empty
+        self.date_wide = date_wide
+
+    def login_by_token(self, token):
+        self.hit("login_by_token")
+
+    def _last_bar_date(self) -> str:
+        day = self.now if self.now.hour >= 14 else self.now - timedelta(days=1)
+        return day.strftime("%Y-%m-%d")
+
+    def _frame(self, ids: List[str], start: str, end: str):
+        import pandas as pd
+        rows = [
+            {"date": d, "stock_id": sid, "Trading_Volume": 1000, "open": fake_close(sid, d),
+             "max": fake_close(sid, d), "min": fake_close(sid, d), "close": fake_close(sid, d)}
+            for sid in ids for d in trading_days(start, min(end, self._last_bar_date()))
+        ]
+        return pd.DataFrame(rows)
+
+    def taiwan_stock_daily(self, stock_id: str = "", start_date: str = "", end_date: str = ""):
+        self.hit("taiwan_stock_daily_all" if not stock_id else "taiwan_stock_daily")
+        if not stock_id:
+            if not self.date_wide:
+                raise Exception("Your level is register. Please update your user level.")
+            return self._frame(self.universe, start_date, end_date or start_date)
+        return self._frame([stock_id], start_date, end_date or start_date)
+
+    def taiwan_stock_info(self):
+        import pandas as pd
+        self.hit("taiwan_stock_info")
+        return pd.DataFrame({
+            "stock_id": self.universe,
+            "type": ["tpex" if is_otc(sid) else "twse" for sid in self.universe],
+            "date": ["2020-01-01"] * len(self.universe),
+        })
+
+    def get_data(self, dataset: str, data_id: str = "", start_date: str = "", end_date: str = "", **kwargs):
+        import pandas as pd
+        self.hit(f"get_data:{dataset}")
+        if dataset == "TaiwanStockTradingDate":
+            # 與真實資料一樣只到昨天，今天是否開盤要由程式另外探測
+            yesterday = (self.now - timedelta(days=1)).strftime("%Y-%m-%d")
+            return pd.DataFrame({"date": trading_days(start_date, min(end_date, yesterday))})
+        if dataset == "TaiwanStockPrice":
+            today = self.now.strftime("%Y-%m-%d")
+            if self.tick_empty or self.now.weekday() >= 5:
+                return pd.DataFrame()
+            return pd.DataFrame([{"date": today, "stock_id": data_id, "Time": self.now.strftime("%H:%M:%S"),
+                                  "close": fake_close(data_id, today)}])
+        raise Exception(f"未支援的假資料集：{dataset}")
+
+
+class FakeYFinance(FakeService):
+    """yfinance 模組的替身：download() 與 Ticker().history()；error_rate 以 Too Many Requests 表現。"""
+
+    def __init__(self, now: datetime, latency: float, error_rate: float, seed: int = 2):
+        super().__init__("yfinance", latency, error_rate, seed)
+        self.now = now
+
+    def module(self) -> ModuleType:
+        mod = ModuleType("yfinance")
+        mod.download = self.download
+        mod.Ticker = lambda symbol: _FakeTicker(self, symbol)
+        return mod
+
+    def _valid(self, ticker: str) -> bool:
+        stock_id, _, suffix = ticker.partition(".")
+        return suffix == ("TWO" if is_otc(stock_id) else "TW")
+
+    def download(self, tickers, period="1d", interval="1m", group_by="ticker", progress=False, threads=False,
+                 start=None):
+        import pandas as pd
+        self.hit("download", "Too Many Requests. Rate limited. Try after a while.")
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        if interval == "1m":
+            index = pd.DatetimeIndex([self.now.replace(tzinfo=None, second=0, microsecond=0)])
+        else:
+            index = pd.DatetimeIndex(pd.to_datetime(trading_days(
+                (self.now - timedelta(days=7)).strftime("%Y-%m-%d"), self.now.strftime("%Y-%m-%d"))[-5:]))
+        columns, data = [], []
+        for ticker in tickers:
+            if self._valid(ticker):
+                columns.append((ticker, "Close"))
+                data.append([fake_close(ticker.split(".")[0], ts.strftime("%Y-%m-%d")) for ts in index])
+        if not columns:
+            return pd.DataFrame()
+        return pd.DataFrame(list(zip(*data)), index=index, columns=pd.MultiIndex.from_tuples(columns))
+
+
+class _FakeTicker:
+    def __init__(self, yf: FakeYFinance, symbol: str):
+        self.yf = yf
+        self.symbol = symbol
+
+    def history(self, period="5d", interval="1d"):
+        data = self.yf.download([self.symbol], period=period, interval=interval)
+        return data[self.symbol] if not data.empty else data
+
+
+# ======================== 假 Google Sheets ========================
+_A1 = re.compile(r"^(?:'?([^'!]+)'?!)?([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$")
+
+
+def _col_index(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n - 1
+
+
+def parse_a1(range_name: str):
+    """回傳 (分頁, 起始列, 起始欄, 結束列或 None, 結束欄或 None)，皆為 0 起算。"""
+    sheet, c0, r0, c1, r1 = _A1.match(range_name).groups()
+    return (
+        sheet or "Sheet1",
+        int(r0) - 1 if r0 else 0,
+        _col_index(c0) if c0 else 0,
+        int(r1) - 1 if r1 else None,
+        _col_index(c1) if c1 else None,
+    )
+
+
+class FakeSheetsService(FakeService):
+    """googleapiclient Sheets service 的替身：values().batchGet/get/append/update/batchUpdate/clear。"""
+
+    def __init__(self, sheets: Dict[str, List[List]], latency: float, error_rate: float, seed: int = 3):
+        super().__init__("sheets", latency, error_rate, seed)
+        self.sheets = sheets
+        self.bytes = 0
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _request(self, method: str, fn, body=None):
+        return _FakeRequest(self, method, fn, body)
+
+    def _read(self, range_name: str) -> List[List]:
+        sheet, r0, c0, r1, c1 = parse_a1(range_name)
+        if sheet not in self.sheets:
+            raise _FakeHttpError(f"Unable to parse range: {range_name}", status=400)
+        rows = self.sheets[sheet]
+        out = []
+        for row in rows[r0:(r1 + 1 if r1 is not None else None)]:
+            cells = row[c0:(c1 + 1 if c1 is not None else None)]
+            while cells and cells[-1] in ("", None):
+                cells = cells[:-1]
+            out.append(cells)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def _write(self, range_name: str, values: List[List]):
+        sheet, r0, c0, _, _ = parse_a1(range_name)
+        rows = self.sheets.setdefault(sheet, [])
+        for i, values_row in enumerate(values):
+            while len(rows) <= r0 + i:
+                rows.append([])
+            row = rows[r0 + i]
+            while len(row) < c0 + len(values_row):
+                row.append("")
+            row[c0:c0 + len(values_row)] = values_row
+
+    def batchGet(self, spreadsheetId, ranges):
+        return self._request("batchGet", lambda: {
+            "valueRanges": [{"range": r, "values": self._read(r)} for r in ranges]
+        })
+
+    def get(self, spreadsheetId, range=None, fields=None):
+        if range is None:  # spreadsheets().get：工作表清單
+            # 新試算表預設 1000 列，append 超出時才變長
+            return self._request("get", lambda: {"sheets": [
+                {"properties": {"sheetId": i, "title": title, "gridProperties": {"rowCount": max(1000, len(rows))}}}
+                for i, (title, rows) in enumerate(self.sheets.items())
+            ]})
+        return self._request("get", lambda: {"range": range, "values": self._read(range)})
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        return self._request("update", lambda: self._write(range, body["values"]) or {}, body)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def run():
+            for item in body.get("data", []):
+                self._write(item["range"], item["values"])
+            titles = list(self.sheets)
+            for req in body.get("requests", []):  # spreadsheets().batchUpdate：只支援刪除列
+                r = req["deleteDimension"]["range"]
+                del self.sheets[titles[r["sheetId"]]][r["startIndex"]:r["endIndex"]]
+            return {}
+        return self._request("batchUpdate", run, body)
+
+    def append(self, spreadsheetId, range, valueInputOption, body):
+        def run():
+            sheet, r0, c0, _, _ = parse_a1(range)
+            rows = self.sheets.setdefault(sheet, [])
+            last = max([i for i, row in enumerate(rows) if any(row[c0:c0 + 8])] + [r0 - 1])
+            self._write(f"{sheet}!A{last + 2}", body["values"])
+            end = last + 1 + len(body["values"])
+            return {"updates": {"updatedRange": f"{sheet}!A{last + 2}:H{end}", "updatedRows": len(body["values"])}}
+        return self._request("append", run, body)
+
+    def clear(self, spreadsheetId, range, body=None):
+        def run():
+            sheet, r0, c0, r1, c1 = parse_a1(range)
+            rows = self.sheets.setdefault(sheet, [])
+            for row in rows[r0:(r1 + 1 if r1 is not None else None)]:
+                for c in range(c0, min(len(row), (c1 + 1) if c1 is not None else len(row))):
+                    row[c] = ""
+            return {}
+        return self._request("clear", run)
+
+
+class _FakeHttpError(Exception):
+    """googleapiclient HttpError 的替身：狀態碼放在 resp.status（預設 429 限流）。"""
+
+    def __init__(self, message: str, status: int = 429):
+        super().__init__(message)
+        self.resp = type("resp", (), {"status": status})()
+
+
+class _FakeRequest:
+    def __init__(self, service: FakeSheetsService, method: str, fn, body=None):
+        self.service = service
+        self.method = method
+        self.fn = fn
+        self.body = json.dumps(body, ensure_ascii=False) if body is not None else None
+
+    def execute(self):
+        self.service.hit(self.method, "Quota exceeded for quota metric 'Write requests'", _FakeHttpError)
+        if self.body:
+            with self.service.lock:
+                self.service.bytes += len(self.body.encode("utf-8"))
+        return self.fn()
+
+
+# ======================== 假 Discord ========================
+class FakeDiscordSession:
+    """requests.Session 替身：不經過 HTTP，直接套用 fake_discord_webhook 的限流規則（虛擬時鐘）。"""
+
+    def __init__(self, clock: VirtualClock, limit: int, window: float, latency: float):
+        from fake_discord_webhook import RateLimitState
+        self.state = RateLimitState(limit, window, clock=clock.monotonic)
+        self.latency = latency
+        self.calls = 0
+
+    def post(self, url, json=None, timeout=None):
+        self.calls += 1
+        if self.latency:
+            _real_sleep(self.latency)
+        content = (json or {}).get("content", "")
+        ok, remaining, reset_after = self.state.take()
+        headers = {"X-RateLimit-Remaining": str(remaining), "X-RateLimit-Reset-After": f"{reset_after:.3f}"}
+        if not ok:
+            return _FakeResponse(429, headers, {"retry_after": round(reset_after, 3)})
+        if len(content) > 2000:
+            self.state.rejected_400 += 1
+            return _FakeResponse(400, headers, {"message": "content must be 2000 or fewer in length."})
+        self.state.accepted.append(content)
+        return _FakeResponse(204, headers, None)
+
+
+class _FakeResponse:
+    def __init__(self, status_code: int, headers: Dict[str, str], body):
+        self.status_code = status_code
+        self.headers = headers
+        self._body = body
+        self.text = json.dumps(body, ensure_ascii=False) if body is not None else ""
+
+    def json(self):
+        return self._body
+
+
+# ======================== 載入真正的程式 ========================
+def load_script(filename: str, module_name: str) -> ModuleType:
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_watchlist(size: int) -> List[str]:
+    return [str(1101 + i) for i in range(size)]
+
+
+def make_spreadsheet(watchlist: List[str]) -> Dict[str, List[List]]:
+    return {
+        "Config": [["股票代號", "股票名稱", "啟用"]] + [[sid, f"測試{sid}", "Y"] for sid in watchlist],
+        "Sheet1": [["股票代號", "股票名稱", "日期", "收盤價", "MA5", "MA20", "MA60", "更新時間"]],
+    }
+
+
+class _FrozenDatetime(datetime):
+    frozen: datetime = None
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.frozen.astimezone(tz) if tz else cls.frozen.replace(tzinfo=None)
+
+
+def _frozen(at: datetime):
+    return type("FrozenDatetime", (_FrozenDatetime,), {"frozen": at})
+
+
+class Scenario:
+    def __init__(self, args, size: int, workdir: str, at: datetime):
+        self.args = args
+        self.size = size
+        self.at = at
+        self.watchlist = make_watchlist(size)
+        self.clock = VirtualClock()
+        scale = args.latency_scale
+        self.finmind = FakeDataLoader(self.watchlist + ["2330"], at, args.finmind_latency * scale,
+                                      args.finmind_error_rate, args.finmind_tick_empty, not args.no_date_wide)
+        self.yfinance = FakeYFinance(at, args.yfinance_latency * scale, args.yfinance_error_rate)
+        self.sheets = FakeSheetsService(make_spreadsheet(self.watchlist), args.sheets_latency * scale,
+                                        args.sheets_error_rate)
+        self.discord = FakeDiscordSession(self.clock, args.discord_limit, args.discord_window,
+                                          args.discord_latency * scale)
+        self.db_path = os.path.join(workdir, f"bench_{size}.db")
+
+    def calls(self) -> Dict[str, int]:
+        return {
+            "finmind": self.finmind.total,
+            "yfinance": self.yfinance.total,
+            "sheets": self.sheets.total,
+            "discord": self.discord.calls,
+        }
+
+
+def install(scenario: Scenario, modules: Dict[str, ModuleType]):
+    """把假來源接到已載入的模組上。"""
+    import bar_store
+    import config_cache
+    import ma_state
+    import market_map
+    import minute_store
+    import push_state
+    import quota
+    import sheet_mirror
+    import trading_calendar
+    from quota import QUOTAS
+    from discord_sender import DiscordSender
+
+    sys.modules["yfinance"] = scenario.yfinance.module()
+    sys.modules.setdefault("FinMind", ModuleType("FinMind"))
+    fake_finmind = ModuleType("FinMind.data")
+    fake_finmind.DataLoader = lambda: scenario.finmind
+    sys.modules["FinMind.data"] = fake_finmind
+
+    for module in (bar_store, config_cache, ma_state, market_map, minute_store, push_state, quota, sheet_mirror,
+                   trading_calendar):
+        module.BAR_STORE_PATH = scenario.db_path
+    QUOTAS.reset(clock=scenario.clock.monotonic, sleep=scenario.clock.sleep)
+
+    notify = modules["notify"]
+    notify.datetime = _frozen(scenario.at)
+    notify.get_sheets_service = lambda: scenario.sheets
+    notify._discord_sender = DiscordSender(
+        "https://discord.invalid/webhook", log=notify.write_log, session=scenario.discord,
+        sleep=scenario.clock.sleep, clock=scenario.clock.monotonic,
+    )
+    fill = modules.get("fill")
+    if fill is not None:
+        fill.datetime = _frozen(scenario.at)
+        fill.get_sheets_service = lambda: scenario.sheets
+        fill.DataLoader = lambda: scenario.finmind
+
+
+def measure(label: str, scenario: Scenario, fn, trace_memory: bool) -> Dict:
+    before = scenario.calls()
+    virtual_before = scenario.clock.elapsed
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    error = None
+    try:
+        fn()
+    except Exception as e:  # 量測照樣輸出，讓錯誤也看得到
+        error = f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024 if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+    after = scenario.calls()
+    return {
+        "scenario": label,
+        "symbols": scenario.size,
+        "wall_s": round(wall, 3),
+        "virtual_wait_s": round(scenario.clock.elapsed - virtual_before, 1),
+        "calls": {k: after[k] - before[k] for k in after},
+        "peak_alloc_mib": round(peak, 1) if peak is not None else None,
+        "max_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "error": error,
+    }
+
+
+def run_scenarios(args) -> List[Dict]:
+    workdir = tempfile.mkdtemp(prefix="offline_bench_")
+    os.environ.update({
+        "GOOGLE_SHEETS_CREDENTIALS": "{}",
+        "GOOGLE_SHEET_ID": "offline-benchmark",
+        "FINMIND_TOKEN": "offline-benchmark",
+        "DISCORD_WEBHOOK_URL": "https://discord.invalid/webhook",
+        "BAR_STORE_PATH": os.path.join(workdir, "default.db"),
+        "LOG_FILE": os.path.join(workdir, "bench.log"),
+        "LOG_CONSOLE": "1" if args.verbose else "0",
+        "FINMIND_DATE_WIDE": "0" if args.no_date_wide else "1",
+    })
+    modules = {"notify": load_script("stock-multi-notify.py", "bench_stock_multi_notify")}
+    if not args.skip_fill:
+        modules["fill"] = load_script("stock-history-fill.py", "bench_stock_history_fill")
+
+    results = []
+    for size in args.sizes:
+        for mode, at in [("intraday", args.intraday_at), ("after_close", args.after_close_at)]:
+            scenario = Scenario(args, size, workdir, at)
+            install(scenario, modules)
+            for run in ("cold", "warm"):
+                label = f"notify {mode} {run}"
+                results.append(measure(label, scenario, lambda: modules["notify"].main(), args.trace_memory))
+                print_row(results[-1])
+            os.remove(scenario.db_path)
+        if not args.skip_fill:
+            scenario = Scenario(args, size, workdir, args.after_close_at)
+            install(scenario, modules)
+            results.append(measure("fill", scenario, modules["fill"].main, args.trace_memory))
+            print_row(results[-1])
+    return results
+
+
+def print_row(r: Dict):
+    calls = r["calls"]
+    peak = f"{r['peak_alloc_mib']:7.1f}" if r["peak_alloc_mib"] is not None else "      -"
+    print(
+        f"{r['scenario']:<26}{r['symbols']:>6}{r['wall_s']:>9.2f}{r['virtual_wait_s']:>10.1f}"
+        f"{calls['finmind']:>9}{calls['yfinance']:>9}{calls['sheets']:>8}{calls['discord']:>9}"
+        f"{peak}{r['max_rss_mib']:>9.1f}"
+        + (f"  ❌ {r['error']}" if r["error"] else ""),
+        flush=True,
+    )
+
+
+def _parse_at(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d %H:%M").replace(tzinfo=TW_TZ)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="離線效能測試（假 FinMind / yfinance / Sheets / Discord）")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[12, 100, 1000], help="監控清單大小")
+    parser.add_argument("--skip-fill", action="store_true", help="不測補齊歷史程式")
+    parser.add_argument("--intraday-at", type=_parse_at, default=_parse_at("2026-10-16 10:30"))
+    parser.add_argument("--after-close-at", type=_parse_at, default=_parse_at("2026-10-16 14:30"))
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="所有假來源延遲的倍率（0 = 不延遲）")
+    parser.add_argument("--finmind-latency", type=float, default=0.05)
+    parser.add_argument("--yfinance-latency", type=float, default=0.2)
+    parser.add_argument("--sheets-latency", type=float, default=0.15)
+    parser.add_argument("--discord-latency", type=float, default=0.1)
+    parser.add_argument("--finmind-error-rate", type=float, default=0.0)
+    parser.add_argument("--yfinance-error-rate", type=float, default=0.0, help="以 Too Many Requests 失敗的比例")
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0)
+    parser.add_argument("--finmind-tick-empty", action="store_true", help="分鐘價查無資料（免費方案）")
+    parser.add_argument("--no-date-wide", action="store_true", help="不支援全市場單日查詢（免費方案）")
+    parser.add_argument("--discord-limit", type=int, default=5, help="Discord 每個視窗最多接受幾則")
+    parser.add_argument("--discord-window", type=float, default=2.0, help="Discord 限流視窗秒數")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+                        help="不用 tracemalloc 量峰值配置（較快）")
+    parser.add_argument("--json", help="把結果寫成 JSON 檔")
+    parser.add_argument("--verbose", action="store_true", help="同時輸出程式本身的 log")
+    args = parser.parse_args()
+
+    print(f"{'情境':<24}{'股票數':>4}{'牆鐘秒':>6}{'虛擬等待秒':>5}{'FinMind':>9}{'yfinance':>9}"
+          f"{'Sheets':>8}{'Discord':>9}{'峰值MiB':>5}{'RSS MiB':>9}")
+    results = run_scenarios(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if any(r["error"] for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
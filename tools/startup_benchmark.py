@@ -0,0 +1,118 @@
+"""
+推播程式啟動成本量測：以 python -X importtime 載入 stock-multi-notify.py（不執行 main），
+列出各模組 import 耗時、總耗時與峰值記憶體，並檢查重量級套件沒有在啟動時被載入。
+
+    python tools/startup_benchmark.py                  # 預設預算 300 ms
+    python tools/startup_benchmark.py --budget-ms 150 --top 15
+    python tools/startup_benchmark.py --deferred       # 另外列出各延後載入套件實際第一次使用時的成本
+
+超過預算或偵測到重量級套件於啟動時載入，結束碼為 1，可放進 CI 或部署前檢查。
+"""
+import argparse
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 這些套件應該延後到第一次使用才載入（頂層名稱 → 實際使用的模組，用於 --deferred 量測）
+DEFERRED_MODULES = {
+    "pandas": "pandas",
+    "numpy": "numpy",
+    "FinMind": "FinMind.data",
+    "yfinance": "yfinance",
+    "googleapiclient": "googleapiclient.discovery",
+    "google.oauth2": "google.oauth2.service_account",
+    "requests": "requests",
+}
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def _bench_env():
+    env = dict(os.environ)
+    # 只量測載入，不會真的連線；必要環境變數缺少時程式會直接丟錯，所以給假值
+    env.setdefault("GOOGLE_SHEETS_CREDENTIALS", "{}")
+    env.setdefault("GOOGLE_SHEET_ID", "startup-benchmark")
+    env.setdefault("FINMIND_TOKEN", "startup-benchmark")
+    env["PYTHONPATH"] = REPO_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def run_importtime(code: str):
+    """在子行程執行 code 並回傳 (牆鐘秒數, importtime 紀錄, 子行程峰值 RSS MiB)。"""
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_DIR, env=_bench_env(), capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit(f"子行程失敗（結束碼 {proc.returncode}）")
+    records = []
+    for line in proc.stderr.splitlines():
+        m = _IMPORTTIME_RE.match(line)
+        if m:
+            self_us, cumulative_us, indent, name = m.groups()
+            records.append({
+                "module": name,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+                "depth": len(indent) // 2,
+            })
+    peak_rss_mib = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return elapsed, records, peak_rss_mib
+
+
+def main():
+    parser = argparse.ArgumentParser(description="推播程式啟動成本量測")
+    parser.add_argument("--script", default="stock-multi-notify.py")
+    parser.add_argument("--budget-ms", type=float, default=300.0, help="載入總耗時預算（毫秒）")
+    parser.add_argument("--top", type=int, default=10, help="列出耗時最多的前 N 個頂層 import")
+    parser.add_argument("--deferred", action="store_true", help="另外量測各延後載入套件的成本")
+    args = parser.parse_args()
+
+    script = os.path.join(REPO_DIR, args.script)
+    code = f"import runpy; runpy.run_path({script!r}, run_name='startup_benchmark')"
+    elapsed, records, rss = run_importtime(code)
+
+    top_level = [r for r in records if r["depth"] == 0]
+    import_ms = sum(r["cumulative_ms"] for r in top_level)
+    print(f"== {args.script} 啟動 ==")
+    print(f"行程總耗時 {elapsed * 1000:.0f} ms（含直譯器啟動），import 合計 {import_ms:.0f} ms，峰值 RSS {rss:.1f} MiB")
+    print(f"-- 頂層 import 前 {args.top} 名（累計 ms）--")
+    for r in sorted(top_level, key=lambda r: r["cumulative_ms"], reverse=True)[:args.top]:
+        print(f"{r['cumulative_ms']:9.1f}  {r['module']}")
+
+    loaded = {r["module"] for r in records}
+    leaked = [m for m in DEFERRED_MODULES if m in loaded]
+
+    if args.deferred:
+        print("-- 延後載入套件第一次使用時的成本 --")
+        for module in DEFERRED_MODULES.values():
+            try:
+                m_elapsed, m_records, m_rss = run_importtime(f"import {module}")
+            except SystemExit:
+                print(f"{'-':>9}  {module}（未安裝）")
+                continue
+            own = next((r for r in m_records if r["module"] == module), None)
+            cost = own["cumulative_ms"] if own else m_elapsed * 1000
+            print(f"{cost:9.1f}  {module}")
+
+    failed = False
+    if leaked:
+        print(f"❌ 啟動時載入了應延後的套件：{', '.join(leaked)}")
+        failed = True
+    if import_ms > args.budget_ms:
+        print(f"❌ import 合計 {import_ms:.0f} ms 超過預算 {args.budget_ms:.0f} ms")
+        failed = True
+    if not failed:
+        print(f"✅ 在預算 {args.budget_ms:.0f} ms 內，且未提前載入重量級套件")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+台股交易日曆（本地 SQLite，與日 K 快取共用同一個檔案）。
+
+- 每年向 FinMind TaiwanStockTradingDate 載入一次交易日清單
+- FinMind 查不到時，改由已快取的日 K 推導（coverage 範圍內有任何股票成交的日子即為交易日）
+- is_trading_day() / previous_trading_day() 在記憶體中查表，O(1)；
+  日曆未涵蓋的日期回傳 None，由呼叫端改用原本的 API 判斷
+- TaiwanStockTradingDate 通常只到昨天：呼叫端探測到今天有開盤時以 record_open() 記下，
+  同一時段之後的執行直接查 probed_open()，不再探測；休市的探測結果不記錄（可能只是資料延遲）
+"""
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from bar_store import BAR_STORE_PATH, BarStore
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trading_days (
+    date TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS probed_open_days (
+    date        TEXT PRIMARY KEY,
+    after_close INTEGER NOT NULL  -- 1：盤後以當天日 K 確認；0：盤中依近幾天資料推估
+);
+CREATE TABLE IF NOT EXISTS calendar_meta (
+    year          INTEGER PRIMARY KEY,
+    covered_from  TEXT NOT NULL,
+    covered_until TEXT NOT NULL,
+    loaded_on     TEXT NOT NULL,
+    source        TEXT NOT NULL
+);
+"""
+
+
+def _shift(date: str, days: int) -> str:
+    return (datetime.strptime(date, "%Y-%m-%d") + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def _days(start: str, end: str) -> Iterable[str]:
+    d = datetime.strptime(start, "%Y-%m-%d")
+    last = datetime.strptime(end, "%Y-%m-%d")
+    while d <= last:
+        yield d.strftime("%Y-%m-%d")
+        d += timedelta(days=1)
+
+
+class TradingCalendar:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or BAR_STORE_PATH
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        """把日曆讀進記憶體：交易日集合、各年涵蓋範圍，以及每個日曆日 → 前一交易日。"""
+        with self._lock:
+            self._trading: Set[str] = {r[0] for r in self._conn.execute("SELECT date FROM trading_days")}
+            self._probed: Dict[str, bool] = {
+                r[0]: bool(r[1]) for r in self._conn.execute("SELECT date, after_close FROM probed_open_days")
+            }
+            self._meta: Dict[int, tuple] = {
+                r[0]: (r[1], r[2], r[3], r[4])
+                for r in self._conn.execute(
+                    "SELECT year, covered_from, covered_until, loaded_on, source FROM calendar_meta"
+                )
+            }
+            self._prev: Dict[str, str] = {}
+            last = None
+            for year in sorted(self._meta):
+                covered_from, covered_until = self._meta[year][:2]
+                for day in _days(covered_from, covered_until):
+                    if last:
+                        self._prev[day] = last
+                    if day in self._trading:
+                        last = day
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # ---------- 查詢 ----------
+    def covers(self, date: str) -> bool:
+        meta = self._meta.get(int(date[:4]))
+        return bool(meta) and meta[0] <= date <= meta[1]
+
+    def is_trading_day(self, date: str) -> Optional[bool]:
+        if not self.covers(date):
+            return None
+        return date in self._trading
+
+    def previous_trading_day(self, date: str) -> Optional[str]:
+        """date 之前最近一個交易日；日曆未涵蓋前一天時回傳 None（date 本身可在涵蓋範圍之外）。"""
+        day_before = _shift(date, -1)
+        if not self.covers(day_before):
+            return None
+        return day_before if day_before in self._trading else self._prev.get(day_before)
+
+    def probed_open(self, date: str, after_close: bool) -> bool:
+        """今天稍早已探測到開盤；盤後需要盤後的確認，盤中推估的結果不算。"""
+        confirmed = self._probed.get(date)
+        return confirmed is not None and (confirmed or not after_close)
+
+    def needs_refresh(self, date: str) -> bool:
+        """date 不在日曆中，且今天還沒嘗試載入過該年度時才需要重新載入。"""
+        if self.covers(date):
+            return False
+        meta = self._meta.get(int(date[:4]))
+        return not meta or meta[2] != date
+
+    # ---------- 載入 ----------
+    def record_open(self, date: str, after_close: bool):
+        """記下呼叫端以 API 探測到的開盤日（日曆未涵蓋的日期，通常是今天）。"""
+        with self._lock:
+            after_close = after_close or self._probed.get(date, False)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO probed_open_days (date, after_close) VALUES (?, ?)", (date, int(after_close))
+            )
+            self._conn.commit()
+            self._probed[date] = after_close
+
+    def _save_year(self, year: int, dates: Iterable[str], covered_from: str, covered_until: str,
+                   loaded_on: str, source: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM trading_days WHERE date BETWEEN ? AND ?", (covered_from, covered_until))
+            self._conn.executemany("INSERT OR REPLACE INTO trading_days (date) VALUES (?)", [(d,) for d in dates])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO calendar_meta (year, covered_from, covered_until, loaded_on, source) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (year, covered_from, covered_until, loaded_on, source),
+            )
+            self._conn.execute("DELETE FROM probed_open_days WHERE date <= ?", (covered_until,))
+            self._conn.commit()
+        self._load()
+
+    def refresh_year(self, year: int, fetch_dates: Callable[[str, str], Iterable[str]], today: str) -> bool:
+        """
+        以 fetch_dates(start, end) 載入整年交易日（FinMind TaiwanStockTradingDate）。
+        涵蓋範圍到回傳的最後一個交易日為止；若資料只到過去，之後的日期仍視為未涵蓋。
+        """
+        start, end = f"{year}-01-01", f"{year}-12-31"
+        dates = sorted({str(d)[:10] for d in fetch_dates(start, end) if start <= str(d)[:10] <= end})
+        if not dates:
+            # 仍記錄 loaded_on，避免同一天反覆嘗試
+            meta = self._meta.get(year)
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO calendar_meta (year, covered_from, covered_until, loaded_on, source) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (year, meta[0] if meta else start, meta[1] if meta else _shift(start, -1), today,
+                     meta[3] if meta else "empty"),
+                )
+                self._conn.commit()
+            self._load()
+            return False
+        self._save_year(year, dates, start, dates[-1], today, "finmind")
+        return True
+
+    def learn_from_store(self, store: BarStore, today: str):
+        """由日 K 快取推導已過去日期的交易日（FinMind 日曆不可用時的備援）。"""
+        coverage = [store.coverage(sid) for sid, *_ in store.stats()]
+        ranges = [c for c in coverage if c]
+        if not ranges:
+            return
+        covered_from = min(c[0] for c in ranges)
+        covered_until = min(max(c[1] for c in ranges), _shift(today, -1))
+        bar_dates = store.bar_dates(covered_from, covered_until)
+        for year in range(int(covered_from[:4]), int(covered_until[:4]) + 1):
+            if self._meta.get(year, (None, None, None, ""))[3] == "finmind":
+                continue
+            y_from = max(covered_from, f"{year}-01-01")
+            y_until = min(covered_until, f"{year}-12-31")
+            self._save_year(year, [d for d in bar_dates if y_from <= d <= y_until], y_from, y_until, today, "bars")